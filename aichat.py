@@ -5,7 +5,6 @@ intelligence-powered chat system. It features image and audio queries and a rati
 system in addition to the usual chat functions. This interface is different in that 
 the resulting chat text is editable. Just click on it a couple times."""
 import html
-import io
 import base64
 import json
 import os
@@ -13,9 +12,10 @@ import time
 import requests
 from pprint import pprint
 import gradio as gr
-from openai import OpenAI
 import librosa
 import soundfile as sf
+import preprocess
+import backends
 LLAVA_ENDPOINT = "http://localhost:8087/v1"
 model_changed = False
 
@@ -37,15 +37,18 @@ LICENSE = """    AI Chat Interface
     51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
     """
 
-client = OpenAI(base_url=LLAVA_ENDPOINT, api_key="llama.cpp")
+# Pooled, with retries; shared with album_create. More servers share
+# the work with LOCAL_ENDPOINTS=http://gpu1:8087/v1,http://gpu2:8087/v1
+LLAVA_ENDPOINTS = backends.endpoints(LLAVA_ENDPOINT)
+pool = backends.BackendPool(LLAVA_ENDPOINTS, "llama.cpp").start()
 
-# Get available models initially
+# Get available models initially, from every endpoint
 try:
-    models = [model.id for model in client.models.list()]
+    models = pool.list_models()
     if len(models) == 0:
-        print(f"\nNo models found at {LLAVA_ENDPOINT}\n")
+        print(f"\nNo models found at {', '.join(LLAVA_ENDPOINTS)}\n")
 except Exception as e:
-    print(f"\nERROR retrieving models from {LLAVA_ENDPOINT}: {e}\n")
+    print(f"\nERROR retrieving models from {', '.join(LLAVA_ENDPOINTS)}: {e}\n")
     models = []
 JS = """
 """
@@ -58,8 +61,8 @@ def get_system_prompt(model_name: str) -> str:
     """Module: get_system_prompt
     :param model_name: Name of the model
     :returns: Appropriate system prompt for the model"""
-    from look_up_model import get_caps
-    tags = get_caps(model_name.lower().split(':')[0])
+    from look_up_model import resolve_caps
+    tags = resolve_caps(model_name)
     vision = 'vision' in tags or 'omni' in tags
     audio = 'audio' in tags or 'omni' in tags
     video = 'video' in tags or 'omni' in tags
@@ -96,12 +99,8 @@ def predict(prompt, history: list):
 
     # Handle image input
     if demo.image is not None:
-        img = demo.image.resize((250, 250))
-        buffered = io.BytesIO()
-        img.save(buffered, format="PNG")
-        image_bytes = buffered.getvalue()
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-        image_url = f"data:image/png;base64,{image_base64}"
+        # Encoded once, then reused for each message about this image
+        image_url = preprocess.image_url(demo.image)
         message_content.append({
             "type": "image_url",
             "image_url": {"url": image_url}
@@ -140,34 +139,35 @@ def predict(prompt, history: list):
     # Append to history
     history.append({"role": "user", "content": message_content})
 
-    # Send request to the server
+    # Send request to the least-loaded server hosting the model
     try:
-        response = client.chat.completions.create(
-            model=demo.model,
-            messages=history,
-            temperature=0.2,
-            stream=True,
-        )
+        with pool.client(demo.model) as client:
+            response = client.chat.completions.create(
+                model=demo.model,
+                messages=history,
+                temperature=0.2,
+                stream=True,
+            )
 
-        history.append({"role": "assistant", "content": ""})
-        start_time = time.time()
-        token_count = 0
+            history.append({"role": "assistant", "content": ""})
+            start_time = time.time()
+            token_count = 0
 
-        for tok in response:                     # streamed tokens
-            content = tok.choices[0].delta.content
-            if content:
-                history[-1]["content"] += html.unescape(content)
-                token_count += 1
-                # Yield only the assistant message (first output)
-                yield history[-1]
+            for tok in response:                     # streamed tokens
+                content = tok.choices[0].delta.content
+                if content:
+                    history[-1]["content"] += html.unescape(content)
+                    token_count += 1
+                    # Yield only the assistant message (first output)
+                    yield history[-1]
 
-        token_count *= 2.75  # approximate
-        elapsed = time.time() - start_time
-        tps = token_count / elapsed if elapsed > 0 else 0
-        tps_str = f"{tps:.1f} tokens/sec."
+            token_count *= 2.75  # approximate
+            elapsed = time.time() - start_time
+            tps = token_count / elapsed if elapsed > 0 else 0
+            tps_str = f"{tps:.1f} tokens/sec."
 
-        # Yield the final assistant message **and** the TPS string
-        yield history[-1], tps_str
+            # Yield the final assistant message **and** the TPS string
+            yield history[-1], tps_str
     except Exception as e:
         history.append({"role": "assistant", "content": f"Error: {str(e)}".replace('\n', '<br>')})
         yield history[-1], "0 tokens/sec."
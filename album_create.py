@@ -4,16 +4,37 @@ Description: Create searchable photo albums and online image portfolios
 with the help of AI.
 License: Copyright (C) 2026 Henry F Kroll III, see LICENSE
 """
-import io
 import os
 import sys
+import json
+import time
+import tempfile
+import bisect
+import hashlib
 import base64
-from PIL import Image
-from flask import Flask, send_from_directory, render_template_string, jsonify
+import threading
+from collections import OrderedDict
+from flask import Flask, Response, send_from_directory, send_file, jsonify, request, abort
+from werkzeug.serving import is_running_from_reloader
 import google.generativeai as genai
 from openai import OpenAI
-from figs import parse_html
-from xmp import get_keywords
+from captions import open_store, cache_path, ResultCache
+from scanner import open_scanner, media_kind
+from search import open_index, export_index
+from vectors import open_vectors, stub_embed
+import similar
+from similar import open_similar
+import facets
+from facets import open_facets, encode_cursor, decode_cursor
+from jobs import JobQueue, CAPTION_WORKERS
+from bulk import BulkCaptioner
+import thumbs
+import preprocess
+import audio
+import video
+import backends
+from gemini import GeminiFiles
+from discovery import ModelDiscovery
 
 app = Flask(__name__)
 IMAGE_FOLDER="."
@@ -21,66 +42,110 @@ app.model = 'lorem' # default to lorem ipsum
 # Local llava-llama.cpp router endpoint
 # See https://github.com/ggml-org/llama.cpp/blob/master/tools/server/README.md
 BASE_URL = "http://localhost:8087/v1"
-lclient = OpenAI(base_url=BASE_URL, api_key="sk-xxx")
-# Get image/audio/video/any-to-any models to populate dropdown
-# We have to get tags with look_up_model.py & models.csv
-# Since router endpoints do not provide tag info (yet?).
-# Update models.csv with update_models.py, or add your own.
-from look_up_model import get_caps
-unfiltered = [model.id for model in lclient.models.list()]
-
-# Initialize list of eligible models and dictionary for tags
-models = []
-model_tags = {}
-
-try:
-    for model in unfiltered:
-        if model == "default":
-            continue
-        ml = model.lower()
-        # Attempt to retrieve tags using get_caps
-        tags = get_caps(ml.split(':')[0])
-        if not tags:
-            tags = get_caps(ml.rsplit('-', 1)[0])
-        # Check if model supports image/audio/any/video
-        if 'image' in tags or 'audio' in tags or 'any' in tags or 'video' in tags:
-            models.append(model)
-            model_tags[model] = tags
-            print(f"{tags} \t{model}")
-except Exception as e:
-    print(f"\nERROR retrieving model tags: {e}\n")
-
-if len(models) == 0:
-    print(f"\nNo image/audio/video models found at {BASE_URL}\n")
+# More servers share the work with LOCAL_ENDPOINTS=http://gpu1:8087/v1,...
+LOCAL_ENDPOINTS = backends.endpoints(BASE_URL)
+# Embedding model for semantic search (/api/search?mode=semantic), served
+# by the local endpoints; EMBED_MODEL=stub hashes words instead, to try it
+EMBED_MODEL = os.environ.get('EMBED_MODEL')
+SEMANTIC_RESULTS = 1000
+# With COPY_SIMILAR=1, AI Caption All copies captions to images that are
+# copies of each other (within similar.COPY_RADIUS) instead of captioning
+# them again. Off by default: memes on one template can look the same.
+COPY_SIMILAR = os.environ.get('COPY_SIMILAR', '0') != '0'
 # Google Gemini API endpoint
 GEMINI_API_ENDPOINT = "https://api.gemini.google/v1/text"
 # Your Gemini API key (export GENAI_TOKEN)
 GEMINI_API_KEY = os.environ.get("GENAI_TOKEN")
-genai.configure(api_key=GEMINI_API_KEY)
 # Configure OpenAI
 gpt_key = os.getenv("OPENAI_API_KEY")
 OpenAI.api_key = gpt_key
 
-@app.route('/')
-def gallery():
-    """Module: gallery: Generate the portfolio builder page
-    
-    :inputs: None
-    :outputs: None"""
-    # Fill collection with existing captions / EXIF XMP keywords
-    figures_collection = {}
-    # Get captions (figures_collection) from index.html, if it exists
-    index_path = os.path.join(IMAGE_FOLDER, 'index.html')
-    image_files = [f for f in os.listdir(IMAGE_FOLDER) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'))]
-    audio_files = [f for f in os.listdir(IMAGE_FOLDER) if f.lower().endswith(('.mp3', '.wav', '.ogg', '.m4a', '.flac', '.aac', '.wma', '.alac', '.aiff', '.opus', ))]
-    video_files = [f for f in os.listdir(IMAGE_FOLDER) if f.lower().endswith(('.mp4', '.mov', '.avi', '.mkv', '.webm', '.flv', '.wmv', '.mpeg', '.mpg'))]
-    if os.path.isfile(index_path):
-        figures_collection = parse_html(index_path)
-    else:
-        # Populate captions / keywords for both images and audio files
-        for fname in image_files + audio_files + video_files:
-            figures_collection[fname] = get_keywords(os.path.join(IMAGE_FOLDER, fname))
-    return render_template_string('''<!DOCTYPE html><head>
+# Queues, clients and caches are made on first use. Thumbnail worker
+# processes re-import this module, and must not open databases, start
+# threads or talk to backends.
+_services = {}
+_services_lock = threading.RLock()
+
+def _service(name, make):
+    with _services_lock:
+        if name not in _services:
+            _services[name] = make()
+        return _services[name]
+
+def caption_jobs():
+    """Module: caption_jobs: the JobQueue that captions files
+    Captioning runs in bounded per-backend worker pools, off the request
+    threads, so a slow model does not tie up the web server."""
+    return _service('jobs', lambda: JobQueue(
+        run_caption_job,
+        dict(CAPTION_WORKERS, local=backends.DEFAULT_SLOTS * len(LOCAL_ENDPOINTS))))
+
+def _local_backends():
+    # Get image/audio/video/any-to-any models to populate dropdown
+    # We have to get tags with look_up_model.py & models.csv
+    # Since router endpoints do not provide tag info (yet?).
+    # Update models.csv with update_models.py, or add your own.
+    # Discovery runs in the background so the gallery serves immediately,
+    # even when the router is slow or down. The page polls /api/models.
+    # The endpoints are health-checked between discoveries; requests go to
+    # the least-loaded one hosting the model.
+    pool = backends.BackendPool(LOCAL_ENDPOINTS, "sk-xxx",
+                                on_change=lambda: model_discovery().poke())
+    discovery = ModelDiscovery(pool.list_models, name=", ".join(LOCAL_ENDPOINTS))
+    return pool, discovery
+
+def local_pool():
+    """Module: local_pool: the BackendPool of LOCAL_ENDPOINTS, health-checked
+    in the background once it is first used"""
+    return _service('local', _local_backends)[0].start()
+
+def model_discovery():
+    """Module: model_discovery: the ModelDiscovery of the local endpoints,
+    refreshed in the background once it is first used"""
+    local_pool()
+    return _service('local', _local_backends)[1].start()
+
+def gemini_files():
+    """Module: gemini_files: Gemini uploads, cached by content hash"""
+    def make():
+        genai.configure(api_key=GEMINI_API_KEY)
+        return GeminiFiles(genai)
+    return _service('gemini', make)
+
+def result_cache():
+    """Module: result_cache: model output for files the model has seen"""
+    return _service('results', ResultCache)
+
+def media_catalog():
+    """Module: media_catalog: scanned media files in IMAGE_FOLDER
+    :returns: MediaScanner, brought up to date"""
+    scanner = open_scanner(IMAGE_FOLDER, on_media_change)
+    scanner.scan()
+    return scanner
+
+def on_media_change(scanner, changes):
+    """Process only the files that were added or changed"""
+    store = open_store(scanner.folder)
+
+    def thumbnails(names):
+        # Hashed by now, so file_hash is a lookup
+        entries = scanner.entries
+        images = [f for f in names if f in entries and entries[f].kind == 'image']
+        thumbs.pregenerate(cache_path(scanner.folder, thumbs.THUMB_DIR),
+                           ((os.path.join(scanner.folder, f), store.file_hash(f))
+                            for f in images))
+
+    # The first scan lists everything; rows for files deleted meanwhile go.
+    # New files are hashed in the background, then get thumbnails.
+    store.sync(changes.added, changes.changed, changes.removed,
+               complete=len(changes.added) == len(scanner.entries),
+               on_added=thumbnails)
+    # Dates, sizes and durations are read in the background
+    open_facets(store).refresh(scanner)
+
+# The gallery page. It is compiled once, and each rendering is cached
+# until the list of models changes; figures come from /api/items.
+GALLERY_TEMPLATE = '''<!DOCTYPE html><head>
         <meta charset="UTF-8"><!--//
     Generated by FindAImage - https://github.com/themanyone/FindAImage
         //-->
@@ -155,6 +220,18 @@ def gallery():
             margin: 0 auto;
             width: 350px;
         }
+        #gallery, #more {
+            width: 100%;
+        }
+        .chunk {
+            display: flex;
+            flex-wrap: wrap;
+            width: 100%;
+        }
+        body.no-audio-ai .ai-audio, body.no-image-ai .ai-image,
+        body.no-video-ai .ai-video {
+            display: none;
+        }
         .button {
         	background:linear-gradient(to bottom, #e6e6e6 5%, #757575 100%);
         	background-color:#e6e6e6;
@@ -210,37 +287,18 @@ def gallery():
     <a class="button" id="download">Save Gallery</a></div>
     <a style="position:absolute; right:5px; top:5px;" href="https://github.com/themanyone/FindAImage">FindAImage</a>
     </header>
-        {% for image in images %}
-            <figure style="float: left; margin: 10px;" title="{{ image }}">
-                <img src="{{ url_for('image_file', filename=image) }}" alt="{{ image }}" title="{{ image }}"><br>
-                <figcaption onClick="blank(this)" contenteditable="true">{{ figures.get(image, "Click to add searchable caption...") }}</figcaption>
-            <a class="button ai-image ai-button" data-type="image" data-filename="{{ image }}" onclick="describeImage(this)">Use AI</a></figure>
-        {% endfor %}
-        {% for audio in audios %}
-            <figure style="float: left; margin: 10px;" title="{{ audio }}">
-                <audio controls src="{{ url_for('media_file', filename=audio) }}" title="{{ audio }}"></audio><br>
-                <canvas class="waveform" data-src="{{ url_for('media_file', filename=audio) }}" title="{{ audio }}" width="320" height="64"></canvas>
-                 <figcaption onClick="blank(this)" contenteditable="true">{{ figures.get(audio, "Click to add searchable caption...") }}</figcaption>
-                 <!-- Use AI button for audio (hidden by default, shown for any and audio models) -->
-                 <a class="button ai-audio ai-button" data-type="audio" data-filename="{{ audio }}" style="display:none" onclick="describeAudio(this)">Use AI</a>
-             </figure>
-         {% endfor %}
-        {% for video in videos %}
-            <figure style="float: left; margin: 10px;" title="{{ video }}">
-                <video width="320" height="240" controls>
-                  <source src="{{ url_for('media_file', filename=video) }}" type="video/mp4">
-                  Your browser does not support the video tag.
-                </video><br>
-                 <figcaption onClick="blank(this)" contenteditable="true">{{ figures.get(video, "Click to add searchable caption...") }}</figcaption>
-                 <!-- Use AI button for video (shown for any, video, and image models) -->
-                 <a class="button ai-video ai-button" data-type="video" data-filename="{{ video }}" onclick="describeImage(this)">Use AI</a>
-             </figure>
-         {% endfor %}
+    <main id="gallery"></main>
+    <div id="more"></div>
     <script>
+        // Live gallery: figures are fetched from /api/items page by page
+        // as the user scrolls, and pages far off screen are emptied out.
+        var liveGallery = true;
+        const placeholder = "Click to add searchable caption...";
+        const pageSize = 200;
+        let model_tags = {{ model_tags | tojson }};
         function switch_ai(val) {
             //console.log(val);
             fetch('/model/' + val);
-            const model_tags = {{ model_tags | tojson }};
             var showAudioAI = val.includes('lorem') || model_tags[val]?.includes('audio') 
                 || model_tags[val]?.includes('any');
                                   console.log(`${val} ${model_tags[val]}`);
@@ -249,60 +307,241 @@ def gallery():
                                   || typeof model_tags[val] === 'undefined';
             const showVideoAI = val.includes('Lorem') || model_tags[val]?.includes('video') 
                 || model_tags[val]?.includes('any');
-            document.querySelectorAll('.ai-audio').forEach(b => b.style.display = showAudioAI ? 'inline-block' : 'none');
-            document.querySelectorAll('.ai-image').forEach(b => b.style.display = showVisionAI ? 'inline-block' : 'none');
-            document.querySelectorAll('.ai-video').forEach(b => b.style.display = showVideoAI ? 'inline-block' : 'none');
+            // Body classes also cover figures rendered later
+            document.body.classList.toggle('no-audio-ai', !showAudioAI);
+            document.body.classList.toggle('no-image-ai', !showVisionAI);
+            document.body.classList.toggle('no-video-ai', !showVideoAI);
         }
         switch_ai(document.getElementById('ai').value);
-        function describeImage(btn) {
-            let success = false;
-            const imageName = btn.dataset.filename;
-            const ele = btn.previousElementSibling;
-            if (btn) btn.innerText = 'Please Wait...';
-            const to = setTimeout(()=>{ if(!success && btn) btn.innerText = 'Try Again'; }, 20000);
-            return fetch('/describe/' + imageName)
+        // Models are discovered in the background. Fill in the dropdown
+        // as they arrive, then keep checking for changes.
+        let modelsLoaded = false;
+        function loadModels() {
+            fetch('/api/models')
                 .then(response => response.json())
                 .then(data => {
-                    if (ele) ele.textContent = data.description;
-                    success = true;
-                    if (btn) btn.innerText = 'Re-Caption This Image';
-                    clearTimeout(to);
-                    return data;
+                    model_tags = data.model_tags;
+                    const select = document.getElementById('ai');
+                    const selected = select.value;
+                    while (select.options.length > 3) select.remove(3);
+                    data.models.forEach(model => {
+                        const value = model.replace(/:/g, ';').replace(/\\//g, ',');
+                        select.add(new Option(model, value, false, value == selected));
+                    });
+                    if (!modelsLoaded || select.value != selected) switch_ai(select.value);
+                    modelsLoaded = data.ready;
+                    setTimeout(loadModels, data.ready && !data.error ? 60000 : 3000);
                 })
-                .catch(err => {
-                    if (btn) btn.innerText = 'Error';
-                    clearTimeout(to);
-                    throw err;
+                .catch(() => setTimeout(loadModels, 3000));
+        }
+        loadModels();
+        function esc(s) {
+            return String(s).replace(/[&<>"']/g, c => ({'&': '&amp;', '<': '&lt;',
+                '>': '&gt;', '"': '&quot;', "'": '&#39;'})[c]);
+        }
+        // One figure. live=false gives the markup for a saved gallery.
+        function figureHTML(item, live) {
+            const name = esc(item.name), url = encodeURIComponent(item.name);
+            let media;
+            if (item.type == 'image') {
+                media = live ? `<img src="/thumbs/320/${url}" data-hover="/thumbs/640/${url}" alt="${name}" title="${name}" loading="lazy">`
+                    : `<img src="/images/${url}" alt="${name}" title="${name}">`;
+            } else if (item.type == 'audio') {
+                media = `<audio controls src="/media/${url}" title="${name}"></audio><br>
+                <canvas class="waveform" data-src="/media/${url}" title="${name}" width="320" height="64"></canvas>`;
+            } else {
+                media = `<video width="320" height="240" controls>
+                  <source src="/media/${url}" type="video/mp4">
+                  Your browser does not support the video tag.
+                </video>`;
+            }
+            const caption = esc(item.caption || placeholder);
+            if (!live) {
+                return `<figure style="float: left; margin: 10px;" title="${name}">
+                ${media}<br>
+                <figcaption>${caption}</figcaption></figure>`;
+            }
+            const describe = item.type == 'audio' ? 'describeAudio' : 'describeImage';
+            return `<figure style="float: left; margin: 10px;" title="${name}" data-name="${name}">
+                ${media}<br>
+                <figcaption onClick="blank(this)" onFocus="this.dataset.saved=this.innerText" onBlur="saveCaption(this)" contenteditable="true">${caption}</figcaption>
+                <a class="button ai-${item.type} ai-button" data-type="${item.type}" data-filename="${name}" onclick="${describe}(this)">Use AI</a></figure>`;
+        }
+        const gallery = document.getElementById('gallery');
+        const itemsByName = new Map();
+        let query = '', cursor = null, finished = false, inflight = null, generation = 0;
+        function renderChunk(chunk) {
+            chunk.innerHTML = chunk.items.map(item => figureHTML(item, true)).join('');
+            chunk.querySelectorAll('canvas.waveform[data-src]').forEach(c => drawWaveform(c));
+        }
+        // Empty chunks that scroll far away, keeping their height; refill on return
+        const windowObserver = new IntersectionObserver(entries => {
+            entries.forEach(entry => {
+                const chunk = entry.target;
+                if (entry.isIntersecting && chunk.dataset.parked) {
+                    renderChunk(chunk);
+                    chunk.style.height = '';
+                    delete chunk.dataset.parked;
+                } else if (!entry.isIntersecting && !chunk.dataset.parked
+                           && !chunk.contains(document.activeElement)) {
+                    chunk.style.height = chunk.offsetHeight + 'px';
+                    chunk.textContent = '';
+                    chunk.dataset.parked = '1';
+                }
+            });
+        }, {rootMargin: '3000px 0px'});
+        // Search results are ranked filenames; fetch only the items not seen yet
+        async function searchPage(params) {
+            params.set('q', query);
+            const data = await (await fetch('/api/search?' + params)).json();
+            const missing = new URLSearchParams();
+            data.ids.forEach(name => { if (!itemsByName.has(name)) missing.append('name', name); });
+            if (missing.has('name')) {
+                const found = await (await fetch('/api/items?' + missing)).json();
+                found.items.forEach(item => itemsByName.set(item.name, item));
+            }
+            return {items: data.ids.map(name => itemsByName.get(name)).filter(Boolean),
+                    next: data.next};
+        }
+        async function fetchPage(gen) {
+            const params = new URLSearchParams({limit: pageSize});
+            if (cursor) params.set('cursor', cursor);
+            const data = query ? await searchPage(params)
+                : await (await fetch('/api/items?' + params)).json();
+            if (gen != generation) return;  // the search changed meanwhile
+            const chunk = document.createElement('div');
+            chunk.className = 'chunk';
+            chunk.items = data.items.map(item => itemsByName.get(item.name) || item);
+            chunk.items.forEach(item => itemsByName.set(item.name, item));
+            renderChunk(chunk);
+            gallery.appendChild(chunk);
+            windowObserver.observe(chunk);
+            cursor = data.next;
+            finished = !data.next;
+        }
+        function loadPage() {
+            if (finished) return Promise.resolve();
+            if (!inflight) {
+                const p = fetchPage(generation)
+                    .catch(err => console.log('gallery load error', err))
+                    .finally(() => {
+                        if (inflight === p) inflight = null;
+                        // Keep going while the bottom of the page is in view
+                        if (!finished && more.getBoundingClientRect().top < innerHeight + 3000)
+                            setTimeout(loadPage, 0);
+                    });
+                inflight = p;
+            }
+            return inflight;
+        }
+        function resetGallery(q) {
+            generation++;
+            query = q;
+            cursor = null;
+            finished = false;
+            inflight = null;
+            gallery.textContent = '';
+            loadPage();
+        }
+        const more = document.getElementById('more');
+        new IntersectionObserver(entries => {
+            if (entries[0].isIntersecting) loadPage();
+        }, {rootMargin: '3000px 0px'}).observe(more);
+        function figureFor(name) {
+            return gallery.querySelector(`figure[data-name="${CSS.escape(name)}"]`);
+        }
+        function setCaption(name, text) {
+            const item = itemsByName.get(name);
+            if (item) item.caption = text;
+            const figure = figureFor(name);
+            if (figure) figure.querySelector('figcaption').textContent = text;
+        }
+        // Captions are made by a job queue on the server. Queue a job,
+        // then follow it with Server-Sent Events, or poll if they fail.
+        // The caption fills in as the model writes it.
+        function followJob(id, btn, name) {
+            return new Promise((resolve, reject) => {
+                const events = new EventSource(`/api/jobs/${id}/events`);
+                let text = '';
+                events.addEventListener('status', e => {
+                    const data = JSON.parse(e.data);
+                    if (btn) btn.innerText = data.status == 'running' ? 'Please Wait...' : 'Queued...';
+                    if (name && data.delta) {
+                        text = text.slice(0, data.offset) + data.delta;
+                        const figure = figureFor(name);
+                        if (figure) figure.querySelector('figcaption').textContent = text;
+                    }
                 });
+                events.addEventListener('done', e => {
+                    events.close();
+                    resolve(JSON.parse(e.data));
+                });
+                events.onerror = () => {
+                    events.close();
+                    pollJob(id).then(resolve, reject);
+                };
+            });
         }
-        function describeAudio(btn) {
-            let success = false;
-            const audioName = btn.dataset.filename;
-            const ele = btn.previousElementSibling;
-            if (btn) btn.innerText = 'Please Wait...';
-            const to = setTimeout(()=>{ if(!success && btn) btn.innerText = 'Try Again'; }, 20000);
-            return fetch('/describe/' + audioName)
+        async function pollJob(id) {
+            for (;;) {
+                const data = await fetch(`/api/jobs/${id}?wait=30`).then(r => r.json());
+                if (data.status != 'queued' && data.status != 'running') return data;
+            }
+        }
+        function describe(name, btn, label) {
+            // Re-Caption asks the model again instead of using a cached result
+            const force = !!btn && btn.innerText.startsWith('Re-Caption');
+            const figure = figureFor(name);
+            const before = figure ? figure.querySelector('figcaption').textContent : null;
+            if (btn) btn.innerText = 'Queued...';
+            return fetch('/api/describe/' + encodeURIComponent(name), {method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({force: force})})
                 .then(response => response.json())
+                .then(data => data.job ? followJob(data.job, btn, name) : data)
                 .then(data => {
-                    if (ele) ele.textContent = data.description;
-                    success = true;
-                    if (btn) btn.innerText = 'Re-Caption This Audio';
-                    clearTimeout(to);
+                    if (data.status == 'error') {
+                        // Put back the caption a failed stream overwrote
+                        const figure = figureFor(name);
+                        if (figure && before !== null) figure.querySelector('figcaption').textContent = before;
+                        if (btn) {
+                            btn.innerText = 'Try Again';
+                            btn.title = data.error || '';
+                        }
+                        return data;
+                    }
+                    setCaption(name, data.description);
+                    if (btn) btn.innerText = label;
                     return data;
                 })
                 .catch(err => {
                     if (btn) btn.innerText = 'Error';
-                    clearTimeout(to);
                     throw err;
                 });
         }
-        // Caption all visible media sequentially using currently selected AI
-        async function aiCaptionAll() {
+        function describeImage(btn) {
+            return describe(btn.dataset.filename, btn, 'Re-Caption This Image');
+        }
+        function describeAudio(btn) {
+            return describe(btn.dataset.filename, btn, 'Re-Caption This Audio');
+        }
+        function isBlank(caption) {
+            return !caption || caption == 'None' || caption.slice(0, 5) == 'Click'
+                || caption.slice(0, 5) == 'Lorem';
+        }
+        // Caption all matching media on the server, as many at a time as
+        // the model allows. The run carries on if the page is closed, and
+        // the page picks up its progress again when it is reopened.
+        let bulkRun = null;
+        function followBulk(run) {
             const control = document.getElementById('ai_caption_all');
-            if (!control) return;
-            let shouldStop = false;
-                                  
-            // Add a button for shouldStop
+            if (!control || bulkRun) return;
+            bulkRun = run.run;
+            const original = control.dataset.label || control.innerText;
+            control.dataset.label = original;
+            control.disabled = true;
+
+            // Add a button to stop the run
             const stopButton = document.createElement('button');
             stopButton.innerText = 'Stop';
             stopButton.className = 'button';
@@ -310,66 +549,120 @@ def gallery():
             stopButton.style.color="white";
             stopButton.style.marginLeft="10px";
             control.parentNode.insertBefore(stopButton, control.nextSibling);
-            // Handle stop button click
             stopButton.addEventListener('click', () => {
-                shouldStop = true;
-                stopButton.style.display = 'none';
-                stopButton.remove();
+                stopButton.innerText = 'Stopping...';
+                stopButton.disabled = true;
+                fetch(`/api/bulk/${run.run}/cancel`, {method: 'POST'});
             });
 
-            // process AI captions
-            const original = control.innerText;
-            control.disabled = true;
-            control.innerText = 'Captioning...';
-            const items = Array.from(document.querySelectorAll('.ai-button'));
-            for (const item of items) {
-                // skip hidden buttons
-                if (item.offsetParent === null) continue;
-                // skip non-blank captions
-                const figcaption = item.previousElementSibling;
-                if (figcaption && figcaption.innerText !== 'None'
-                    && figcaption.innerText !== ''
-                    && figcaption.innerText.slice(0, 5) !== 'Click'
-                    && figcaption.innerText.slice(0, 5) !== 'Lorem') continue;
-                const type = item.dataset.type;
-                const fname = item.dataset.filename;
-                try {
-                    if (type === 'audio') await describeAudio(item);
-                    else await describeImage(item);
-                } catch (e) {
-                    console.log('AI caption error', e);
-                }
-                // small delay between items
-                await new Promise(r => setTimeout(r, 500));
-                if (shouldStop) break; // Exit early if shouldStop is true
-            }
-            control.innerText = 'Done';
-            setTimeout(()=> { control.innerText = original; control.disabled = false; }, 1500);
+            const show = data => {
+                const finished = data.captioned + data.failed + data.skipped + data.copied;
+                control.innerText = `Captioning ${finished} / ${data.total}`;
+                data.items.forEach(item => {
+                    if (item.status == 'done' || item.status == 'copied')
+                        setCaption(item.filename, item.description);
+                });
+            };
+            const end = label => {
+                bulkRun = null;
+                stopButton.remove();
+                control.innerText = label;
+                setTimeout(()=> { control.innerText = original; control.disabled = false; }, 1500);
+            };
+            const events = new EventSource(`/api/bulk/${run.run}/events`);
+            events.addEventListener('status', e => show(JSON.parse(e.data)));
+            events.addEventListener('done', e => {
+                const data = JSON.parse(e.data);
+                events.close();
+                show(data);
+                if (data.error) console.log('AI caption error', data.error);
+                end(data.status == 'error' ? 'Error' : 'Done');
+            });
+            // The browser reconnects by itself unless the run is gone
+            events.onerror = () => {
+                if (events.readyState == EventSource.CLOSED) end('Error');
+            };
         }
+        function aiCaptionAll() {
+            const control = document.getElementById('ai_caption_all');
+            fetch('/api/bulk', {method: 'POST', headers: {'Content-Type': 'application/json'},
+                                body: JSON.stringify({q: query})})
+                .then(response => response.json())
+                .then(data => {
+                    if (data.run) return followBulk(data);
+                    console.log('AI caption error', data.error);
+                    control.innerText = 'Not Available';
+                    setTimeout(()=> { control.innerText = control.dataset.label || 'AI Caption All'; }, 1500);
+                });
+        }
+        fetch('/api/bulk').then(response => response.json()).then(data => {
+            if (data && data.status == 'running') followBulk(data);
+        });
         document.getElementById('ai_caption_all').addEventListener('click', aiCaptionAll);
         function blank(e){
             if (e.innerHTML=="Click to add searchable caption..."){
                 e.innerHTML = "";
             }
         }
+        // Remember captions edited by hand
+        function saveCaption(e){
+            const btn = e.nextElementSibling;
+            const text = e.innerText.trim();
+            if (!btn || !text || text == e.dataset.saved.trim()
+                || text.startsWith('Click to add')) return;
+            const item = itemsByName.get(btn.dataset.filename);
+            if (item) item.caption = text;
+            fetch('/caption/' + encodeURIComponent(btn.dataset.filename), {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({caption: text})
+            });
+        }
         function remove(e){
             let parentNode = e.parentNode;
                 parentNode.removeChild(e);
         }
+        // Every item in the folder, in page order, with any captions edited here
+        async function allItems() {
+            const items = [];
+            let next = null;
+            do {
+                const params = new URLSearchParams({limit: 500});
+                if (next) params.set('cursor', next);
+                const data = await (await fetch('/api/items?' + params)).json();
+                data.items.forEach(item => items.push(itemsByName.get(item.name) || item));
+                next = data.next;
+            } while (next);
+            return items;
+        }
         // Download the finished gallery page
-        document.getElementById('download').addEventListener('click', function() {
+        document.getElementById('download').addEventListener('click', async function() {
 
             // Parse document's HTML
             htmlContent = document.documentElement.outerHTML;
             let parser = new DOMParser();
             doc = parser.parseFromString(htmlContent, 'text/html');
 
+            // Write out every figure, not just the ones on screen
+            const items = await allItems();
+            doc.getElementById('gallery').innerHTML = items.map(item => figureHTML(item, false)).join('');
+            doc.body.removeAttribute('class');
+            remove(doc.getElementById('more'));
             // Remove links
             doc.querySelectorAll('a').forEach(e=>remove(e));
             // Remove AI dropdown
             remove(doc.querySelector('label[for=ai]'));
             // Remove this script
             remove(doc.querySelector('script'));
+            // Prebuilt search index, ahead of the search script that reads it
+            const index = doc.createElement('script');
+            index.type = 'application/json';
+            index.id = 'search-index';
+            index.textContent = await (await fetch('/api/search/export', {method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({items: items.map(item => [item.name, item.caption])})})).text();
+            const code = doc.querySelector('script');
+            code.parentNode.insertBefore(index, code);
             // Remove help span
             remove(doc.querySelector('span'));
 
@@ -397,37 +690,36 @@ def gallery():
             // Show help message
             document.getElementById("help").style.display="inline-block";
         });
-    </script><script>
-        // Search functions
-        let figures = document.querySelectorAll('figure');
-       
-        function filterFigures(event) {
+        // Swap in the larger thumbnail the first time an image is hovered
+        function hoverThumb(event) {
+            const img = event.target;
+            if (img.tagName == 'IMG' && img.dataset.hover
+                && img.getAttribute('src') != img.dataset.hover) {
+                img.setAttribute('src', img.dataset.hover);
+            }
+        }
+        document.body.addEventListener('mouseover', hoverThumb);
+        // Search on the server, shortly after typing stops
+        let searchTimer = null;
+        function searchGallery(event) {
             if (event.key == "Escape") event.target.value = '';
-            let searchTerm = (event.target.value || '').trim().toLowerCase();
-            if (searchTerm.length == 0) searchTerm = ' ';
-            figures.forEach(figure => {
-                const caption = figure.querySelector('figcaption');
-                if (!caption) {
-                    figure.style.display = 'inline-block';
-                } else if (caption.innerText.toLowerCase().includes(searchTerm)) {
-                    figure.style.display = 'inline-block';
-                } else {
-                    figure.style.display = 'none';
-                }
-            });
+            const q = (event.target.value || '').trim();
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(() => { if (q != query) resetGallery(q); }, 200);
         }
-
+        const search = document.getElementById('search');
+        search.addEventListener('keyup', searchGallery, true);
+        search.addEventListener('search', searchGallery, true);
+        search.addEventListener('click', (e) => e.target.select(), true);
+    </script><script>
+        // Search for saved galleries, from memesearch.js. The live page searches on the server.
+        {{ memesearch|safe }}
         function init() {
-             let search = document.getElementById('search');
-             search.addEventListener('keyup', filterFigures, true);
-             search.addEventListener('click', (e) => {
-                 e.target.select();
-                 filterFigures(e);
-             }, true);
+            if (window.liveGallery) return;
             // Draw waveforms for any audio canvases
             document.querySelectorAll('canvas.waveform[data-src]').forEach(c => drawWaveform(c));
-         }
- 
+        }
+
         const AudioCtx = window.AudioContext || window.webkitAudioContext;
         let audioCtx = null;
         async function drawWaveform(canvas) {
@@ -467,9 +759,319 @@ def gallery():
         }
          init();
      </script>
-    ''', images=image_files, figures=figures_collection, models=models
-    , model_tags=model_tags, audios=audio_files, videos=video_files
-)
+    '''
+_gallery_template = None
+_page_cache = {}
+
+def gallery_template():
+    """Module: gallery_template: the compiled gallery page template"""
+    global _gallery_template
+    if _gallery_template is None:
+        # Saved galleries search with memesearch.js, inlined
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'memesearch.js'),
+                  encoding='utf-8') as f:
+            app.jinja_env.globals['memesearch'] = f.read()
+        _gallery_template = app.jinja_env.from_string(GALLERY_TEMPLATE)
+    return _gallery_template
+
+def page_version(known):
+    """Module: page_version: ETag for the models and their tags, the only
+    things the page itself shows"""
+    key = json.dumps([known["models"], known["model_tags"]])
+    return hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
+
+@app.route('/')
+def gallery():
+    """Module: gallery: Generate the portfolio builder page
+    
+    :inputs: None
+    :outputs: None"""
+    # Scan now, so new files get captions and thumbnails started.
+    # Figures themselves are fetched by the page from /api/items.
+    media_catalog()
+    open_store(IMAGE_FOLDER).sync()
+    known = model_discovery().snapshot()
+    etag = page_version(known)
+    # The ETag and body are stored together, so a request racing a new
+    # rendering never pairs one's ETag with the other's body
+    cached = _page_cache.get('page')
+    if cached is None or cached[0] != etag:
+        cached = (etag, gallery_template().render(models=known["models"],
+                                                  model_tags=known["model_tags"]))
+        _page_cache['page'] = cached
+    response = Response(cached[1], mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+KIND_ORDER = {'image': 0, 'audio': 1, 'video': 2}
+MAX_PAGE = 500
+_views = OrderedDict()
+
+def search_index(catalog=None, store=None):
+    """Module: search_index: the caption search index for IMAGE_FOLDER,
+    caught up with any new files and caption changes"""
+    index = open_index(IMAGE_FOLDER)
+    index.refresh(catalog or media_catalog(), store or open_store(IMAGE_FOLDER))
+    return index
+
+def embed_texts(texts):
+    """Module: embed_texts: embeddings of texts from EMBED_MODEL"""
+    if EMBED_MODEL == 'stub':
+        return stub_embed(texts)
+    with local_pool().client(EMBED_MODEL) as client:
+        response = client.embeddings.create(model=EMBED_MODEL, input=texts)
+    return [item.embedding for item in response.data]
+
+def caption_vectors(catalog=None, store=None):
+    """Module: caption_vectors: caption embeddings for IMAGE_FOLDER; new and
+    changed captions are embedded in the background"""
+    store = store or open_store(IMAGE_FOLDER)
+    index = open_vectors(store.db_path, embed_texts, EMBED_MODEL)
+    index.refresh(catalog or media_catalog(), store)
+    return index
+
+def similar_images(catalog=None):
+    """Module: similar_images: perceptual hashes of the images in
+    IMAGE_FOLDER; new and changed images are hashed in the background"""
+    index = open_similar(open_store(IMAGE_FOLDER),
+                         cache_path(IMAGE_FOLDER, thumbs.THUMB_DIR))
+    index.refresh(catalog or media_catalog())
+    return index
+
+def similar_of(filename):
+    """Copies of filename close enough to share its caption, closest first,
+    once hashing has caught up"""
+    index = similar_images()
+    index.wait()
+    return [name for name, _ in index.similar(filename, similar.COPY_RADIUS) or []]
+
+def media_facets(catalog=None, store=None):
+    """Module: media_facets: facet columns of the media in IMAGE_FOLDER,
+    caught up with any new files and caption changes"""
+    index = open_facets(store or open_store(IMAGE_FOLDER))
+    index.refresh(catalog or media_catalog())
+    return index
+
+def facet_filters(args):
+    """Module: facet_filters: facet filters from query parameters
+    :param args: request.args or a dict, with captioned=yes|no, model=name
+        (repeat for several) and min_<facet>/max_<facet> for facets.RANGES
+    :returns: hashable filters for item_view
+    :raises ValueError: for a value that is not a number or date"""
+    filters = []
+    ranges = tuple((facet, (facets.parse_bound(facet, args[f'min_{facet}'])
+                            if args.get(f'min_{facet}') else None,
+                            facets.parse_bound(facet, args[f'max_{facet}'])
+                            if args.get(f'max_{facet}') else None))
+                   for facet in facets.RANGES
+                   if args.get(f'min_{facet}') or args.get(f'max_{facet}'))
+    if ranges:
+        filters.append(('ranges', ranges))
+    if args.get('captioned'):
+        filters.append(('captioned', args['captioned'].lower() in ('yes', 'true', '1')))
+    models = args.getlist('model') if hasattr(args, 'getlist') else args.get('model')
+    if models:
+        filters.append(('models', tuple([models] if isinstance(models, str) else models)))
+    return tuple(filters)
+
+def item_view(catalog, store, sort, types, q, filters=()):
+    """Module: item_view: sorted (key, filename) sequence, cached per revision
+    :param filters: facet filters, as from facet_filters"""
+    index = media_facets(catalog, store)
+    key = (catalog.folder, index.version, store.revision if q else None,
+           sort, types, q, filters)
+    view = _views.get(key)
+    if view is None:
+        found = None
+        if q:
+            # Every word, as typed, as a prefix, or with a typo
+            found = [name for name, _ in search_index(catalog, store).search(q)]
+        view = index.select(types, sort, names=found, **dict(filters))
+        _views[key] = view
+        while len(_views) > 16:
+            _views.popitem(last=False)
+    return view
+
+def page_items(catalog, store, page):
+    """Items for a page of (key, filename), with their captions and facets"""
+    captions = store.get_many([name for _, name in page])
+    entries = catalog.entries
+    index = open_facets(store)
+    return [dict(index.facets(name) or {}, name=name, type=entries[name].kind,
+                 caption=captions.get(name))
+            for _, name in page if name in entries]
+
+@app.route('/api/items')
+def api_items():
+    """Module: api_items: one page of media items, with captions
+    :param cursor: opaque position returned as "next" by the previous page
+    :param limit: items per page, at most 500
+    :param sort: type, name, date, size, taken, width, height, pixels,
+        duration, captioned or model
+    :param order: asc or desc
+    :param type: comma-separated media types, e.g. image,video
+    :param q: only items matching every word of q, as in /api/search
+    :param captioned: yes or no
+    :param model: only items captioned by this model (repeat for several)
+    :param min_<facet>, max_<facet>: bounds on size, date, taken, width,
+        height, pixels or duration; dates may be ISO, e.g. 2024-05-01
+    :param name: just these files, in this order (repeat for each); no paging
+    :returns: {"items": [{"name", "type", "caption", "width", ...}], "next", "total"}"""
+    sort = request.args.get('sort', 'type')
+    if sort not in facets.SORTS:
+        abort(400)
+    try:
+        filters = facet_filters(request.args)
+    except ValueError:
+        abort(400)
+    desc = request.args.get('order', 'asc') == 'desc'
+    limit = max(1, min(request.args.get('limit', 200, type=int), MAX_PAGE))
+    types = tuple(sorted(set(request.args.get('type', 'image,audio,video').split(','))
+                         & set(KIND_ORDER)))
+    q = request.args.get('q', '').strip()
+    catalog = media_catalog()
+    store = open_store(IMAGE_FOLDER)
+    index = media_facets(catalog, store)
+    # Pages only change with the folder, the captions or the facets read
+    etag = hashlib.blake2b(json.dumps(
+        [os.path.abspath(catalog.folder), catalog.revision, store.revision,
+         index.version, request.query_string.decode()]).encode(),
+        digest_size=12).hexdigest()
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    names = request.args.getlist('name')
+    if names:
+        page = [(None, name) for name in names[:MAX_PAGE] if name in catalog.entries]
+        response = jsonify({"items": page_items(catalog, store, page),
+                            "total": len(page), "next": None})
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
+    view = item_view(catalog, store, sort, types, q, filters)
+    try:
+        after = (decode_cursor(request.args['cursor'], sort)
+                 if request.args.get('cursor') else None)
+    except ValueError:
+        abort(400)
+    # Cursors are positions in the sort order, so pages stay consistent
+    # as files come and go.
+    if desc:
+        end = len(view) if after is None else bisect.bisect_left(view, after)
+        page = view[max(0, end - limit):end][::-1]
+        more = end - limit > 0
+    else:
+        start = 0 if after is None else bisect.bisect_right(view, after)
+        page = view[start:start + limit]
+        more = start + limit < len(view)
+    response = jsonify({"items": page_items(catalog, store, page), "total": len(view),
+                        "next": encode_cursor(page[-1]) if page and more else None})
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/search')
+def api_search():
+    """Module: api_search: ranked search of captions, XMP keywords and filenames
+    Every word must match, as typed, as the start of a longer word, or
+    with a typo. The best matches (by BM25) come first.
+    With mode=semantic, captions closest in meaning come first instead,
+    up to SEMANTIC_RESULTS; this needs EMBED_MODEL.
+    :param q: words to search for
+    :param mode: words (default) or semantic
+    :param type: comma-separated media types, e.g. image,video
+    :param limit: filenames per page, at most 500
+    :param cursor: opaque position returned as "next" by the previous page
+    :returns: {"ids": [filename], "total", "next"}"""
+    q = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', 200, type=int), MAX_PAGE))
+    types = set(request.args.get('type', 'image,audio,video').split(','))
+    try:
+        start = decode_cursor(request.args['cursor'])[0] if request.args.get('cursor') else 0
+    except ValueError:
+        abort(400)
+    semantic = request.args.get('mode') == 'semantic'
+    if semantic and not EMBED_MODEL:
+        return jsonify({"error": "Semantic search needs EMBED_MODEL"}), 400
+    catalog = media_catalog()
+    index = caption_vectors(catalog) if semantic else search_index(catalog)
+    etag = hashlib.blake2b(json.dumps(
+        [os.path.abspath(catalog.folder), index.version,
+         request.query_string.decode()]).encode(), digest_size=12).hexdigest()
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    try:
+        results = index.search(q, SEMANTIC_RESULTS) if semantic else index.search(q)
+    except Exception as e:
+        print(f"Could not embed the query with {EMBED_MODEL}: {e}")
+        return jsonify({"error": str(e)}), 503
+    entries = catalog.entries
+    ranked = [name for name, _ in results
+              if name in entries and entries[name].kind in types]
+    page = ranked[start:start + limit]
+    more = start + limit < len(ranked)
+    response = jsonify({"ids": page, "total": len(ranked),
+                        "next": encode_cursor([start + limit]) if more else None})
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/search/export', methods=['POST'])
+def api_search_export():
+    """Module: api_search_export: prebuilt search index for a saved gallery
+    :param items: [filename, caption] pairs, in page order
+    :returns: JSON for <script type="application/json" id="search-index">"""
+    items = (request.get_json(silent=True) or {}).get('items') or []
+    return Response(export_index((str(name), caption) for name, caption in items),
+                    mimetype='application/json')
+
+def similar_radius():
+    """?distance=, within what multi-index hashing handles quickly"""
+    return max(0, min(request.args.get('distance', similar.RADIUS, type=int), 40))
+
+@app.route('/api/similar/<filename>')
+def api_similar(filename):
+    """Module: api_similar: images that look like one, closest first
+    :param distance: most differing bits (of 128), default RADIUS
+    :returns: {"items": [{"name", "distance", "caption"}], "hashed"};
+        hashed is false while the image waits to be hashed"""
+    catalog = media_catalog()
+    entry = catalog.entries.get(filename)
+    if entry is None or entry.kind != 'image':
+        abort(404)
+    index = similar_images(catalog)
+    found = index.similar(filename, similar_radius())
+    captions = open_store(IMAGE_FOLDER).get_many([name for name, _ in found or []])
+    return jsonify({"items": [{"name": name, "distance": d, "caption": captions.get(name)}
+                              for name, d in found or []],
+                    "hashed": found is not None})
+
+@app.route('/api/duplicates')
+def api_duplicates():
+    """Module: api_duplicates: groups of near-duplicate images
+    :param distance: most differing bits (of 128), default RADIUS
+    :returns: {"groups": [[filename]], largest first, "images", "pending"}"""
+    index = similar_images()
+    groups = index.clusters(similar_radius())
+    return jsonify(dict(index.stats(), groups=groups))
+
+@app.route('/api/models')
+def api_models():
+    """Module: api_models: discovered models and tags, for the dropdown"""
+    return jsonify(model_discovery().snapshot())
+
+@app.route('/caption/<filename>', methods=['POST'])
+def save_caption(filename):
+    """Module: save_caption: store a caption edited on the page"""
+    if filename not in media_catalog().entries:
+        abort(404)
+    caption = request.get_json(silent=True) or {}
+    open_store(IMAGE_FOLDER).set(filename, caption.get("caption", ""))
+    return jsonify({"ok": True})
 
 @app.route('/model/<ai>')
 def model_switch(ai):
@@ -478,67 +1080,186 @@ def model_switch(ai):
     print("AI model switched to " + app.model)
     return ai
 
-@app.route('/describe/<filename>')
-def describe_image(filename):
-    """Module: describe_image: generate image descriptions
-    :param filename: name of image file to analyze
-    :returns: image description JSON"""
-    print(f"Generating caption with {app.model} model")
-    if app.model == 'lorem':
-        return jsonify({"description":
-"Lorem ipsum dolor sit amet, consectetur adipiscing elit. Sed non risus. "+
-"Suspendisse lectus tortor, dignissim sit amet, adipiscing nec, ultricies sed, "+
-"dolor."})
+LOREM = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit. Sed non risus. "
+         "Suspendisse lectus tortor, dignissim sit amet, adipiscing nec, ultricies sed, "
+         "dolor.")
+
+class CaptionError(Exception):
+    """The model gave no caption, or cannot caption this kind of file"""
+
+def caption_backend(model):
+    """Module: caption_backend: which worker pool serves a model
+    :returns: 'lorem', 'gemini', 'local', 'openai', or None"""
+    if model == 'lorem':
+        return 'lorem'
+    if GEMINI_API_KEY and model.lower() == 'gemini':
+        return 'gemini'
+    if model in model_discovery().models:
+        return 'local'
+    if model.lower() == 'openai' and gpt_key:
+        return 'openai'
+    return None
+
+# Models behind the 'gemini' and 'openai' dropdown entries
+GEMINI_MODEL = "gemini-1.5-flash"
+OPENAI_MODEL = "gpt-3.5-turbo"
+
+def caption_params(backend, model, kind):
+    """Module: caption_params: model id and preprocessing for the result cache"""
+    if backend == 'gemini':
+        return GEMINI_MODEL, {"upload": "original"}
+    if backend == 'openai':
+        return OPENAI_MODEL, {"upload": "original"}
+    if kind == 'video':
+        return model, video.params()
+    if kind == 'audio' and audio.AVAILABLE:
+        return model, {"audio": audio.RATE, "chunk": audio.MAX_CHUNK, "merge": audio.MERGE}
+    return model, {"audio": "original"} if kind == 'audio' else preprocess.params()
+
+STOP = ["<|im_end|>", "###"]
+
+def local_completion(model, messages, on_text=None):
+    """Module: local_completion: ask the least-loaded local server
+    :param on_text: called with the text so far as tokens arrive;
+        without it the reply comes back in one piece
+    :returns: the reply text"""
+    if on_text is None:
+        response = local_pool().create(model, messages=messages, stream=False, stop=STOP)
+        return response.choices[0].message.content
+    text = ''
+    for piece in local_pool().stream(model, messages=messages, stop=STOP):
+        text += piece
+        on_text(text)
+    return text
+
+def audio_completion(model, audio_base64, audio_format, prompt, on_text=None):
+    """Module: audio_completion: ask the local model about a sound clip"""
+    return local_completion(
+        model, [
+            {"role": "user", "content": [
+                {
+                    "type": "input_audio",
+                    "input_audio": {
+                        "data": audio_base64,
+                        "format": audio_format
+                    }
+                },
+                {"type": "text", "text": prompt}
+            ]}
+        ], on_text)
 
+def describe_audio(model, file_path, prompt, on_text=None):
+    """Module: describe_audio: caption a recording of any length
+    Chunks are captioned up to AUDIO_WORKERS at a time, but no more than
+    this job's share of the endpoints' slots for the model, then
+    summarized into one caption (AUDIO_MERGE=timestamps lists them). Only
+    the summary is streamed to on_text."""
+    def describe(wav):
+        return audio_completion(model, base64.b64encode(wav).decode('utf-8'), 'wav', prompt)
+
+    def summarize(text):
+        return local_completion(
+            model, [{"role": "user", "content":
+                "These describe consecutive parts of one recording:\n" + text +
+                "\n\nDescribe the whole recording in 10-50 words."}], on_text)
+
+    # This job's worker waits meanwhile, so its slot goes to the chunks.
+    # Any of the queue's workers may be running an audio job too, so the
+    # slots beyond theirs are split evenly, and together the chunks never
+    # ask for more than the endpoints have.
+    workers = max(1, caption_jobs().workers.get('local', 1))
+    spare = max(0, local_pool().slots(model) - workers)
+    return audio.caption_audio(file_path, describe, summarize,
+                               workers=min(audio.WORKERS, 1 + spare // workers))
+
+def describe_video(model, filename, prompt, on_text=None):
+    """Module: describe_video: caption a video from its keyframes
+    The frames go to the model in one request, with their times."""
+    cache_dir = cache_path(IMAGE_FOLDER, thumbs.THUMB_DIR)
+    try:
+        frames = video.keyframes(os.path.join(IMAGE_FOLDER, filename),
+                                 open_store(IMAGE_FOLDER).file_hash(filename), cache_dir)
+    except (OSError, ValueError) as e:
+        if not video.FFMPEG:
+            raise CaptionError("Video captions need ffmpeg") from e
+        raise
+    content = [{"type": "image_url", "image_url": {"url": preprocess.data_url(data, 'JPEG')}}
+               for _, data in frames]
+    content.append({"type": "text", "text": video.frame_prompt(frames, prompt)})
+    return local_completion(model, [{"role": "user", "content": content}], on_text)
+
+def generate_caption(filename, model, force=False, on_text=None):
+    """Module: generate_caption: describe one media file with a model
+    Results are cached by content hash, model, prompt and preprocessing.
+    :param filename: name of image or audio file to analyze
+    :param model: model name, as chosen from the dropdown
+    :param force: ask the model again even if a result is cached
+    :param on_text: called with the text so far while the model writes
+    :returns: description text"""
+    backend = caption_backend(model)
+    if backend == 'lorem':
+        return LOREM
+    if backend is None:
+        raise CaptionError("no response")
+    kind = media_kind(filename) or 'image'
+    prompt = f"Describe this {kind} in 10-50 words."
+    model_id, params = caption_params(backend, model, kind)
+    digest = open_store(IMAGE_FOLDER).file_hash(filename)
+    key = result_cache().key(digest, model_id, prompt, params)
+    if not force:
+        cached = result_cache().get(key)
+        if cached is not None:
+            return cached
+    description = infer_caption(backend, model, filename, kind, prompt, on_text)
+    if description:
+        result_cache().put(key, description, digest, model_id)
+    return description
+
+def infer_caption(backend, model, filename, kind, prompt, on_text=None):
+    """Module: infer_caption: ask a backend to describe one media file
+    :param backend: 'gemini', 'local' or 'openai'
+    :param model: model name, as chosen from the dropdown
+    :param filename: name of image or audio file to analyze
+    :param kind: 'image', 'audio' or 'video'
+    :param prompt: instructions for the model
+    :param on_text: called with the text so far as tokens arrive (Gemini
+        and local models)
+    :returns: description text"""
+    print(f"Generating caption with {model} model")
     file_path = os.path.join(IMAGE_FOLDER, filename)
-    is_audio = filename.lower().endswith(('.mp3', '.wav', '.ogg', '.m4a'))
-    prompt = "Describe this audio in 10-50 words." if is_audio else "Describe this image in 10-50 words."
 
-    if GEMINI_API_KEY and app.model.lower() == 'gemini':
-        # temporarily uploads the file (image or audio) to google
-        myfile = genai.upload_file(file_path)
-        model = genai.GenerativeModel("gemini-1.5-flash")
+    if backend == 'gemini':
+        # Uploads the file (image or audio) to google, unless a recent
+        # upload of the same bytes is still there
+        digest = open_store(IMAGE_FOLDER).file_hash(filename)
         try:
-            response = model.generate_content(
-                [myfile, "\n\n", prompt]
-            )
-            return jsonify({"description": f"{response.text}"})
+            return gemini_files().generate(GEMINI_MODEL, file_path, prompt,
+                                           digest, on_text)
         except ValueError as ve:
-            return jsonify({"description": f"{ve}"})
-    elif app.model in models:
-        # For audio files, encode raw bytes into input_audio content (base64 + format).
+            raise CaptionError(f"{ve}") from ve
+    elif backend == 'local':
+        is_audio = kind == 'audio'
+        if kind == 'video':
+            # A few keyframes, captioned together
+            return describe_video(model, filename, prompt, on_text)
+        if is_audio and audio.AVAILABLE:
+            # Decoded to 16 kHz mono and captioned in chunks
+            return describe_audio(model, file_path, prompt, on_text)
+        # Otherwise encode raw bytes into input_audio content (base64 + format).
         if is_audio:
             with open(file_path, "rb") as f:
                 audio_bytes = f.read()
             audio_base64 = base64.b64encode(audio_bytes).decode('utf-8')
             audio_format = filename.rsplit('.', 1)[1].lower()
-            response = lclient.chat.completions.create(
-                model=app.model,
-                messages=[
-                    {"role": "user", "content": [
-                        {
-                            "type": "input_audio",
-                            "input_audio": {
-                                "data": audio_base64,
-                                "format": audio_format
-                            }
-                        },
-                        {"type": "text", "text": prompt}
-                    ]}
-                ], stream=False,
-                stop=["<|im_end|>", "###"]
-            )
-            return jsonify({"description": response.choices[0].message.content})
+            return audio_completion(model, audio_base64, audio_format, prompt, on_text)
         else:
-            # Image path: keep previous behavior
-            image = Image.open(file_path).resize((250, 250))
-            buffered = io.BytesIO()
-            image.save(buffered, format="PNG")
-            image_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            image_url = f"data:image/png;base64,{image_base64}"
-            response = lclient.chat.completions.create(
-                model=app.model,
-                messages=[
+            # Shrunk and encoded once per file, then cached
+            image_url = preprocess.image_url(
+                file_path, open_store(IMAGE_FOLDER).file_hash(filename),
+                cache_path(IMAGE_FOLDER, thumbs.THUMB_DIR))
+            return local_completion(
+                model,
+                [
                    {"role": "user", "content": [
                             {
                                 "type": "image_url",
@@ -546,22 +1267,19 @@ def describe_image(filename):
                             },
                             {"type": "text", "text": prompt},
                         ]}
-                ], stream=False,
-                stop=["<|im_end|>", "###"]
-            )
-            return jsonify({"description": response.choices[0].message.content})
-    elif app.model.lower() == 'openai' and gpt_key:
-        client = OpenAI()
-        if is_audio:
-            # OpenAI chat/file handling for audio is not implemented here
-            return jsonify({"description": "OpenAI audio analysis is not supported by this gallery interface."})
+                ], on_text)
+    elif backend == 'openai':
+        client = backends.client(None, gpt_key, pool=caption_jobs().workers.get('openai', 4))
+        if kind != 'image':
+            # OpenAI chat/file handling for audio and video is not implemented here
+            raise CaptionError(f"OpenAI {kind} analysis is not supported by this gallery interface.")
         # Upload the image to OpenAI
         with open(file_path, "rb") as image:
             file_response = client.files.create(file=image, purpose='vision')
         file_id = file_response.id
         # Generate caption with GPT-3.5-Turbo
         response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
+            model=OPENAI_MODEL,
             messages=[
                 {
                     "role": "user",
@@ -569,14 +1287,194 @@ def describe_image(filename):
                 }
             ]
         )
-        return jsonify({"description": response.choices[0].message.content})
-    return jsonify({"description": "no response"})
+        return response.choices[0].message.content
+    raise CaptionError("no response")
+
+def run_caption_job(job):
+    """Caption a file in a worker thread and save the result
+    Followers see the caption grow as the model writes it."""
+    description = generate_caption(job.filename, job.model, job.options.get('force', False),
+                                   on_text=lambda text: job.update(text=text))
+    if description and job.backend != 'lorem':
+        open_store(IMAGE_FOLDER).set(job.filename, description, source='ai', model=job.model)
+    return description
+
+
+def submit_caption(filename, model=None, force=False):
+    """Module: submit_caption: queue a caption job for filename
+    :param force: bypass the result cache
+    :returns: Job, or None if no backend serves the model"""
+    model = model or app.model
+    backend = caption_backend(model)
+    if backend is None:
+        return None
+    return caption_jobs().submit(filename, model, backend, force=force)
+
+@app.route('/api/describe/<filename>', methods=['POST'])
+def api_describe(filename):
+    """Module: api_describe: queue a caption job and return its id at once"""
+    if not os.path.isfile(os.path.join(IMAGE_FOLDER, filename)):
+        abort(404)
+    options = request.get_json(silent=True) or {}
+    job = submit_caption(filename, options.get("model"), bool(options.get("force")))
+    if job is None:
+        return jsonify({"status": "error", "description": "no response",
+                        "error": "no response"}), 400
+    return jsonify(job.to_dict()), 202
+
+@app.route('/api/jobs')
+def api_jobs():
+    """Module: api_jobs: pool sizes, queued/running jobs per backend,
+    result cache counters, connection/retry counts per endpoint, health
+    and load of the local endpoints, Gemini uploads, and caption embeddings"""
+    return jsonify(dict(caption_jobs().stats(), cache=result_cache().stats(),
+                        backends=backends.stats(), endpoints=local_pool().stats(),
+                        gemini=gemini_files().stats(),
+                        embeddings=open_vectors(open_store(IMAGE_FOLDER).db_path, embed_texts,
+                                                EMBED_MODEL).stats() if EMBED_MODEL else None))
+
+@app.route('/api/jobs/<job_id>')
+def api_job(job_id):
+    """Module: api_job: job status; ?wait=seconds waits for a change"""
+    job = caption_jobs().get(job_id) or abort(404)
+    wait = min(request.args.get('wait', 0, type=float), 60)
+    if wait > 0 and not job.done:
+        job.wait(timeout=wait)
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<job_id>/events')
+def api_job_events(job_id):
+    """Module: api_job_events: follow a job as Server-Sent Events
+    While the model writes, status events carry the new text as delta,
+    to go after the first offset characters."""
+    job = caption_jobs().get(job_id) or abort(404)
+    return Response(job.events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/describe/<filename>')
+def describe_image(filename):
+    """Module: describe_image: generate image descriptions
+    Kept for scripts; queues a job like /api/describe and waits for it.
+    :param filename: name of image file to analyze
+    :param force: ?force=1 bypasses the result cache
+    :returns: image description JSON"""
+    job = submit_caption(filename, force=request.args.get('force') == '1')
+    if job is None:
+        return jsonify({"description": "no response"})
+    while not job.done:
+        job.wait(timeout=60)
+    return jsonify({"description": job.description})
+
+def caption_kinds(model):
+    """Module: caption_kinds: media types a model can caption
+    Matches the AI buttons the page shows for the model."""
+    tags = model_discovery().model_tags.get(model)
+    kinds = set()
+    if tags is None or {'image', 'any', 'video'} & set(tags):
+        kinds.add('image')
+    if model == 'lorem' or (tags and {'audio', 'any'} & set(tags)):
+        kinds.add('audio')
+    if tags and {'video', 'any'} & set(tags):
+        kinds.add('video')
+    return kinds
+
+def backend_slots(backend, model):
+    """Module: backend_slots: how many captions a backend can make at once
+    llama.cpp reports its parallel slots (-np) as total_slots in /props;
+    local slots are added up over the endpoints hosting the model."""
+    if backend == 'local':
+        return local_pool().slots(model)
+    return caption_jobs().workers.get(backend, 2)
+
+def bulk_slots(backend, model):
+    """Grow the backend's pool to its slots, so a bulk run can fill them"""
+    slots = backend_slots(backend, model)
+    if slots > caption_jobs().workers.get(backend, 0):
+        caption_jobs().resize(backend, slots)
+    return slots
+
+_bulk = {}
+
+def bulk_captioner():
+    """Module: bulk_captioner: the BulkCaptioner for IMAGE_FOLDER"""
+    key = os.path.abspath(IMAGE_FOLDER)
+    if key not in _bulk:
+        _bulk[key] = BulkCaptioner(open_store(IMAGE_FOLDER), caption_jobs(),
+                                   caption_backend, bulk_slots, similar_of)
+    return _bulk[key]
+
+@app.route('/api/bulk', methods=['POST'])
+def api_bulk_start():
+    """Module: api_bulk_start: caption every uncaptioned file on the server
+    :param model: model to use, default the selected one
+    :param type: comma-separated media types, as in /api/items
+    :param q: only files matching every word of q, as in /api/search
+    :param copy_similar: copy captions to copies of an image (within
+        similar.COPY_RADIUS) instead of captioning them, default COPY_SIMILAR
+    :returns: the run's progress; the active run if one is going"""
+    options = request.get_json(silent=True) or {}
+    model = options.get('model') or app.model
+    if caption_backend(model) is None:
+        return jsonify({"status": "error", "error": f"model {model} is not available"}), 400
+    types = tuple(sorted(set(options.get('type', 'image,audio,video').split(','))
+                         & set(KIND_ORDER) & caption_kinds(model)))
+    q = options.get('q', '').strip()
+    catalog = media_catalog()
+    view = item_view(catalog, open_store(IMAGE_FOLDER), 'type', types, q)
+    copy = bool(options.get('copy_similar', COPY_SIMILAR))
+    if copy:
+        similar_images(catalog)
+    run = bulk_captioner().start([name for _, name in view], model,
+                                 {"type": ",".join(types), "q": q, "copy_similar": copy})
+    return jsonify(run.to_dict()), 202
+
+@app.route('/api/bulk')
+def api_bulk():
+    """Module: api_bulk: progress of the latest bulk run, or null"""
+    run = bulk_captioner().get()
+    return jsonify(run.to_dict() if run else None)
+
+@app.route('/api/bulk/<run_id>/events')
+def api_bulk_events(run_id):
+    """Module: api_bulk_events: follow a bulk run as Server-Sent Events
+    Each event has the counts and the captions made since the last one."""
+    run = bulk_captioner().get(run_id) or abort(404)
+    return Response(run.events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/bulk/<run_id>/cancel', methods=['POST'])
+def api_bulk_cancel(run_id):
+    """Module: api_bulk_cancel: stop a bulk run"""
+    run = bulk_captioner().cancel(run_id) or abort(404)
+    return jsonify(run.to_dict())
 
 @app.route('/images/<filename>')
 def image_file(filename):
     """Module: image_file: Retrieve local image from flask"""
     return send_from_directory(IMAGE_FOLDER, filename)
 
+@app.route('/thumbs/<int:size>/<filename>')
+def thumb_file(size, filename):
+    """Module: thumb_file: serve a cached 320px or 640px thumbnail"""
+    if size not in thumbs.SIZES:
+        abort(404)
+    if filename.lower().endswith(thumbs.PASSTHROUGH):
+        return send_from_directory(IMAGE_FOLDER, filename)
+    src = os.path.join(IMAGE_FOLDER, filename)
+    try:
+        digest = open_store(IMAGE_FOLDER).file_hash(filename)
+    except OSError:
+        abort(404)
+    try:
+        path = thumbs.get_thumb(cache_path(IMAGE_FOLDER, thumbs.THUMB_DIR), src, digest, size)
+    except thumbs.ERRORS as e:
+        # Let the browser try the original
+        print(f"Thumbnail error for {filename}: {e}")
+        return send_from_directory(IMAGE_FOLDER, filename)
+    # Content-addressed, so the strong ETag never goes stale
+    return send_file(path, mimetype=thumbs.MIMETYPE, etag=f"{digest}-{size}",
+                     conditional=True, max_age=86400)
+
 @app.route('/media/<filename>')
 def media_file(filename):
     """Serve audio/media files from the gallery folder"""
@@ -587,7 +1485,47 @@ def favicon():
     """Serve a browser add-favorites icon from the app directory"""
     return send_from_directory(app.root_path, 'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
+def bench(counts=(100, 1000, 10000, 50000), rounds=20):
+    """Module: bench: page render time vs. item count
+    Compares compiling the template on every hit, rendering the compiled
+    template, serving the cached page, and answering a conditional
+    request, plus the first /api/items page. Uses empty files and skips
+    caption and thumbnail work."""
+    global IMAGE_FOLDER
+    from flask import render_template_string
+    client = app.test_client()
+    known = model_discovery().snapshot()
+    print(f"{'items':>7} {'compile+render':>15} {'render':>9} {'cached':>9} "
+          f"{'304':>9} {'items cold':>11} {'warm':>9}  (ms)")
+    for count in counts:
+        with tempfile.TemporaryDirectory() as folder:
+            for i in range(count):
+                open(os.path.join(folder, f"img{i:06d}.jpg"), 'wb').close()
+            IMAGE_FOLDER = folder
+            open_scanner(folder).scan()
+            def timed(fn):
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    fn()
+                return (time.perf_counter() - start) / rounds * 1e3
+            with app.test_request_context():
+                gallery_template()
+                uncompiled = timed(lambda: render_template_string(
+                    GALLERY_TEMPLATE, models=known["models"], model_tags=known["model_tags"]))
+                compiled = timed(lambda: gallery_template().render(
+                    models=known["models"], model_tags=known["model_tags"]))
+            etag = client.get('/').headers['ETag']
+            cached = timed(lambda: client.get('/'))
+            not_modified = timed(lambda: client.get('/', headers={'If-None-Match': etag}))
+            cold = timed(lambda: (_views.clear(), client.get('/api/items')))
+            warm = timed(lambda: client.get('/api/items'))
+        print(f"{count:>7} {uncompiled:>15.3f} {compiled:>9.3f} {cached:>9.3f} "
+              f"{not_modified:>9.3f} {cold:>11.3f} {warm:>9.3f}")
+
 if __name__ == '__main__':
+    if '--bench' in sys.argv:
+        bench()
+        sys.exit(0)
     HOST = "http://localhost"
     PORT = 9165
     print(f"Starting server on {HOST}:{PORT}")
@@ -602,5 +1540,10 @@ if __name__ == '__main__':
     else:
         IMAGE_FOLDER = '.'
     print(f"Image folder is {IMAGE_FOLDER}")
+    # Finish bulk captioning that a restart interrupted. With debug=True,
+    # only the reloader's child process serves requests.
+    if is_running_from_reloader():
+        model_discovery()
+        bulk_captioner().resume()
 #    webbrowser.open(f"{host}:{port}")
     app.run(debug=True, port=PORT)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""Module: audio
+Description: Long recordings, captioned in pieces.
+
+Audio is decoded as a stream and downmixed to 16 kHz mono, with ffmpeg
+when it is installed, else with soundfile (pip install soundfile). It is
+cut into chunks of at most MAX_CHUNK seconds, preferably in a pause,
+found with NumPy by the energy of 30 ms frames. Silent chunks are
+dropped. Chunks are captioned a few at a time while decoding continues,
+and the captions are merged into one description, or listed with their
+times. Only the chunks in flight are held in memory, so a 90-minute
+recording needs no more memory than a 90-second one."""
+import io
+import os
+import sys
+import time
+import wave
+import shutil
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    import soundfile as sf
+    SOUNDFILE_AVAILABLE = True
+except (ImportError, OSError):
+    SOUNDFILE_AVAILABLE = False
+
+FFMPEG = shutil.which('ffmpeg')
+AVAILABLE = bool(FFMPEG) or SOUNDFILE_AVAILABLE
+RATE = 16000
+# Chunk lengths in seconds; cut in the first pause after MIN_CHUNK
+MIN_CHUNK = 15
+MAX_CHUNK = 30
+MIN_SILENCE = 0.4
+FRAME = 0.03
+SILENCE_DB = -40
+# 'summary' asks the model to combine chunk captions into one;
+# 'timestamps' lists them as [m:ss-m:ss] caption
+MERGE = os.environ.get('AUDIO_MERGE', 'summary')
+WORKERS = int(os.environ.get('AUDIO_WORKERS', 2))
+
+class Resampler:
+    """Module: Resampler: linear interpolation that carries across blocks"""
+    def __init__(self, src, dst):
+        self.step = src / dst
+        self.t = 0.0
+        self.last = None
+
+    def __call__(self, x):
+        buf = x if self.last is None else np.concatenate(([self.last], x))
+        n = len(buf)
+        if n < 2:
+            self.last = buf[-1] if n else self.last
+            return np.zeros(0, np.float32)
+        positions = np.arange(self.t, n - 1, self.step)
+        out = np.interp(positions, np.arange(n), buf).astype(np.float32)
+        self.t = (positions[-1] + self.step if len(positions) else self.t) - (n - 1)
+        self.last = buf[-1]
+        return out
+
+def _ffmpeg_blocks(path, rate, block):
+    proc = subprocess.Popen([FFMPEG, '-nostdin', '-v', 'error', '-i', path, '-vn',
+                             '-f', 's16le', '-ac', '1', '-ar', str(rate), '-'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        rest = b''
+        while data := proc.stdout.read(block * 2):
+            data = rest + data
+            whole = len(data) // 2 * 2
+            rest = data[whole:]
+            yield np.frombuffer(data[:whole], '<i2').astype(np.float32) / 32768
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        error = proc.stderr.read().decode(errors='replace').strip()
+        proc.stderr.close()
+        if proc.wait() not in (0, -9) and error:
+            print(f"ffmpeg: {error}")
+
+def _soundfile_blocks(path, rate, block):
+    info = sf.info(path)
+    resample = Resampler(info.samplerate, rate) if info.samplerate != rate else None
+    size = max(1, int(block * info.samplerate / rate))
+    for data in sf.blocks(path, blocksize=size, dtype='float32', always_2d=True):
+        mono = data.mean(axis=1) if data.shape[1] > 1 else data[:, 0]
+        yield resample(mono) if resample else mono
+
+def decode(path, rate=RATE, block=RATE):
+    """Module: decode: stream a file as mono float32 blocks
+    :param path: audio (or video) file
+    :param rate: output sample rate
+    :param block: samples per block, about
+    :returns: generator of numpy arrays"""
+    if FFMPEG:
+        return _ffmpeg_blocks(path, rate, block)
+    if SOUNDFILE_AVAILABLE:
+        return _soundfile_blocks(path, rate, block)
+    raise RuntimeError("Decoding audio needs ffmpeg or soundfile")
+
+def frame_levels(samples, rate=RATE):
+    """RMS level in dBFS of each 30 ms frame"""
+    frame = int(rate * FRAME)
+    n = len(samples) // frame
+    if not n:
+        return np.zeros(0)
+    frames = samples[:n * frame].reshape(n, frame)
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-9))
+
+def find_cut(samples, start, rate=RATE):
+    """First pause after sample start, as the sample in its middle, or None"""
+    frame = int(rate * FRAME)
+    first = start // frame
+    quiet = frame_levels(samples, rate)[first:] < SILENCE_DB
+    need = max(1, int(MIN_SILENCE / FRAME))
+    if len(quiet) < need:
+        return None
+    # Runs of quiet frames long enough to be a pause
+    runs = np.convolve(quiet, np.ones(need, int), 'valid') == need
+    hits = np.flatnonzero(runs)
+    if not len(hits):
+        return None
+    return (first + hits[0] + need // 2) * frame
+
+def split(blocks, rate=RATE, min_chunk=MIN_CHUNK, max_chunk=MAX_CHUNK):
+    """Module: split: cut a stream of blocks into chunks at pauses
+    :returns: generator of (start seconds, samples); silent chunks are skipped"""
+    low, high = int(min_chunk * rate), int(max_chunk * rate)
+    buf, offset = np.zeros(0, np.float32), 0
+    for block in blocks:
+        buf = np.concatenate((buf, block))
+        while len(buf) >= low:
+            cut = find_cut(buf[:high], low, rate)
+            if cut is None:
+                if len(buf) < high:
+                    break
+                cut = high
+            chunk, buf = buf[:cut], buf[cut:]
+            levels = frame_levels(chunk, rate)
+            if len(levels) and levels.max() >= SILENCE_DB:
+                yield offset / rate, chunk
+            offset += cut
+    levels = frame_levels(buf, rate)
+    if len(levels) and levels.max() >= SILENCE_DB:
+        yield offset / rate, buf
+
+def to_wav(samples, rate=RATE):
+    """Module: to_wav: 16-bit mono WAV bytes"""
+    pcm = (np.clip(samples, -1, 1) * 32767).astype('<i2')
+    buffered = io.BytesIO()
+    with wave.open(buffered, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(pcm.tobytes())
+    return buffered.getvalue()
+
+def clock(seconds):
+    """m:ss, or h:mm:ss for long recordings"""
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02}:{s:02}" if h else f"{m}:{s:02}"
+
+def timestamped(parts):
+    """Module: timestamped: chunk captions as [m:ss-m:ss] lines"""
+    return "\n".join(f"[{clock(start)}-{clock(end)}] {text.strip()}"
+                     for start, end, text in parts)
+
+def caption_audio(path, describe, summarize=None, workers=None, merge=None):
+    """Module: caption_audio: caption a recording chunk by chunk
+    :param path: audio file
+    :param describe: describe(wav_bytes) -> caption of one chunk
+    :param summarize: summarize(timestamped captions) -> one caption
+    :param workers: chunks captioned at a time, default WORKERS
+    :param merge: 'summary' or 'timestamps', default MERGE
+    :returns: description text"""
+    workers, merge = workers or WORKERS, merge or MERGE
+    parts, futures = [], []
+    free = threading.Semaphore(workers)
+    failed = threading.Event()
+
+    def run(wav):
+        try:
+            return describe(wav)
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            free.release()
+
+    chunks = split(decode(path))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for start, samples in chunks:
+                # Decode no further ahead than the workers can keep up with
+                free.acquire()
+                if failed.is_set():
+                    break
+                end = start + len(samples) / RATE
+                futures.append((start, end, pool.submit(run, to_wav(samples))))
+            for start, end, future in futures:
+                parts.append((start, end, future.result() or ''))
+        except BaseException:
+            # One failed chunk fails the caption; do not wait for the rest
+            for *_, future in futures:
+                future.cancel()
+            raise
+        finally:
+            chunks.close()
+    if not parts:
+        return "Silence."
+    if len(parts) == 1:
+        return parts[0][2]
+    text = timestamped(parts)
+    if merge == 'summary' and summarize:
+        try:
+            return summarize(text)
+        except Exception as e:
+            print(f"Could not merge audio captions: {e}")
+    return text
+
+if __name__ == "__main__":
+    # Show the chunks a recording would be cut into
+    if len(sys.argv) != 2:
+        print("Usage: python audio.py <audio file>")
+        sys.exit(1)
+    start = time.perf_counter()
+    for begin, samples in split(decode(sys.argv[1])):
+        print(f"{clock(begin)} {len(samples) / RATE:5.1f} s "
+              f"peak {frame_levels(samples).max():.0f} dB")
+    print(f"{time.perf_counter() - start:.2f} s, with "
+          f"{'ffmpeg' if FFMPEG else 'soundfile' if SOUNDFILE_AVAILABLE else 'nothing'}")
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""Module: backends
+Description: Shared, pooled clients for OpenAI-compatible model servers.
+
+One OpenAI client is kept per endpoint, key and pool size, over an httpx
+connection pool that keeps connections alive between requests. Replies
+of 429 (too many requests) and 503 (busy or loading a model) are retried
+with jittered exponential backoff, honoring Retry-After. Requests, new
+connections, reused connections and retries are counted per endpoint.
+
+Several local servers can share the work: BackendPool health-checks a
+list of endpoints (LOCAL_ENDPOINTS, comma separated) in the background,
+merges the models they host, and sends each request to the least-loaded
+healthy endpoint hosting the requested model, failing over to the next
+one when a server cannot be reached. Used by album_create and aichat;
+tests/stubs.py tries it against a few local stub servers."""
+import os
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from urllib.request import urlopen
+import httpx
+import openai
+from openai import OpenAI
+
+RETRY_STATUS = (429, 503)
+RETRIES = 4
+BACKOFF = 0.5
+MAX_DELAY = 20
+# Seconds between health checks of pooled endpoints
+HEALTH_INTERVAL = 15
+# Requests an endpoint is assumed to run at once until /props says
+DEFAULT_SLOTS = 2
+# Local models can take minutes to answer. Requests wait as long as it
+# takes for a free connection; the pool size bounds concurrency.
+TIMEOUT = httpx.Timeout(300, connect=5, pool=None)
+
+class EndpointStats:
+    """Module: EndpointStats: request and connection counters"""
+    def __init__(self):
+        self.requests = self.connections = self.retries = self.errors = 0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def to_dict(self):
+        return {"requests": self.requests, "connections": self.connections,
+                "reused": max(0, self.requests - self.connections),
+                "retries": self.retries, "errors": self.errors}
+
+class RetryTransport(httpx.BaseTransport):
+    """Module: RetryTransport: pooled transport that retries 429 and 503
+    :param stats: EndpointStats to count into
+    :param pool: most connections, all kept alive"""
+    def __init__(self, stats, pool=4, retries=RETRIES, backoff=BACKOFF):
+        self.stats = stats
+        self.retries = retries
+        self.backoff = backoff
+        self.transport = httpx.HTTPTransport(limits=httpx.Limits(
+            max_connections=pool, max_keepalive_connections=pool))
+
+    def _trace(self, event, info):
+        # httpcore reports each new TCP connection
+        if event == "connection.connect_tcp.complete":
+            self.stats.add(connections=1)
+
+    def delay(self, response, attempt):
+        """Seconds to wait: Retry-After if given, else jittered backoff"""
+        try:
+            return min(float(response.headers["retry-after"]), MAX_DELAY)
+        except (KeyError, ValueError):
+            return min(self.backoff * 2 ** attempt, MAX_DELAY) * random.uniform(0.5, 1.5)
+
+    def handle_request(self, request):
+        request.extensions = dict(request.extensions, trace=self._trace)
+        for attempt in range(self.retries + 1):
+            self.stats.add(requests=1)
+            try:
+                response = self.transport.handle_request(request)
+            except httpx.TransportError:
+                self.stats.add(errors=1)
+                raise
+            if response.status_code not in RETRY_STATUS or attempt == self.retries:
+                return response
+            wait = self.delay(response, attempt)
+            # Read the short error body so the connection can be reused
+            response.read()
+            response.close()
+            self.stats.add(retries=1)
+            time.sleep(wait)
+        return response
+
+    def close(self):
+        self.transport.close()
+
+_clients = {}
+_stats = {}
+_lock = threading.Lock()
+
+def endpoint_stats(base_url):
+    """Counters for one endpoint, created on first use"""
+    with _lock:
+        return _stats.setdefault(base_url, EndpointStats())
+
+def client(base_url=None, api_key=None, pool=4):
+    """Module: client: the shared OpenAI client for an endpoint
+    :param base_url: server URL, e.g. http://localhost:8087/v1; None for OpenAI
+    :param api_key: API key
+    :param pool: connections to keep; match the number of workers using it
+    :returns: OpenAI client"""
+    url = base_url or "https://api.openai.com/v1"
+    key = (url, api_key, pool)
+    with _lock:
+        if key in _clients:
+            return _clients[key]
+    transport = RetryTransport(endpoint_stats(url), pool)
+    # Retries are ours, so the SDK's are turned off
+    new = OpenAI(base_url=url, api_key=api_key, max_retries=0,
+                 http_client=httpx.Client(transport=transport, timeout=TIMEOUT))
+    with _lock:
+        return _clients.setdefault(key, new)
+
+def stats():
+    """Module: stats: counters for every endpoint used so far"""
+    with _lock:
+        return {url: s.to_dict() for url, s in _stats.items()}
+
+def endpoints(default):
+    """Module: endpoints: local server URLs, from LOCAL_ENDPOINTS or default
+    e.g. LOCAL_ENDPOINTS=http://gpu1:8087/v1,http://gpu2:8087/v1"""
+    urls = [u.strip().rstrip('/') for u in os.environ.get('LOCAL_ENDPOINTS', '').split(',')]
+    return [u for u in urls if u] or [default]
+
+class NoEndpoint(openai.APIConnectionError):
+    """No healthy endpoint hosts the model"""
+    def __init__(self, message):
+        super().__init__(message=message, request=httpx.Request("POST", "http://pool"))
+
+class Endpoint:
+    """Module: Endpoint: one server in a BackendPool, with its health,
+    models, parallel slots per model and requests in flight"""
+    def __init__(self, url, api_key, pool=DEFAULT_SLOTS):
+        self.url = url
+        self.api_key = api_key
+        self.pool = pool
+        self.models = set()
+        # None until the first health check
+        self.healthy = None
+        self.error = None
+        self.checked = 0
+        self.slots = {}
+        # The health check each model's slots were last read at
+        self._slots_read = {}
+        self.inflight = 0
+        self.served = 0
+
+    def client(self):
+        """Pooled client with a connection for each slot"""
+        return client(self.url, self.api_key,
+                      max([self.pool, *self.slots.values()]) + 1)
+
+    def capacity(self, model):
+        return self.slots.get(model) or self.pool
+
+    def load(self, model):
+        """Share of the endpoint's slots for model in use"""
+        return self.inflight / self.capacity(model)
+
+    def fetch_slots(self, model):
+        """Parallel slots (llama-server -np) from /props, as total_slots,
+        read at most once per health check"""
+        if self.checked and self._slots_read.get(model) == self.checked:
+            return self.capacity(model)
+        self._slots_read[model] = self.checked
+        url = self.url.rsplit('/v1', 1)[0] + '/props?' + urlencode({'model': model})
+        try:
+            with urlopen(url, timeout=5) as response:
+                slots = json.load(response).get('total_slots')
+            if slots:
+                self.slots[model] = int(slots)
+        except (OSError, ValueError) as e:
+            print(f"Could not read parallel slots of {model} at {self.url}: {e}")
+        return self.capacity(model)
+
+    def to_dict(self):
+        return {"url": self.url, "healthy": self.healthy, "error": self.error,
+                "models": sorted(self.models), "slots": dict(self.slots),
+                "inflight": self.inflight, "served": self.served,
+                "checked": self.checked}
+
+class BackendPool:
+    """Module: BackendPool: least-loaded routing over several servers
+    :param urls: endpoint URLs, e.g. from endpoints()
+    :param api_key: API key, the same for all
+    :param pool: requests each endpoint runs at once, until /props says
+    :param interval: seconds between health checks
+    :param on_change: called when the merged list of models changes"""
+    def __init__(self, urls, api_key, pool=DEFAULT_SLOTS, interval=HEALTH_INTERVAL,
+                 on_change=None):
+        self.endpoints = [Endpoint(url, api_key, pool) for url in urls]
+        self.interval = interval
+        self.on_change = on_change
+        self._merged = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def check(self, endpoint):
+        """Health-check one endpoint by listing its models"""
+        try:
+            ids = [m.id for m in endpoint.client().with_options(timeout=5).models.list()]
+        except Exception as e:
+            if endpoint.healthy is not False:
+                print(f"Endpoint {endpoint.url} is down: {e}")
+            with self._lock:
+                endpoint.healthy, endpoint.error = False, str(e)
+        else:
+            if endpoint.healthy is False:
+                print(f"Endpoint {endpoint.url} is back")
+            with self._lock:
+                endpoint.healthy, endpoint.error = True, None
+                endpoint.models = set(ids)
+        endpoint.checked = time.time()
+        return endpoint.healthy
+
+    def check_all(self):
+        """Check every endpoint at once; a dead one costs one timeout"""
+        with ThreadPoolExecutor(len(self.endpoints)) as pool:
+            list(pool.map(self.check, self.endpoints))
+        merged = self.models()
+        changed = merged != self._merged
+        self._merged = merged
+        if changed and self.on_change:
+            self.on_change()
+
+    def models(self):
+        """Models hosted by any healthy endpoint, in endpoint order"""
+        merged = []
+        with self._lock:
+            for endpoint in self.endpoints:
+                if endpoint.healthy:
+                    merged += sorted(endpoint.models - set(merged))
+        return merged
+
+    def list_models(self):
+        """Module: list_models: check all endpoints, then merge their models
+        :raises ConnectionError: when every endpoint is down"""
+        self.check_all()
+        if not any(e.healthy for e in self.endpoints):
+            if len(self.endpoints) == 1:
+                raise ConnectionError(self.endpoints[0].error)
+            raise ConnectionError("; ".join(f"{e.url}: {e.error}" for e in self.endpoints))
+        return self.models()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.check_all()
+
+    def start(self):
+        """Start the health-check thread, once"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name="endpoint-health")
+            self._thread.start()
+        return self
+
+    @contextmanager
+    def client(self, model, exclude=()):
+        """Module: client: the least-loaded endpoint's client, held for the
+        duration of the with block (including streamed responses)
+        :raises NoEndpoint: when no healthy endpoint hosts model"""
+        with self._lock:
+            found = [e for e in self.endpoints
+                     if e.healthy and model in e.models and e not in exclude]
+            if not found:
+                found = [e for e in self.endpoints if e.healthy is None and e not in exclude]
+            if not found:
+                raise NoEndpoint(f"No healthy endpoint serves {model}")
+            endpoint = min(found, key=lambda e: (e.load(model), e.served))
+            endpoint.inflight += 1
+            endpoint.served += 1
+        try:
+            yield endpoint.client()
+        except openai.APITimeoutError:
+            raise
+        except openai.APIConnectionError as e:
+            # Unreachable; route around it until the next health check
+            with self._lock:
+                endpoint.healthy, endpoint.error = False, str(e)
+            self._wake.set()
+            e.endpoint = endpoint
+            raise
+        finally:
+            with self._lock:
+                endpoint.inflight -= 1
+
+    def create(self, model, **kwargs):
+        """Module: create: chat completion on the least-loaded endpoint,
+        retried on the next one if a server cannot be reached"""
+        tried = []
+        while True:
+            try:
+                with self.client(model, tried) as c:
+                    return c.chat.completions.create(model=model, **kwargs)
+            except NoEndpoint:
+                if tried:
+                    raise NoEndpoint(f"No endpoint serving {model} could be reached")
+                raise
+            except openai.APITimeoutError:
+                raise
+            except openai.APIConnectionError as e:
+                tried.append(e.endpoint)
+
+    def stream(self, model, **kwargs):
+        """Module: stream: streamed chat completion on the least-loaded
+        endpoint, failing over while no text has arrived yet
+        :returns: generator of text pieces"""
+        tried = []
+        while True:
+            started = False
+            try:
+                with self.client(model, tried) as c:
+                    for chunk in c.chat.completions.create(model=model, stream=True, **kwargs):
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            started = True
+                            yield chunk.choices[0].delta.content
+                return
+            except NoEndpoint:
+                if tried:
+                    raise NoEndpoint(f"No endpoint serving {model} could be reached")
+                raise
+            except openai.APITimeoutError:
+                raise
+            except openai.APIConnectionError as e:
+                if started:
+                    raise
+                tried.append(e.endpoint)
+
+    def slots(self, model):
+        """Module: slots: parallel slots for model across healthy endpoints"""
+        found = [e for e in self.endpoints if e.healthy and model in e.models]
+        return sum(e.fetch_slots(model) for e in found) or DEFAULT_SLOTS
+
+    def stats(self):
+        """Health, models and load of each endpoint"""
+        with self._lock:
+            return [e.to_dict() for e in self.endpoints]
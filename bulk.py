@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""Module: bulk
+Description: Server-side "AI Caption All".
+
+A bulk run captions every file in a folder, or in a filtered subset, that
+does not have a caption yet. It keeps as many jobs in flight as the
+backend has parallel slots, records each result as it arrives, and can
+be followed as Server-Sent Events. Progress is kept in the caption
+database, so a run that was interrupted by a restart picks up where it
+left off. Stopping a run cancels the jobs that have not started.
+
+With copy_similar, a file that is a near-duplicate of one with a caption
+gets that caption instead of a model call. Files whose near-duplicates
+are being captioned wait for them."""
+import json
+import time
+import uuid
+import threading
+from jobs import Tracked
+from captions import is_blank
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bulk_runs (
+    id TEXT PRIMARY KEY,
+    model TEXT,
+    filters TEXT,
+    status TEXT,
+    created REAL,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS bulk_items (
+    run TEXT,
+    filename TEXT,
+    status TEXT,
+    PRIMARY KEY (run, filename)
+);
+"""
+# How long a resumed run waits for its model to be discovered
+BACKEND_WAIT = 120
+
+class BulkRun(Tracked):
+    """Module: BulkRun: progress of one bulk captioning run"""
+    def __init__(self, run_id, model, filters, pending, counts=None):
+        super().__init__()
+        self.id = run_id
+        self.model = model
+        self.filters = filters
+        self.pending = pending
+        counts = counts or {}
+        self.captioned = counts.get('done', 0)
+        self.failed = counts.get('error', 0)
+        self.skipped = counts.get('skipped', 0)
+        self.copied = counts.get('copied', 0)
+        self.total = (len(pending) + self.captioned + self.failed + self.skipped
+                      + self.copied)
+        self.status = "running"
+        self.slots = 0
+        self.error = None
+        self.cancelled = threading.Event()
+        self.jobs = set()
+        self.items = []
+
+    def record(self, filename, status, description=None):
+        """Count one finished file and keep it for event streams"""
+        with self._cond:
+            if status == 'done':
+                self.captioned += 1
+            elif status == 'error':
+                self.failed += 1
+            elif status == 'skipped':
+                self.skipped += 1
+            elif status == 'copied':
+                self.copied += 1
+            self.items.append([filename, status, description])
+            self.version += 1
+            self._cond.notify_all()
+
+    def to_dict(self, seen=None):
+        """Progress counts, plus the files finished since the last call
+        with the same seen dict"""
+        with self._cond:
+            start = seen.get('items', 0) if seen is not None else len(self.items)
+            items = self.items[start:]
+            if seen is not None:
+                seen['items'] = start + len(items)
+        return {"run": self.id, "model": self.model, "filters": self.filters,
+                "status": self.status, "total": self.total,
+                "captioned": self.captioned, "failed": self.failed,
+                "skipped": self.skipped, "copied": self.copied,
+                "slots": self.slots,
+                "error": self.error,
+                "items": [{"filename": f, "status": s, "description": d}
+                          for f, s, d in items]}
+
+class BulkCaptioner:
+    """Module: BulkCaptioner: runs and resumes bulk captioning for a folder
+    :param store: CaptionStore of the folder; also holds run progress
+    :param queue: JobQueue that does the captioning
+    :param backend_of: model -> backend name, or None if unavailable
+    :param slots_of: (backend, model) -> number of jobs to keep in flight
+    :param similar_of: filename -> near-duplicates, closest first, for
+        copy_similar runs"""
+    def __init__(self, store, queue, backend_of, slots_of, similar_of=None):
+        self.store = store
+        self.queue = queue
+        self.backend_of = backend_of
+        self.slots_of = slots_of
+        self.similar_of = similar_of
+        self.runs = {}
+        self.active = None
+        self._lock = threading.Lock()
+        with self._lock, self.db:
+            self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        return self.store.db
+
+    def start(self, filenames, model, filters=None):
+        """Module: start: caption the files that have no caption yet
+        :param filenames: candidate files, in the order to caption them
+        :param model: model to caption with
+        :param filters: how the files were chosen, kept for display; with
+            copy_similar true, near-duplicates share captions
+        :returns: BulkRun; the active one if a run is already going"""
+        with self._lock:
+            if self.active and not self.active.done:
+                return self.active
+            captions = self.store.get_many(list(filenames))
+            pending = [f for f in filenames if is_blank(captions.get(f))]
+            run = BulkRun(uuid.uuid4().hex, model, filters or {}, pending)
+            now = time.time()
+            with self.db:
+                # Only unfinished runs need their items
+                self.db.execute("DELETE FROM bulk_items WHERE run IN "
+                                "(SELECT id FROM bulk_runs WHERE status != 'running')")
+                self.db.execute("DELETE FROM bulk_runs WHERE status != 'running'")
+                self.db.execute("INSERT INTO bulk_runs VALUES (?, ?, ?, 'running', ?, ?)",
+                                (run.id, model, json.dumps(run.filters), now, now))
+                self.db.executemany("INSERT INTO bulk_items VALUES (?, ?, 'pending')",
+                                    ((run.id, f) for f in pending))
+            self._launch(run)
+            return run
+
+    def resume(self):
+        """Module: resume: restart runs that were going at shutdown
+        :returns: list of resumed BulkRuns"""
+        resumed = []
+        with self._lock:
+            rows = self.db.execute("SELECT id, model, filters FROM bulk_runs "
+                                   "WHERE status='running' ORDER BY created").fetchall()
+            for run_id, model, filters in rows:
+                pending = [r[0] for r in self.db.execute(
+                    "SELECT filename FROM bulk_items WHERE run=? AND status='pending' "
+                    "ORDER BY rowid", (run_id,))]
+                counts = dict(self.db.execute(
+                    "SELECT status, COUNT(*) FROM bulk_items WHERE run=? GROUP BY status",
+                    (run_id,)).fetchall())
+                run = BulkRun(run_id, model, json.loads(filters), pending, counts)
+                if self.active and not self.active.done:
+                    # One run at a time; the others are dropped
+                    self._finish(run, "cancelled")
+                    continue
+                print(f"Resuming bulk captioning: {len(pending)} of {run.total} files left")
+                self._launch(run)
+                resumed.append(run)
+        return resumed
+
+    def cancel(self, run_id):
+        """Module: cancel: stop a run and cancel its queued jobs
+        :returns: the BulkRun, or None"""
+        run = self.runs.get(run_id)
+        if run is None or run.done:
+            return run
+        run.cancelled.set()
+        for job in list(run.jobs):
+            self.queue.cancel(job)
+        run.update()
+        return run
+
+    def get(self, run_id=None):
+        """A run by id, or the latest one"""
+        if run_id is None:
+            return self.active
+        return self.runs.get(run_id)
+
+    def _launch(self, run):
+        # Finished runs are only kept until the next one starts
+        self.runs = {run_id: old for run_id, old in self.runs.items() if not old.done}
+        self.runs[run.id] = run
+        self.active = run
+        threading.Thread(target=self._drive, args=(run,), daemon=True,
+                         name=f"bulk-{run.id[:8]}").start()
+
+    def _set_item(self, run, filename, status):
+        with self._lock, self.db:
+            self.db.execute("UPDATE bulk_items SET status=? WHERE run=? AND filename=?",
+                            (status, run.id, filename))
+            self.db.execute("UPDATE bulk_runs SET updated=? WHERE id=?",
+                            (time.time(), run.id))
+
+    def _finish(self, run, status, error=None):
+        with self.db:
+            self.db.execute("UPDATE bulk_runs SET status=?, updated=? WHERE id=?",
+                            (status, time.time(), run.id))
+        run.update(status=status, error=error)
+
+    def _wait_backend(self, run):
+        deadline = time.monotonic() + BACKEND_WAIT
+        while not run.cancelled.is_set():
+            backend = self.backend_of(run.model)
+            if backend or time.monotonic() > deadline:
+                return backend
+            run.cancelled.wait(2)
+        return None
+
+    def _drive(self, run):
+        """Keep up to slots jobs in flight until the run is finished"""
+        try:
+            backend = self._wait_backend(run)
+            if backend is None:
+                if run.cancelled.is_set():
+                    self._finish(run, "cancelled")
+                else:
+                    self._finish(run, "error", f"model {run.model} is not available")
+                return
+            slots = max(1, int(self.slots_of(backend, run.model)))
+            run.update(slots=slots)
+            free = threading.Semaphore(slots)
+            todo = run.pending
+            while todo and not run.cancelled.is_set():
+                later = []
+                for filename in todo:
+                    while not free.acquire(timeout=0.5):
+                        if run.cancelled.is_set():
+                            break
+                    else:
+                        if run.cancelled.is_set():
+                            free.release()
+                    if run.cancelled.is_set():
+                        break
+                    if not self._submit(run, filename, backend, free, later):
+                        free.release()
+                # Wait for the jobs in flight
+                for _ in range(slots):
+                    free.acquire()
+                for _ in range(slots):
+                    free.release()
+                todo = later
+            self._finish(run, "cancelled" if run.cancelled.is_set() else "done")
+        except Exception as e:
+            print(f"Bulk captioning error: {e}")
+            self._finish(run, "error", str(e))
+
+    def _submit(self, run, filename, backend, free, later):
+        """Caption one file, unless it need not be
+        :returns: False if no job was submitted"""
+        # It may have been captioned by hand since the run started
+        if not is_blank(self.store.get(filename)):
+            self._set_item(run, filename, 'skipped')
+            run.record(filename, 'skipped')
+            return False
+        similar = (self.similar_of(filename) or []
+                   if run.filters.get('copy_similar') and self.similar_of else [])
+        if similar:
+            details = self.store.get_details(similar)
+            for name in similar:
+                caption, _, model = details.get(name, (None, None, None))
+                if not is_blank(caption):
+                    # Keep the model, so the copy is filtered and shown like its source
+                    self.store.set(filename, caption, source='copy', model=model)
+                    self._set_item(run, filename, 'copied')
+                    run.record(filename, 'copied', caption)
+                    return False
+            # Wait for a near-duplicate being captioned, and copy its caption
+            busy = {job.filename for job in list(run.jobs) if not job.done}
+            if busy.intersection(similar):
+                later.append(filename)
+                return False
+        job = self.queue.submit(
+            filename, run.model, backend,
+            on_done=lambda job, run=run, free=free: self._job_done(run, job, free))
+        run.jobs.add(job)
+        return True
+
+    def _job_done(self, run, job, free):
+        try:
+            run.jobs.discard(job)
+            if job.status == 'cancelled':
+                # Left pending, in case the run is started again
+                return
+            self._set_item(run, job.filename, job.status)
+            run.record(job.filename, job.status, job.description)
+        finally:
+            free.release()
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+"""Module: captions
+Description: Persistent caption store for a gallery folder.
+
+Captions live in a small SQLite database, .findaimage.db, in the gallery
+folder, keyed by filename and content hash. It is populated once from
+index.html and XMP keywords, then kept up to date as files appear and
+captions are edited or generated, so page loads are indexed reads instead
+of an HTML parse. New files are hashed and imported in the background, so
+a first scan of a big folder does not hold up the page. Renamed or copied
+files keep their captions by hash.
+
+Model output is also cached by content hash, model and prompt in
+~/.cache/findaimage/results.db, so files are only captioned once by
+each model, whichever gallery they are in."""
+import os
+import sys
+import json
+import time
+import hashlib
+import itertools
+import sqlite3
+import threading
+from figs import parse_html
+from xmp import get_keywords_many
+
+STORE_FILE = '.findaimage.db'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'findaimage')
+# Model output shared by all galleries, keyed by file contents
+RESULTS_FILE = os.path.join(CACHE_DIR, 'results.db')
+MAX_RESULTS = 50000
+# New files hashed and imported at a time
+BATCH = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captions (
+    filename TEXT PRIMARY KEY,
+    hash TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    caption TEXT,
+    source TEXT,
+    model TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS captions_hash ON captions(hash);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def content_hash(path, block=1 << 20):
+    """Module: content_hash: hex digest of a file's bytes
+    :param path: file to hash
+    :returns: 32-character blake2b hex digest"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while chunk := f.read(block):
+            h.update(chunk)
+    return h.hexdigest()
+
+def is_blank(caption):
+    """Module: is_blank: True for a missing or placeholder caption"""
+    return (not caption or caption == 'None' or caption.startswith('Click')
+            or caption.startswith('Lorem'))
+
+def cache_path(folder, name):
+    """Module: cache_path: a writable cache directory for a gallery folder
+    :param folder: gallery folder
+    :param name: cache name, e.g. .thumbs
+    :returns: folder/name, or a directory under ~/.cache if folder is read-only"""
+    path = os.path.join(folder, name)
+    if not os.access(folder, os.W_OK):
+        key = hashlib.blake2b(os.path.abspath(folder).encode(), digest_size=8)
+        path = os.path.join(CACHE_DIR, key.hexdigest(), name.lstrip('.'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def connect(path):
+    """Module: connect: open a SQLite database for use by one thread"""
+    db = sqlite3.connect(path, timeout=30)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+def _stamp(st):
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+class CaptionStore:
+    """Module: CaptionStore: captions for one gallery folder
+    :param folder: gallery folder
+    :param db_path: database file, default .findaimage.db in folder"""
+    def __init__(self, folder, db_path=None):
+        self.folder = folder
+        # Next to the photos, or under ~/.cache if the folder is read-only
+        self.db_path = db_path or os.path.join(cache_path(folder, ''), STORE_FILE)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._worker = None
+        with self._lock, self.db:
+            self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        """One connection per thread"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = connect(self.db_path)
+        return db
+
+    def _meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+    def _bump(self):
+        self.db.execute("INSERT INTO meta VALUES ('revision', 1) ON CONFLICT(key) "
+                        "DO UPDATE SET value = value + 1")
+
+    @property
+    def revision(self):
+        """Increases every time a caption changes"""
+        return int(self._meta('revision', 0))
+
+    def sync(self, filenames=(), changed=(), removed=(), complete=False, on_added=None):
+        """Module: sync: bring the store up to date with the folder
+        Only file stats are compared here; new and edited files are hashed
+        and their captions imported in the background, BATCH at a time.
+        :param filenames: media files added to the folder
+        :param changed: media files whose contents changed
+        :param removed: media files no longer in the folder
+        :param complete: filenames lists every media file in the folder,
+            as after a restart, so rows for any others are removed too
+        :param on_added: called from the background with each batch of
+            filenames once they are stored
+        :returns: number of new files queued"""
+        index_path = os.path.join(self.folder, 'index.html')
+        with self._lock:
+            html = self._import_html(index_path)
+            known = {}
+            if filenames or changed or removed or complete:
+                known = {row[0]: row[1:] for row in self.db.execute(
+                    'SELECT filename, hash, size, mtime_ns, caption, source FROM captions')}
+            # Files edited while nobody watched look added; compare their stat
+            stale = [f for f in dict.fromkeys([*filenames, *changed])
+                     if self._differs(f, known.get(f))]
+            gone = set(removed)
+            if complete:
+                gone.update(set(known) - set(filenames))
+            for f in gone:
+                self._pending.pop(f, None)
+            gone = [f for f in gone if f in known]
+            self.db.executemany('DELETE FROM captions WHERE filename=?',
+                                [(f,) for f in gone])
+            if gone or html:
+                self._bump()
+                self.db.commit()
+            # The rows as they were, so an edit is told apart from a touch
+            now = time.time()
+            for f in stale:
+                self._pending[f] = (known.get(f), now, on_added)
+            self._start()
+        return sum(1 for f in stale if f not in known)
+
+    def _start(self):
+        if self._pending and (self._worker is None or not self._worker.is_alive()):
+            self._worker = threading.Thread(target=self._add_pending, daemon=True,
+                                            name="caption-import")
+            self._worker.start()
+
+    def _add_pending(self):
+        while True:
+            with self._lock:
+                batch = dict(itertools.islice(self._pending.items(), BATCH))
+                for name in batch:
+                    del self._pending[name]
+            if not batch:
+                return
+            try:
+                self._add({name: item[:2] for name, item in batch.items()})
+            except Exception as e:
+                print(f"Could not import captions: {e}")
+                continue
+            callbacks = {}
+            for name, (*_, on_added) in batch.items():
+                if on_added:
+                    callbacks.setdefault(on_added, []).append(name)
+            for on_added, names in callbacks.items():
+                try:
+                    on_added(names)
+                except Exception as e:
+                    print(f"Error after importing captions: {e}")
+
+    def wait(self, timeout=None):
+        """Wait for new files being imported"""
+        worker = self._worker
+        if worker is not None:
+            worker.join(timeout)
+
+    def _differs(self, filename, row):
+        """Whether a file is not in the store as it is on disk"""
+        # Rows made by file_hash alone have not been imported yet
+        if row is None or row[4] is None:
+            return True
+        try:
+            st = os.stat(os.path.join(self.folder, filename))
+        except OSError:
+            return False
+        return row[1:3] != (st.st_size, st.st_mtime_ns)
+
+    def _import_html(self, index_path):
+        """Import captions from index.html when it is new or has changed"""
+        try:
+            stamp = _stamp(os.stat(index_path))
+        except OSError:
+            return {}
+        if stamp == self._meta('index_html'):
+            return {}
+        figures = parse_html(index_path)
+        now = time.time()
+        with self.db:
+            for fname, caption in figures.items():
+                self.db.execute(
+                    "INSERT INTO captions (filename, caption, source, updated) "
+                    "VALUES (?, ?, 'html', ?) ON CONFLICT(filename) DO UPDATE SET "
+                    "caption=excluded.caption, source='html', updated=excluded.updated",
+                    (fname, caption, now))
+            self._set_meta('index_html', stamp)
+        return figures
+
+    def _add(self, known):
+        """Add new or edited files: reuse captions by hash, else read XMP in bulk
+        Files are hashed and XMP read without holding the lock; a caption
+        set since a file was queued is kept.
+        :param known: (row, time queued) by filename, where row is the stored
+            (hash, size, mtime_ns, caption, source) then, or None"""
+        rows, need_xmp, touched = [], [], []
+        for fname, (old, _) in known.items():
+            path = os.path.join(self.folder, fname)
+            try:
+                st = os.stat(path)
+                digest = self._stored_hash(fname, st) or content_hash(path)
+            except OSError as e:
+                print(f"Error: {e}")
+                continue
+            if old and old[0] == digest and old[4] is not None:
+                # Touched, not edited
+                touched.append((st.st_size, st.st_mtime_ns, fname))
+                continue
+            caption, source, model = None, None, None
+            if old and old[3] and old[4] in ('user', 'html'):
+                # Keep what a person wrote; model captions and keywords are redone
+                caption, source = old[3], old[4]
+            if caption is None:
+                row = self.db.execute(
+                    'SELECT caption, source, model FROM captions '
+                    'WHERE hash=? AND caption IS NOT NULL LIMIT 1', (digest,)).fetchone()
+                if row:
+                    caption, source, model = row
+                else:
+                    need_xmp.append(path)
+                    source = 'xmp'
+            rows.append([fname, digest, st.st_size, st.st_mtime_ns, caption,
+                         source, model, time.time()])
+        keywords = get_keywords_many(need_xmp) if need_xmp else {}
+        for row in rows:
+            if row[5] == 'xmp':
+                row[4] = keywords.get(os.path.join(self.folder, row[0]))
+        with self._lock, self.db:
+            names = [row[0] for row in rows]
+            edited = set()
+            for i in range(0, len(names), 500):
+                batch = names[i:i + 500]
+                edited.update(name for name, updated in self.db.execute(
+                    'SELECT filename, updated FROM captions WHERE source IS NOT NULL '
+                    f'AND filename IN ({",".join("?" * len(batch))})', batch)
+                    if updated > known[name][1])
+            # Removed while it was being hashed
+            rows = [row for row in rows
+                    if os.path.exists(os.path.join(self.folder, row[0]))]
+            self.db.executemany(
+                'INSERT OR REPLACE INTO captions VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [row for row in rows if row[0] not in edited])
+            self.db.executemany('UPDATE captions SET hash=?, size=?, mtime_ns=? '
+                                'WHERE filename=?',
+                                [(row[1], row[2], row[3], row[0])
+                                 for row in rows if row[0] in edited])
+            self.db.executemany('UPDATE captions SET size=?, mtime_ns=? WHERE filename=?',
+                                touched)
+            if rows or touched:
+                self._bump()
+
+    def _stored_hash(self, filename, st):
+        """The stored hash of a file, if its stat has not changed since"""
+        row = self.db.execute('SELECT hash, size, mtime_ns FROM captions WHERE filename=?',
+                              (filename,)).fetchone()
+        if row and row[0] and row[1:] == (st.st_size, st.st_mtime_ns):
+            return row[0]
+        return None
+
+    def file_hash(self, filename):
+        """Content hash of filename, recomputed only when its stat changes"""
+        path = os.path.join(self.folder, filename)
+        st = os.stat(path)
+        digest = self._stored_hash(filename, st)
+        if digest:
+            return digest
+        digest = content_hash(path)
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT INTO captions (filename, hash, size, mtime_ns, updated) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT(filename) DO UPDATE SET "
+                "hash=excluded.hash, size=excluded.size, mtime_ns=excluded.mtime_ns",
+                (filename, digest, st.st_size, st.st_mtime_ns, time.time()))
+        return digest
+
+    def get(self, filename):
+        """Caption for filename, or None"""
+        row = self.db.execute('SELECT caption FROM captions WHERE filename=?',
+                              (filename,)).fetchone()
+        return row[0] if row else None
+
+    def get_many(self, filenames):
+        """Non-empty captions for a list of filenames, as {filename: caption}"""
+        out = {}
+        for i in range(0, len(filenames), 500):
+            batch = filenames[i:i + 500]
+            out.update(self.db.execute(
+                'SELECT filename, caption FROM captions WHERE caption IS NOT NULL '
+                f'AND filename IN ({",".join("?" * len(batch))})', batch))
+        return out
+
+    def get_details(self, filenames):
+        """Captions with where they came from, as {filename: (caption, source, model)}"""
+        out = {}
+        for i in range(0, len(filenames), 500):
+            batch = filenames[i:i + 500]
+            out.update((row[0], row[1:]) for row in self.db.execute(
+                'SELECT filename, caption, source, model FROM captions '
+                f'WHERE filename IN ({",".join("?" * len(batch))})', batch))
+        return out
+
+    def all(self):
+        """All non-empty captions as {filename: caption}"""
+        return dict(self.db.execute(
+            'SELECT filename, caption FROM captions WHERE caption IS NOT NULL'))
+
+    def changed_since(self, when):
+        """Files whose captions changed at or after when, and the latest change
+        :returns: ([filename], timestamp)"""
+        rows = self.db.execute('SELECT filename, updated FROM captions WHERE updated >= ?',
+                               (when,)).fetchall()
+        return [row[0] for row in rows], max((row[1] for row in rows), default=when)
+
+    def set(self, filename, caption, source='user', model=None):
+        """Store a caption entered by the user or generated by a model"""
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT INTO captions (filename, caption, source, model, updated) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT(filename) DO UPDATE SET "
+                "caption=excluded.caption, source=excluded.source, "
+                "model=excluded.model, updated=excluded.updated",
+                (filename, caption, source, model, time.time()))
+            self._bump()
+
+RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    hash TEXT,
+    model TEXT,
+    caption TEXT,
+    created REAL,
+    used REAL
+);
+CREATE INDEX IF NOT EXISTS results_used ON results(used);
+"""
+
+class ResultCache:
+    """Module: ResultCache: model output for files the model has seen
+    Results are keyed by content hash, model, prompt and preprocessing
+    parameters, so asking again for the same thing is a lookup. The least
+    recently used results are dropped beyond max_entries.
+    :param path: database file, default ~/.cache/findaimage/results.db
+    :param max_entries: most results to keep"""
+    def __init__(self, path=None, max_entries=MAX_RESULTS):
+        self.path = path or RESULTS_FILE
+        self.max_entries = max_entries
+        self.hits = self.misses = self.evictions = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._lock, self.db:
+            self.db.executescript(RESULTS_SCHEMA)
+            self._count = self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    @property
+    def db(self):
+        """One connection per thread"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = connect(self.path)
+        return db
+
+    @staticmethod
+    def key(digest, model, prompt, params=None):
+        """Module: key: cache key for one captioning request
+        :param digest: content hash of the file
+        :param model: model id
+        :param prompt: prompt text
+        :param params: preprocessing parameters, e.g. {"size": [250, 250]}"""
+        blob = json.dumps([digest, model, prompt, params or {}], sort_keys=True)
+        return hashlib.blake2b(blob.encode(), digest_size=16).hexdigest()
+
+    def get(self, key):
+        """Cached caption for key, or None"""
+        row = self.db.execute('SELECT caption FROM results WHERE key=?', (key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.db:
+                self.db.execute('UPDATE results SET used=? WHERE key=?', (time.time(), key))
+        return row[0]
+
+    def put(self, key, caption, digest=None, model=None):
+        """Cache a caption, dropping the least recently used beyond max_entries"""
+        now = time.time()
+        with self._lock, self.db:
+            new = self.db.execute(
+                'INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                (key, digest, model, caption, now, now)).rowcount
+            if new:
+                self._count += 1
+            else:
+                self.db.execute('UPDATE results SET caption=?, used=? WHERE key=?',
+                                (caption, now, key))
+            excess = self._count - self.max_entries
+            if excess > 0:
+                self.db.execute('DELETE FROM results WHERE key IN '
+                                '(SELECT key FROM results ORDER BY used LIMIT ?)', (excess,))
+                self._count -= excess
+                self.evictions += excess
+
+    def stats(self):
+        """Hit/miss counters and size"""
+        lookups = self.hits + self.misses
+        return {"entries": self._count, "max_entries": self.max_entries,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions}
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def open_store(folder):
+    """Module: open_store: the shared CaptionStore for a folder"""
+    key = os.path.abspath(folder)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = CaptionStore(folder)
+        return _stores[key]
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python captions.py <gallery folder>")
+        sys.exit(1)
+    store = open_store(sys.argv[1])
+    for fname, caption in sorted(store.all().items()):
+        print(f"{fname}\t{caption}")
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Module: discovery
+Description: Discover image/audio/video models in the background.
+
+Router endpoints are polled from a daemon thread, so a slow or missing
+llama.cpp server never holds up the web page. Results are cached for ttl
+seconds, and failed attempts are retried sooner."""
+import time
+import threading
+from look_up_model import resolve_caps_many
+
+MEDIA_TAGS = ('image', 'audio', 'any', 'video')
+
+class ModelDiscovery:
+    """Module: ModelDiscovery: TTL-cached model/tag table
+    :param list_models: callable returning a list of model ids
+    :param ttl: seconds between successful refreshes
+    :param retry: seconds between failed attempts"""
+    def __init__(self, list_models, ttl=300, retry=10, name="backend"):
+        self.list_models = list_models
+        self.ttl = ttl
+        self.retry = retry
+        self.name = name
+        self.models = []
+        self.model_tags = {}
+        self.error = None
+        self.updated = 0
+        self.ready = threading.Event()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def refresh(self):
+        """Query the backend once and swap in the new table"""
+        try:
+            unfiltered = [m for m in self.list_models() if m != "default"]
+            caps = resolve_caps_many(unfiltered)
+        except Exception as e:
+            with self._lock:
+                self.error = str(e)
+            print(f"\nERROR retrieving models from {self.name}: {e}\n")
+            return False
+        models, model_tags = [], {}
+        for model, tags in caps.items():
+            # Keep models that support image/audio/any/video
+            if any(t in tags for t in MEDIA_TAGS):
+                models.append(model)
+                model_tags[model] = tags
+        with self._lock:
+            # Announce the first table, and any change to it
+            if models != self.models or not self.ready.is_set():
+                for model in models:
+                    print(f"{model_tags[model]} \t{model}")
+                if not models:
+                    print(f"\nNo image/audio/video models found at {self.name}\n")
+            self.models, self.model_tags = models, model_tags
+            self.error = None
+            self.updated = time.time()
+        self.ready.set()
+        return True
+
+    def _run(self):
+        while True:
+            ok = self.refresh()
+            self._wake.wait(self.ttl if ok else self.retry)
+            self._wake.clear()
+
+    def start(self):
+        """Start the refresher thread, once"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name="model-discovery")
+            self._thread.start()
+        return self
+
+    def poke(self):
+        """Refresh now instead of waiting out the TTL"""
+        self._wake.set()
+
+    def snapshot(self):
+        """Current table as a JSON-ready dict"""
+        with self._lock:
+            return {"models": list(self.models),
+                    "model_tags": dict(self.model_tags),
+                    "ready": self.ready.is_set(),
+                    "error": self.error,
+                    "updated": self.updated}
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+"""Module: facets
+Description: Columnar facets of a gallery's media, for filtering and sorting.
+
+Besides the type, size and modification time from the folder scan, each
+file has the date it was taken (EXIF DateTimeOriginal, or a video's
+creation time), its pixel size, the duration of audio and video (with
+ffprobe when it is installed, else soundfile), whether it has a caption,
+and the model that wrote it. They are kept in NumPy columns, one row per
+file, so any mix of filters and a sort over 100,000 files is a handful of
+vectorized operations. Metadata is read in the background as files
+appear, and kept in the caption store by content hash, so each file is
+read once."""
+import os
+import sys
+import json
+import base64
+import time
+import shutil
+import datetime
+import threading
+import subprocess
+import numpy as np
+from PIL import Image
+from captions import is_blank
+
+try:
+    import soundfile as sf
+    SOUNDFILE_AVAILABLE = True
+except (ImportError, OSError):
+    SOUNDFILE_AVAILABLE = False
+
+FFPROBE = shutil.which('ffprobe')
+KINDS = ('image', 'audio', 'video')
+# Files whose metadata is read at a time
+BATCH = 64
+# Captions edited this many seconds apart may commit out of order
+SKEW = 5
+# Facets that can be filtered by range, as min_<facet> and max_<facet>
+RANGES = ('size', 'date', 'taken', 'width', 'height', 'pixels', 'duration')
+SORTS = ('type', 'name', 'date', 'size', 'taken', 'width', 'height', 'pixels',
+         'duration', 'captioned', 'model')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media_facets (
+    hash TEXT PRIMARY KEY,
+    width INTEGER,
+    height INTEGER,
+    taken REAL,
+    duration REAL
+);
+"""
+
+# EXIF tags: DateTimeOriginal (in the Exif IFD), DateTime, Orientation
+_EXIF_IFD = 0x8769
+_TAKEN, _DATETIME, _ORIENTATION = 36867, 306, 274
+
+def _exif_time(text):
+    """Seconds since the epoch of an EXIF "YYYY:MM:DD HH:MM:SS", local time"""
+    try:
+        return time.mktime(time.strptime(str(text).strip()[:19], '%Y:%m:%d %H:%M:%S'))
+    except (ValueError, OverflowError):
+        return None
+
+def _iso_time(text):
+    try:
+        return datetime.datetime.fromisoformat(text.replace('Z', '+00:00')).timestamp()
+    except (ValueError, AttributeError):
+        return None
+
+def _image_metadata(path):
+    with Image.open(path) as img:
+        width, height = img.size
+        exif = img.getexif()
+        # Rotated a quarter turn when shown
+        if exif.get(_ORIENTATION) in (5, 6, 7, 8):
+            width, height = height, width
+        taken = exif.get_ifd(_EXIF_IFD).get(_TAKEN) or exif.get(_DATETIME)
+        return width, height, _exif_time(taken) if taken else None, None
+
+def _ffprobe_metadata(path):
+    result = subprocess.run([FFPROBE, '-v', 'error', '-print_format', 'json',
+                             '-show_format', '-show_streams', path],
+                            capture_output=True, timeout=60)
+    info = json.loads(result.stdout or b'{}')
+    fmt = info.get('format', {})
+    video = next((s for s in info.get('streams', []) if s.get('codec_type') == 'video'
+                  and not s.get('disposition', {}).get('attached_pic')), {})
+    duration = fmt.get('duration')
+    return (video.get('width'), video.get('height'),
+            _iso_time(fmt.get('tags', {}).get('creation_time')),
+            float(duration) if duration else None)
+
+def read_metadata(path, kind):
+    """Module: read_metadata: facets that need the file's contents
+    :returns: (width, height, taken, duration), None where unknown"""
+    try:
+        if kind == 'image':
+            return _image_metadata(path)
+        if FFPROBE:
+            return _ffprobe_metadata(path)
+        if kind == 'audio' and SOUNDFILE_AVAILABLE:
+            return None, None, None, sf.info(path).duration
+    except Exception as e:
+        print(f"Could not read metadata of {path}: {e}")
+    return None, None, None, None
+
+def parse_bound(facet, value):
+    """Module: parse_bound: a min_/max_ query value as a number
+    Dates may be given as YYYY-MM-DD[THH:MM:SS] or seconds since the epoch.
+    :raises ValueError: for values that are neither"""
+    try:
+        return float(value)
+    except ValueError:
+        if facet in ('date', 'taken'):
+            when = _iso_time(value)
+            if when is not None:
+                return when
+        raise
+
+class FacetIndex:
+    """Module: FacetIndex: media facets of one gallery folder, as columns
+    :param store: CaptionStore of the folder; metadata is kept in its database"""
+    COLUMNS = {'kind': np.int8, 'size': np.int64, 'date': np.int64,
+               'taken': np.float64, 'width': np.int32, 'height': np.int32,
+               'duration': np.float64, 'captioned': np.bool_, 'model': np.int32}
+
+    def __init__(self, store):
+        self.store = store
+        self.folder = store.folder
+        self.names = []
+        self.rows = {}
+        self.free = []
+        self.columns = {name: np.zeros(0, dtype) for name, dtype in self.COLUMNS.items()}
+        self.models = []
+        self._model_codes = {}
+        self.version = 0
+        self.catalog_revision = None
+        self.store_revision = None
+        self.updated = 0
+        # Rows in each sort order, made again after changes
+        self._orders = {}
+        self._names = None
+        self._pending = {}
+        self._worker = None
+        self._lock = threading.RLock()
+        with self.db:
+            self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        return self.store.db
+
+    def _row(self, name):
+        """Row of a file, made if it is new"""
+        row = self.rows.get(name)
+        if row is not None:
+            return row
+        row = self.free.pop() if self.free else len(self.names)
+        if row == len(self.names):
+            self.names.append(None)
+            if row >= len(self.columns['kind']):
+                capacity = max(1024, 2 * len(self.columns['kind']))
+                for key, column in self.columns.items():
+                    grown = np.zeros(capacity, column.dtype)
+                    grown[:len(column)] = column
+                    self.columns[key] = grown
+        self.names[row] = name
+        self.rows[name] = row
+        self._names = None
+        return row
+
+    def _model_code(self, model):
+        if not model:
+            return -1
+        code = self._model_codes.get(model)
+        if code is None:
+            code = self._model_codes[model] = len(self.models)
+            self.models.append(model)
+        return code
+
+    def refresh(self, catalog):
+        """Module: refresh: catch up with the folder and the caption store
+        Metadata of new and changed files is read in the background.
+        :param catalog: MediaScanner of the folder"""
+        with self._lock:
+            catalog_revision, store_revision = catalog.revision, self.store.revision
+            if (catalog_revision, store_revision) == (self.catalog_revision,
+                                                      self.store_revision):
+                return
+            c = self.columns
+            captions = set()
+            if catalog_revision != self.catalog_revision:
+                entries = catalog.entries
+                for name in [n for n in self.rows if n not in entries]:
+                    row = self.rows.pop(name)
+                    self.names[row] = None
+                    c['kind'][row] = -1
+                    self.free.append(row)
+                    self._pending.pop(name, None)
+                    self._names = None
+                for name, e in entries.items():
+                    row = self.rows.get(name)
+                    if row is not None and (c['size'][row], c['date'][row]) == (
+                            e.size, e.mtime_ns):
+                        continue
+                    new = row is None
+                    row = self._row(name)
+                    c['kind'][row] = KINDS.index(e.kind)
+                    c['size'][row], c['date'][row] = e.size, e.mtime_ns
+                    c['width'][row] = c['height'][row] = 0
+                    c['taken'][row] = c['duration'][row] = np.nan
+                    self._pending[name] = e.kind
+                    if new:
+                        captions.add(name)
+            if store_revision != self.store_revision:
+                changed, newest = self.store.changed_since(self.updated - SKEW)
+                captions.update(name for name in changed if name in self.rows)
+                self.updated = max(self.updated, newest)
+            details = self.store.get_details(sorted(captions))
+            for name in captions:
+                caption, _, model = details.get(name, (None, None, None))
+                row = self.rows[name]
+                c['captioned'][row] = not is_blank(caption)
+                c['model'][row] = self._model_code(model) if not is_blank(caption) else -1
+            self.catalog_revision, self.store_revision = catalog_revision, store_revision
+            self._changed()
+            if self._pending and (self._worker is None or not self._worker.is_alive()):
+                self._worker = threading.Thread(target=self._read_pending, daemon=True,
+                                                name="media-facets")
+                self._worker.start()
+
+    def _read_pending(self):
+        while True:
+            with self._lock:
+                batch = list(self._pending.items())[:BATCH]
+                for name, _ in batch:
+                    del self._pending[name]
+            if not batch:
+                return
+            try:
+                self._read(batch)
+            except Exception as e:
+                print(f"Could not read media metadata: {e}")
+
+    def _read(self, batch):
+        """Metadata from the store, or from the files"""
+        digests = {}
+        for name, _ in batch:
+            try:
+                digests[name] = self.store.file_hash(name)
+            except OSError:
+                pass
+        unique = sorted(set(digests.values()))
+        known = {}
+        for i in range(0, len(unique), 500):
+            part = unique[i:i + 500]
+            for digest, *values in self.db.execute(
+                    'SELECT hash, width, height, taken, duration FROM media_facets '
+                    f'WHERE hash IN ({",".join("?" * len(part))})', part):
+                known[digest] = values
+        new = {}
+        for name, kind in batch:
+            digest = digests.get(name)
+            if digest and digest not in known and digest not in new:
+                new[digest] = read_metadata(os.path.join(self.folder, name), kind)
+        if new:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO media_facets VALUES (?, ?, ?, ?, ?)',
+                                    ((d, *values) for d, values in new.items()))
+            known.update(new)
+        with self._lock:
+            c = self.columns
+            for name, digest in digests.items():
+                row = self.rows.get(name)
+                # Skip files that changed or went away meanwhile
+                if row is None or name in self._pending or digest not in known:
+                    continue
+                width, height, taken, duration = known[digest]
+                c['width'][row], c['height'][row] = width or 0, height or 0
+                c['taken'][row] = np.nan if taken is None else taken
+                c['duration'][row] = np.nan if duration is None else duration
+            self._changed()
+
+    def _changed(self):
+        self.version += 1
+        self._orders = {}
+
+    def order(self, sort):
+        """Module: order: every row in sort order, and its sort key
+        The filename breaks ties. Orders are kept until something changes,
+        so a query only has to pick out the rows that match.
+        :returns: (rows, keys)"""
+        if sort not in self._orders:
+            if self._names is None:
+                names = np.array([name or '' for name in self.names], dtype=str)
+                self._names = (np.array(self.names, dtype=object), names,
+                               np.argsort(names, kind='stable'))
+                self._orders = {}
+            _, names, by_name = self._names
+            if sort == 'name':
+                lower = np.char.lower(names)
+                rows = by_name[np.argsort(lower[by_name], kind='stable')]
+                keys = lower[rows]
+            else:
+                key = self.key(sort, len(names))
+                rows = by_name[np.argsort(key[by_name], kind='stable')]
+                keys = key[rows]
+            self._orders[sort] = rows, keys
+        return self._orders[sort]
+
+    def key(self, sort, n):
+        """Sort key of each row, as floats; unknown values sort last"""
+        c = {name: column[:n] for name, column in self.columns.items()}
+        if sort == 'model':
+            # By model name; uncaptioned last
+            order = np.argsort(np.argsort(np.array(self.models, dtype=object)))
+            key = np.append(order, np.inf)[c['model']]
+        else:
+            key = self.value(sort, n)
+        return np.where(np.isnan(key), np.inf, key)
+
+    def value(self, facet, n):
+        """A facet of each row as floats, NaN where unknown"""
+        c = self.columns
+        if facet == 'pixels':
+            value = c['width'][:n].astype(np.float64) * c['height'][:n]
+        elif facet == 'type':
+            value = c['kind'][:n].astype(np.float64)
+        else:
+            value = c[facet][:n].astype(np.float64)
+        if facet in ('width', 'height', 'pixels'):
+            value[value == 0] = np.nan
+        return value
+
+    def select(self, types=KINDS, sort='type', ranges=None, captioned=None,
+               models=None, names=None):
+        """Module: select: the files matching every filter, sorted
+        :param types: media types to include
+        :param sort: one of SORTS; the filename breaks ties
+        :param ranges: {facet: (low, high)}, either may be None; files whose
+            value is unknown do not match
+        :param captioned: True or False to keep only files with or without a caption
+        :param models: keep only files captioned by these models
+        :param names: keep only these files, e.g. search results
+        :returns: FacetView"""
+        with self._lock:
+            n = len(self.names)
+            c = {name: column[:n] for name, column in self.columns.items()}
+            keep = np.isin(c['kind'], [KINDS.index(t) for t in types if t in KINDS])
+            for facet, (low, high) in dict(ranges or ()).items():
+                value = self.value(facet, n)
+                if facet == 'date':
+                    # Modification times are kept in nanoseconds
+                    value /= 1e9
+                if low is not None:
+                    keep &= value >= low
+                if high is not None:
+                    keep &= value <= high
+            if captioned is not None:
+                keep &= c['captioned'] == bool(captioned)
+            if models is not None:
+                codes = [self._model_codes[m] for m in models if m in self._model_codes]
+                keep &= np.isin(c['model'], codes)
+            if names is not None:
+                only = np.zeros(n, bool)
+                only[[self.rows[name] for name in names if name in self.rows]] = True
+                keep &= only
+            rows, keys = self.order(sort)
+            hit = keep[rows]
+            return FacetView(keys[hit], rows[hit], self._names[0])
+
+    def facets(self, name):
+        """Module: facets: one file's facets as a dict, or None"""
+        with self._lock:
+            row = self.rows.get(name)
+            if row is None:
+                return None
+            c = self.columns
+            taken, duration = c['taken'][row], c['duration'][row]
+            return {"size": int(c['size'][row]),
+                    "date": int(c['date'][row]) / 1e9,
+                    "taken": None if np.isnan(taken) else float(taken),
+                    "width": int(c['width'][row]) or None,
+                    "height": int(c['height'][row]) or None,
+                    "duration": None if np.isnan(duration) else float(duration),
+                    "captioned": bool(c['captioned'][row]),
+                    "model": self.models[c['model'][row]] if c['model'][row] >= 0 else None}
+
+    def stats(self):
+        return {"files": len(self.rows), "pending": len(self._pending),
+                "models": len(self.models), "version": self.version}
+
+class FacetView:
+    """Module: FacetView: sorted files, as a sequence of (key, filename)
+    Sequence positions work with bisect, for cursors. Filenames are only
+    looked up for the entries used.
+    :param keys: sort keys, in order
+    :param rows: rows of the files, in order
+    :param names: filename of each row"""
+    def __init__(self, keys, rows, names):
+        self.keys = keys
+        self.rows = rows
+        self.names = names
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(zip(self.keys[i].tolist(), self.names[self.rows[i]].tolist()))
+        return self.keys[i].item(), self.names[self.rows[i]]
+
+    def __iter__(self):
+        return iter(self[:])
+
+def encode_cursor(position):
+    """Module: encode_cursor: an opaque string for a position in a list
+    :param position: (sort key, filename) in a FacetView, or [offset]"""
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def decode_cursor(cursor, sort=None):
+    """Module: decode_cursor: the position a cursor stands for
+    :param sort: the sort of the FacetView it is a position in; None for
+        an offset in a list of results
+    :returns: (sort key, filename), or (offset,)
+    :raises ValueError: for anything but a cursor of that kind, e.g. one
+        made for another sort"""
+    position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if sort is None:
+        if (isinstance(position, list) and len(position) == 1
+                and type(position[0]) is int and position[0] >= 0):
+            return tuple(position)
+    elif isinstance(position, list) and len(position) == 2 and \
+            isinstance(position[1], str):
+        key, name = position
+        if sort == 'name':
+            if isinstance(key, str):
+                return key, name
+        # Every other sort key is a float; JSON may write it as an int
+        elif type(key) in (int, float):
+            return float(key), name
+    raise ValueError(f"Not a cursor for sort {sort}")
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def open_facets(store):
+    """Module: open_facets: the shared FacetIndex for a caption store"""
+    key = os.path.abspath(store.db_path)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = FacetIndex(store)
+        return _indexes[key]
+
+if __name__ == "__main__":
+    # Time filters and sorts over synthetic columns
+    import tempfile
+    from captions import CaptionStore
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rng = np.random.default_rng(0)
+    folder = tempfile.mkdtemp()
+    index = FacetIndex(CaptionStore(folder))
+    for name in (f"IMG_{i:06d}.jpg" for i in rng.permutation(n)):
+        index._row(name)
+    for model in ('llava', 'qwen2.5-vl', 'gemini'):
+        index._model_code(model)
+    index.columns = {
+        'kind': rng.choice(3, n, p=[.8, .1, .1]).astype(np.int8),
+        'size': rng.integers(1e4, 1e8, n), 'date': rng.integers(1.5e18, 1.7e18, n),
+        'taken': np.where(rng.random(n) < .7, rng.uniform(1.2e9, 1.7e9, n), np.nan),
+        'width': rng.integers(200, 6000, n).astype(np.int32),
+        'height': rng.integers(200, 6000, n).astype(np.int32),
+        'duration': np.where(rng.random(n) < .2, rng.uniform(1, 3600, n), np.nan),
+        'captioned': rng.random(n) < .5, 'model': rng.integers(-1, 3, n).astype(np.int32)}
+    for sort in SORTS:
+        start = time.perf_counter()
+        index.order(sort)
+        print(f"{n} files by {sort} in {(time.perf_counter() - start) * 1e3:.1f} ms")
+    for label, kwargs in [
+            ("all, by type", {}),
+            ("images by date taken", dict(types=('image',), sort='taken')),
+            ("uncaptioned, largest first", dict(sort='size', captioned=False)),
+            ("by qwen2.5-vl, 1080p+, by pixels", dict(models=['qwen2.5-vl'], sort='pixels',
+                                                       ranges={'height': (1080, None)})),
+            ("videos over a minute, by duration", dict(types=('video',), sort='duration',
+                                                       ranges={'duration': (60, None)})),
+            ("by name", dict(sort='name'))]:
+        start = time.perf_counter()
+        view = index.select(**kwargs)
+        print(f"{label:>36}: {len(view):>6} in {(time.perf_counter() - start) * 1e3:6.1f} ms")
+    shutil.rmtree(folder)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Module: gemini
+Description: Gemini file uploads, reused while Google keeps them.
+
+Files sent to Gemini are uploaded first and kept on Google's side for
+about two days. Uploads are remembered by content hash together with
+their expiry time, in ~/.cache/findaimage/results.db, so re-captions
+and repeated bulk runs reuse them instead of sending the same bytes
+again. Uploads of different files run in parallel on the caption
+workers; simultaneous requests for the same file share one upload.
+
+The API is passed in, so the google.generativeai module can be swapped
+for FakeGenai (or any object with upload_file, get_file and
+GenerativeModel) to try things out without a key or network."""
+import sys
+import time
+import threading
+from datetime import datetime
+from captions import RESULTS_FILE, connect, content_hash
+
+# Uploads this close to expiring are sent again
+EXPIRY_MARGIN = 600
+# Used when the API does not say when an upload expires
+DEFAULT_TTL = 47 * 3600
+# Audio and video are processed before they can be used
+PROCESSING_WAIT = 120
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS gemini_files (
+    hash TEXT PRIMARY KEY,
+    name TEXT,
+    expires REAL
+);
+"""
+
+def _expires(file):
+    """Expiry of an uploaded file as a timestamp"""
+    when = getattr(file, 'expiration_time', None)
+    if isinstance(when, datetime):
+        return when.timestamp()
+    if isinstance(when, (int, float)):
+        return float(when)
+    return time.time() + DEFAULT_TTL
+
+def _state(file):
+    state = getattr(file, 'state', None)
+    return getattr(state, 'name', state)
+
+class GeminiFiles:
+    """Module: GeminiFiles: upload cache keyed by content hash
+    :param api: google.generativeai, or a fake with the same functions
+    :param path: database file, default ~/.cache/findaimage/results.db"""
+    def __init__(self, api, path=None):
+        self.api = api
+        self.path = path or RESULTS_FILE
+        self.files = {}
+        self.uploads = self.reuses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = {}
+        with self._lock, self.db:
+            self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        """One connection per thread"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = connect(self.path)
+        return db
+
+    def _cached(self, digest):
+        """A stored upload that is still good, or None"""
+        file, expires = self.files.get(digest, (None, 0))
+        if file is None:
+            row = self.db.execute('SELECT name, expires FROM gemini_files WHERE hash=?',
+                                  (digest,)).fetchone()
+            if row and row[1] - EXPIRY_MARGIN > time.time():
+                try:
+                    file, expires = self.api.get_file(row[0]), row[1]
+                except Exception as e:
+                    print(f"Gemini upload {row[0]} is gone: {e}")
+                    return None
+                self.files[digest] = (file, expires)
+        if file is not None and expires - EXPIRY_MARGIN > time.time():
+            return file
+        return None
+
+    def _wait_active(self, file):
+        """Wait while Gemini processes an audio or video upload"""
+        deadline = time.monotonic() + PROCESSING_WAIT
+        while _state(file) == 'PROCESSING' and time.monotonic() < deadline:
+            time.sleep(1)
+            file = self.api.get_file(file.name)
+        if _state(file) == 'FAILED':
+            raise ValueError(f"Gemini could not process {file.name}")
+        return file
+
+    def get(self, path, digest=None):
+        """Module: get: an uploaded file for path, uploading it if needed
+        :param path: local file
+        :param digest: content hash of path, if known
+        :returns: the API's file object, ready to pass to generate_content"""
+        digest = digest or content_hash(path)
+        with self._lock:
+            lock = self._pending.setdefault(digest, threading.Lock())
+        # Callers wanting the same file wait for one upload
+        try:
+            with lock:
+                file = self._cached(digest)
+                if file is not None:
+                    with self._lock:
+                        self.reuses += 1
+                    return file
+                file = self._wait_active(self.api.upload_file(path))
+                expires = _expires(file)
+                self.files[digest] = (file, expires)
+                with self._lock, self.db:
+                    self.db.execute('INSERT OR REPLACE INTO gemini_files VALUES (?, ?, ?)',
+                                    (digest, file.name, expires))
+                    self.uploads += 1
+                return file
+        finally:
+            # Also after a failed upload, so the next caller tries again
+            with self._lock:
+                if self._pending.get(digest) is lock:
+                    del self._pending[digest]
+
+    def generate(self, model, path, prompt, digest=None, on_text=None):
+        """Module: generate: describe a file with a Gemini model
+        If the model fails for another reason than its reply, the upload
+        is forgotten, in case it is what failed, and sent again next time.
+        :param model: Gemini model name
+        :param path: local file, uploaded unless a recent upload is reused
+        :param prompt: instructions for the model
+        :param digest: content hash of path, if known
+        :param on_text: called with the text so far, streamed
+        :returns: description text
+        :raises ValueError: when the reply has no text, e.g. if blocked"""
+        digest = digest or content_hash(path)
+        file = self.get(path, digest)
+        try:
+            response = self.api.GenerativeModel(model).generate_content(
+                [file, "\n\n", prompt], stream=on_text is not None)
+            if on_text is None:
+                return response.text
+            text = ''
+            for chunk in response:
+                text += chunk.text
+                on_text(text)
+            return text
+        except ValueError:
+            raise
+        except Exception:
+            self.forget(digest)
+            raise
+
+    def forget(self, digest):
+        """Drop an upload that the API no longer accepts"""
+        self.files.pop(digest, None)
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM gemini_files WHERE hash=?', (digest,))
+
+    def stats(self):
+        """Upload and reuse counts"""
+        return {"uploads": self.uploads, "reuses": self.reuses}
+
+class FakeGenai:
+    """Module: FakeGenai: stand-in for google.generativeai, for trying
+    things out without a key. Uploads take delay seconds and expire
+    after ttl seconds."""
+    def __init__(self, delay=0.1, ttl=DEFAULT_TTL):
+        self.delay = delay
+        self.ttl = ttl
+        self.uploaded = {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    class File:
+        def __init__(self, name, path, expires):
+            self.name = name
+            self.path = path
+            self.state = 'ACTIVE'
+            self.expiration_time = expires
+
+    class Response:
+        def __init__(self, text):
+            self.text = text
+
+    def upload_file(self, path):
+        time.sleep(self.delay)
+        with self._lock:
+            self.calls += 1
+            name = f"files/{self.calls}"
+            self.uploaded[name] = self.File(name, path, time.time() + self.ttl)
+            return self.uploaded[name]
+
+    def get_file(self, name):
+        if name not in self.uploaded:
+            raise ValueError(f"{name} not found")
+        return self.uploaded[name]
+
+    def GenerativeModel(self, model):
+        fake = self
+        class Model:
+            def generate_content(self, parts, stream=False):
+                files = [p for p in parts if isinstance(p, FakeGenai.File)]
+                for f in files:
+                    if f.name not in fake.uploaded:
+                        # As the API answers for an expired upload
+                        raise PermissionError(f"403 You do not have permission "
+                                              f"to access the File {f.name}")
+                text = f"{model} saw {', '.join(f.path for f in files)}"
+                if stream:
+                    return [FakeGenai.Response(word + ' ') for word in text.split(' ')]
+                return FakeGenai.Response(text)
+        return Model()
+
+if __name__ == "__main__":
+    # Upload a folder twice through the fake, four at a time
+    import os
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    folder = sys.argv[1] if len(sys.argv) > 1 else '.'
+    paths = [os.path.join(folder, f) for f in sorted(os.listdir(folder))
+             if os.path.isfile(os.path.join(folder, f)) and not f.startswith('.')]
+    fake = FakeGenai()
+    files = GeminiFiles(fake, os.path.join(tempfile.mkdtemp(), 'gemini.db'))
+    with ThreadPoolExecutor(4) as pool:
+        for run in (1, 2):
+            start = time.perf_counter()
+            list(pool.map(files.get, paths))
+            print(f"run {run}: {len(paths)} files in {time.perf_counter() - start:.2f} s, "
+                  f"{files.stats()}")
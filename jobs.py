@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Module: jobs
+Description: Captioning job queue with a bounded worker pool per backend.
+
+Requests enqueue a job and return at once. Each backend (local llama.cpp,
+Gemini, OpenAI...) has its own pool, so a slow model cannot starve the
+others, and its size bounds how many inferences run at a time. Clients
+poll a job or follow it as Server-Sent Events, which carry the caption's
+tokens as the model writes them."""
+import os
+import json
+import time
+import uuid
+import threading
+from abc import ABC, abstractmethod
+from itertools import islice
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Concurrent jobs per backend; override with e.g. CAPTION_WORKERS_LOCAL=4
+CAPTION_WORKERS = {"local": 2, "gemini": 4, "openai": 4, "lorem": 4}
+# Finished jobs kept for clients to collect
+KEEP_JOBS = 2000
+
+def sse(event, data):
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+class Tracked(ABC):
+    """Module: Tracked: state that clients can wait on or follow as events"""
+    FINAL = ("done", "error", "cancelled")
+
+    def __init__(self):
+        self.status = "queued"
+        self.version = 0
+        self._cond = threading.Condition()
+
+    def update(self, **fields):
+        """Change fields and wake anyone waiting"""
+        with self._cond:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.version += 1
+            self._cond.notify_all()
+
+    @property
+    def done(self):
+        return self.status in self.FINAL
+
+    def wait(self, version=None, timeout=None):
+        """Block until the version changes, or the work is finished"""
+        version = self.version if version is None else version
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version or self.done, timeout)
+        return self.version
+
+    @abstractmethod
+    def to_dict(self, seen=None):
+        """JSON-ready state; seen is the caller's own dict, for sending deltas"""
+
+    def events(self, keepalive=15):
+        """Module: events: Server-Sent Events stream of changes
+        Each stream passes its own seen dict to to_dict, so subclasses
+        can send only what is new to that client."""
+        version, seen = -1, {}
+        while True:
+            if self.version != version:
+                version = self.version
+                yield sse("done" if self.done else "status", self.to_dict(seen))
+                if self.done:
+                    return
+            elif not self.done:
+                yield ": keepalive\n\n"
+            self.wait(version, keepalive)
+
+class Job(Tracked):
+    """Module: Job: one caption request and its progress"""
+    def __init__(self, filename, model, backend, options=None, on_done=None):
+        super().__init__()
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.model = model
+        self.backend = backend
+        self.options = options or {}
+        self.on_done = on_done
+        self.description = None
+        # Text so far, while the model is still writing
+        self.text = ''
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def to_dict(self, seen=None):
+        out = {"job": self.id, "filename": self.filename, "model": self.model,
+               "status": self.status, "description": self.description,
+               "error": self.error}
+        if self.text and not self.done:
+            if seen is None:
+                out["text"] = self.text
+            else:
+                # Event streams get only the tokens new to them
+                offset = seen.get("text", 0)
+                out.update(offset=offset, delta=self.text[offset:])
+                seen["text"] = len(self.text)
+        return out
+
+class JobQueue:
+    """Module: JobQueue: run jobs with run(job) on per-backend pools
+    :param run: callable doing the work; returns the description
+    :param workers: {backend: pool size}, default CAPTION_WORKERS"""
+    def __init__(self, run, workers=None):
+        self.run = run
+        self.workers = dict(CAPTION_WORKERS if workers is None else workers)
+        for backend in self.workers:
+            env = os.environ.get(f"CAPTION_WORKERS_{backend.upper()}")
+            if env:
+                self.workers[backend] = max(1, int(env))
+        self.jobs = OrderedDict()
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def pool(self, backend):
+        """The worker pool for a backend, created on first use"""
+        with self._lock:
+            if backend not in self._pools:
+                size = self.workers.get(backend, 2)
+                self._pools[backend] = ThreadPoolExecutor(
+                    max_workers=size, thread_name_prefix=f"caption-{backend}")
+            return self._pools[backend]
+
+    def resize(self, backend, size):
+        """Use a different pool size for jobs submitted from now on"""
+        with self._lock:
+            if self.workers.get(backend) == size and backend in self._pools:
+                return
+            self.workers[backend] = size
+            old = self._pools.pop(backend, None)
+        if old:
+            old.shutdown(wait=False)
+
+    def submit(self, filename, model, backend, on_done=None, **options):
+        """Module: submit: queue a caption job
+        :param on_done: called with the job when it finishes or is cancelled
+        :returns: Job"""
+        job = Job(filename, model, backend, options, on_done)
+        with self._lock:
+            self.jobs[job.id] = job
+            # Forget the oldest finished jobs; ones still queued are kept
+            excess = len(self.jobs) - KEEP_JOBS
+            if excess > 0:
+                finished = (old for old in self.jobs.values() if old.done)
+                for old in list(islice(finished, excess)):
+                    del self.jobs[old.id]
+        self.pool(backend).submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        with job._cond:
+            # Claim the job, unless it was cancelled while queued
+            if job.done:
+                cancelled = True
+            else:
+                cancelled = False
+                job.status = "running"
+                job.version += 1
+                job._cond.notify_all()
+        if not cancelled:
+            try:
+                description = self.run(job)
+            except Exception as e:
+                print(f"Caption error for {job.filename}: {e}")
+                job.update(status="error", error=str(e), description=str(e),
+                           finished=time.time())
+            else:
+                job.update(status="done", description=description, finished=time.time())
+        if job.on_done:
+            try:
+                job.on_done(job)
+            except Exception as e:
+                print(f"Error after caption job {job.id}: {e}")
+
+    def cancel(self, job):
+        """Cancel a job that has not started. Running jobs finish.
+        :returns: True if the job was cancelled"""
+        with job._cond:
+            if job.status != "queued":
+                return False
+            job.status = "cancelled"
+            job.finished = time.time()
+            job.version += 1
+            job._cond.notify_all()
+        return True
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def stats(self):
+        """Queued and running job counts per backend"""
+        out = {}
+        for job in list(self.jobs.values()):
+            if job.status in ("queued", "running"):
+                counts = out.setdefault(job.backend, {"queued": 0, "running": 0})
+                counts[job.status] += 1
+        return {"workers": dict(self.workers), "active": out}
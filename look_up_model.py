@@ -1,32 +1,238 @@
 #!/usr/bin/env python3
+"""Module: look_up_model
+Description: Look up model capability tags (image, audio, video, any).
+
+models.csv is compiled once into a compact index, models.idx, which is
+loaded lazily once per process. Lookups are exact, normalized (quantization
+suffixes like :q4_k_m or -GGUF removed) or substring matches."""
+import os
+import re
 import sys
 import ast
 import csv
+import json
+import time
+import bisect
 import argparse
+import threading
 
-def get_caps(lookup):
+CSV_FILE = 'models.csv'
+INDEX_FILE = 'models.idx'
+INDEX_VERSION = 1
+
+# Trailing quantization / packaging suffixes: -GGUF, :Q4_K_M, -IQ4_NL, .gguf
+QUANT_RE = re.compile(r'(?:[-_.](?:gguf|(?:ud-)?i?q\d\w*|bf16|fp?16|f32)|:.*)$')
+
+def normalize(model_id):
+    """Module: normalize: strip organization and quantization suffixes
+    :param model_id: model id, e.g. unsloth/Qwen2.5-VL-3B-Instruct-GGUF:IQ4_NL
+    :returns: normalized name, e.g. qwen2.5-vl-3b-instruct"""
+    name = model_id.lower().rsplit('/', 1)[-1]
+    while True:
+        stripped = QUANT_RE.sub('', name)
+        if stripped == name or not stripped:
+            return name
+        name = stripped
+
+class ModelCatalog:
+    """Module: ModelCatalog: compiled, in-memory view of models.csv"""
+    def __init__(self, ids, tags, tagsets):
+        self.ids = ids
+        self.tags = tags
+        self.tagsets = tagsets
+        self.exact = {}
+        self.names = {}
+        for row, model_id in enumerate(ids):
+            self.exact.setdefault(model_id, row)
+            self.names.setdefault(normalize(model_id), row)
+        # One newline-joined haystack answers substring queries with a
+        # single str.find; starts[] maps the hit offset back to its row.
+        self.haystack = '\n'.join(ids)
+        self.starts = []
+        pos = 0
+        for model_id in ids:
+            self.starts.append(pos)
+            pos += len(model_id) + 1
+
+    def _tags(self, row):
+        return list(self.tagsets[self.tags[row]])
+
+    def substring(self, lookup):
+        """Tags of the first model, in CSV order, whose id contains lookup"""
+        if not lookup or '\n' in lookup:
+            return []
+        pos = self.haystack.find(lookup)
+        if pos < 0:
+            return []
+        return self._tags(bisect.bisect_right(self.starts, pos) - 1)
+
+    def resolve(self, model_id):
+        """Tags by exact, then normalized, then substring match"""
+        ml = model_id.lower()
+        row = self.exact.get(ml)
+        if row is None:
+            row = self.exact.get(ml.split(':')[0])
+        if row is None:
+            row = self.names.get(normalize(ml))
+        if row is not None:
+            return self._tags(row)
+        return (self.substring(ml.split(':')[0])
+                or self.substring(normalize(ml)))
+
+    @classmethod
+    def from_csv(cls, csv_file=CSV_FILE):
+        ids, tags, tagsets, seen = [], [], [], {}
+        with open(csv_file, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                try:
+                    t = ast.literal_eval(row['Tags'])
+                except (ValueError, SyntaxError):
+                    print(f"Error parsing tags for {row['Model ID']}.")
+                    t = []
+                key = tuple(t)
+                if key not in seen:
+                    seen[key] = len(tagsets)
+                    tagsets.append(key)
+                ids.append(row['Model ID'].lower())
+                tags.append(seen[key])
+        return cls(ids, tags, tagsets)
+
+    def save(self, index_file, stamp):
+        """Write the index atomically, so readers never see half a file"""
+        tmp = f"{index_file}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"version": INDEX_VERSION, "source": stamp,
+                       "ids": self.ids, "tags": self.tags,
+                       "tagsets": self.tagsets}, f, separators=(',', ':'))
+        os.replace(tmp, index_file)
+
+    @classmethod
+    def load(cls, index_file, stamp):
+        """Load the index, or None if it is missing or out of date"""
+        try:
+            with open(index_file, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("version") != INDEX_VERSION or data.get("source") != stamp:
+            return None
+        return cls(data["ids"], data["tags"], data["tagsets"])
+
+_catalog = None
+_catalog_stamp = None
+_catalog_lock = threading.Lock()
+
+def _stamp(csv_file):
+    st = os.stat(csv_file)
+    return [st.st_size, st.st_mtime_ns]
+
+def get_catalog(csv_file=CSV_FILE, index_file=INDEX_FILE, rebuild=False):
+    """Module: get_catalog: the process-wide catalog, compiled on demand
+    :param csv_file: models.csv source
+    :param index_file: compiled index, rebuilt when csv_file changes
+    :returns: ModelCatalog, or None if models.csv does not exist"""
+    global _catalog, _catalog_stamp
     try:
-        with open('models.csv', 'r') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if lookup in row['Model ID'].lower():
-                    s = row['Tags']
-                    try:
-                        tags = ast.literal_eval(s)
-                    except (ValueError, SyntaxError):
-                        print("Error parsing tags.")
-                        tags = []
-                    return tags
+        stamp = _stamp(csv_file)
     except FileNotFoundError:
         print("CSV file not found. Run update_models.py to generate it.")
+        return None
+    with _catalog_lock:
+        if _catalog is not None and stamp == _catalog_stamp and not rebuild:
+            return _catalog
+        catalog = None if rebuild else ModelCatalog.load(index_file, stamp)
+        if catalog is None:
+            catalog = ModelCatalog.from_csv(csv_file)
+            try:
+                catalog.save(index_file, stamp)
+            except OSError as e:
+                print(f"Could not write {index_file}: {e}")
+        _catalog, _catalog_stamp = catalog, stamp
+        return catalog
+
+def get_caps(lookup):
+    """Module: get_caps: tags of the first model whose id contains lookup
+    :param lookup: lower-case model id or fragment
+    :returns: list of tags"""
+    catalog = get_catalog()
+    return catalog.substring(lookup) if catalog else []
+
+def resolve_caps(model_id):
+    """Module: resolve_caps: tags by exact, normalized or substring match
+    :param model_id: model id as reported by a llama.cpp router
+    :returns: list of tags"""
+    catalog = get_catalog()
+    return catalog.resolve(model_id) if catalog else []
+
+def resolve_caps_many(model_ids):
+    """Module: resolve_caps_many: batch version of resolve_caps
+    :param model_ids: iterable of model ids
+    :returns: dict of model id to list of tags"""
+    catalog = get_catalog()
+    if not catalog:
+        return {model_id: [] for model_id in model_ids}
+    return {model_id: catalog.resolve(model_id) for model_id in model_ids}
+
+def _scan_caps(lookup, csv_file=CSV_FILE):
+    """The original linear scan, kept for benchmarking"""
+    with open(csv_file, 'r') as f:
+        for row in csv.DictReader(f):
+            if lookup in row['Model ID'].lower():
+                return ast.literal_eval(row['Tags'])
     return []
 
+def bench(rounds=200):
+    """Module: bench: compare the linear CSV scan with the compiled catalog"""
+    catalog = get_catalog()
+    if not catalog:
+        return
+    step = max(1, len(catalog.ids) // 20)
+    sample = catalog.ids[::step] + ['no-such-model']
+    start = time.perf_counter()
+    for lookup in sample:
+        _scan_caps(lookup)
+    scan = (time.perf_counter() - start) / len(sample)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for lookup in sample:
+            catalog.substring(lookup)
+    sub = (time.perf_counter() - start) / (rounds * len(sample))
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for lookup in sample:
+            catalog.resolve(lookup)
+    res = (time.perf_counter() - start) / (rounds * len(sample))
+    start = time.perf_counter()
+    ModelCatalog.load(INDEX_FILE, _stamp(CSV_FILE))
+    load = time.perf_counter() - start
+    print(f"{len(catalog.ids)} models, {len(sample)} lookups")
+    print(f"csv scan:          {scan * 1e3:9.3f} ms/lookup")
+    print(f"catalog substring: {sub * 1e3:9.3f} ms/lookup")
+    print(f"catalog resolve:   {res * 1e3:9.3f} ms/lookup")
+    print(f"index load:        {load * 1e3:9.3f} ms")
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('model_id', type=str, help='Model ID to look up')
+    parser.add_argument('model_id', type=str, nargs='*', help='Model ID(s) to look up')
+    parser.add_argument('-f', '--file', type=argparse.FileType('r'),
+                        help='read model IDs, one per line, ("-" for stdin)')
+    parser.add_argument('--rebuild', action='store_true', help=f'recompile {INDEX_FILE}')
+    parser.add_argument('--bench', action='store_true', help='compare CSV scan and catalog')
     args = parser.parse_args()
-    tags = get_caps(args.model_id.lower().split(':')[0])
-    print(f"tags: {tags}")
+    if args.rebuild:
+        get_catalog(rebuild=True)
+    if args.bench:
+        bench()
+    ids = list(args.model_id)
+    if args.file:
+        ids += [line.strip() for line in args.file if line.strip()]
+    if len(ids) == 1 and not args.file:
+        print(f"tags: {resolve_caps(ids[0])}")
+    elif ids:
+        for model_id, tags in resolve_caps_many(ids).items():
+            print(f"{model_id}\t{tags}")
+    elif not (args.rebuild or args.bench):
+        parser.print_usage(sys.stderr)
 
 if __name__ == '__main__':
     main()
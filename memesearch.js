@@ -15,32 +15,138 @@
     You should have received a copy of the GNU General Public License along
     with this program; if not, write to the Free Software Foundation, Inc.,
     51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
-*/
-const delayTime = 10; // milliseconds
-let figures = document.querySelectorAll('figure');
 
-function init() {
-    let search = document.getElementById('search');
-    search.addEventListener('keyup', filterFigures, true);
-    search.addEventListener('click', (e) => {
-        e.target.select();
-        filterFigures(e);
-    }, true);
-}
+    Figures are found through a word index instead of reading every
+    caption on each keystroke. Saved galleries carry a prebuilt index in
+    <script type="application/json" id="search-index">; other pages get
+    one built from their captions once, at load. A figure is shown when
+    every word typed starts a word of its caption or filename. Typing is
+    coalesced to one search per animation frame, and only figures whose
+    visibility changes are touched.
+*/
+(function () {
+    // Pages that search on a server do not need this
+    if (window.liveGallery) return;
+    const figures = Array.from(document.querySelectorAll('figure'));
+    const wordPattern = /[\p{L}\p{N}]+/gu;
+    let words = [], lists = [], decoded = [], count = 0, order = null;
+    let shown = null, hits = null, pending = null;
 
-function filterFigures(event) {
-    if (event.key == "Escape") event.target.value = '';
-    let searchTerm = event.target.value.trim().toLowerCase();
-    if (searchTerm.length == 0) searchTerm = ' ';
-    figures.forEach(figure => {
-        if (!figure.querySelector('figcaption')) {
-            console.log(figure.querySelector('img').src);
-            figure.style.display = 'inline-block';
-        } else
-        if (figure.querySelector('figcaption').innerText.toLowerCase()
-            .includes(searchTerm))
-            figure.style.display = 'inline-block';
-        else figure.style.display = 'none';
-    });
-}
-init();
+    function tokenize(text) {
+        return (text || '').toLowerCase().match(wordPattern) || [];
+    }
+    function figureName(figure) {
+        const media = figure.querySelector('img, audio, video');
+        return figure.title || (media && (media.alt || media.getAttribute('src'))) || '';
+    }
+    // Prebuilt index: sorted words, and for each the figures it is in,
+    // as base-36 gaps between figure numbers
+    function loadIndex(data) {
+        words = data.words.split(' ');
+        lists = data.ids;
+        count = data.names.length;
+        const byName = new Map();
+        figures.forEach((figure, i) => byName.set(figureName(figure), i));
+        order = data.names.map(name => byName.has(name) ? byName.get(name) : -1);
+    }
+    function buildIndex() {
+        const postings = new Map();
+        figures.forEach((figure, i) => {
+            const caption = figure.querySelector('figcaption');
+            const text = figureName(figure) + ' ' + (caption ? caption.textContent : '');
+            new Set(tokenize(text)).forEach(word => {
+                if (!postings.has(word)) postings.set(word, []);
+                postings.get(word).push(i);
+            });
+        });
+        words = Array.from(postings.keys()).sort();
+        decoded = words.map(word => Uint32Array.from(postings.get(word)));
+        count = figures.length;
+    }
+    function postings(i) {
+        if (!decoded[i]) {
+            const gaps = lists[i];
+            const out = new Uint32Array(gaps.length - gaps.replaceAll(',', '').length + 1);
+            let id = 0, gap = 0, n = 0;
+            for (let j = 0; j <= gaps.length; j++) {
+                const c = j < gaps.length ? gaps.charCodeAt(j) : 44;
+                if (c == 44) {  // ','
+                    id += gap;
+                    out[n++] = order ? order[id] : id;
+                    gap = 0;
+                } else {
+                    gap = gap * 36 + (c < 97 ? c - 48 : c - 87);  // 0-9, a-z
+                }
+            }
+            decoded[i] = out;
+        }
+        return decoded[i];
+    }
+    // Decode the rest while the page is idle, so first searches are quick
+    function warm(start) {
+        const until = performance.now() + 8;
+        let i = start;
+        while (i < words.length && performance.now() < until) postings(i++);
+        if (i < words.length) (window.requestIdleCallback || setTimeout)(() => warm(i));
+    }
+    function lowerBound(term) {
+        let lo = 0, hi = words.length;
+        while (lo < hi) {
+            const mid = (lo + hi) >> 1;
+            if (words[mid] < term) lo = mid + 1; else hi = mid;
+        }
+        return lo;
+    }
+    // Which figures match every word, as a prefix
+    function match(terms) {
+        hits.fill(0);
+        for (let k = 0; k < terms.length; k++) {
+            const term = terms[k];
+            let any = false;
+            for (let i = lowerBound(term); i < words.length && words[i].startsWith(term); i++) {
+                const ids = postings(i);
+                for (let j = 0; j < ids.length; j++) {
+                    // Counted once per word typed, and only if it matched the others
+                    if (hits[ids[j]] == k) { hits[ids[j]] = k + 1; any = true; }
+                }
+            }
+            if (!any) return 0;
+        }
+        return terms.length;
+    }
+    function filterFigures(value) {
+        const terms = Array.from(new Set(tokenize(value)));
+        const need = terms.length ? match(terms) : -1;
+        // One pass of writes, no reads, so the page is laid out once
+        for (let i = 0; i < figures.length; i++) {
+            const visible = need < 0 || (need > 0 && hits[i] == need);
+            if (visible !== shown[i]) {
+                shown[i] = visible;
+                figures[i].style.display = visible ? 'inline-block' : 'none';
+            }
+        }
+    }
+    function schedule(event) {
+        if (event.key == "Escape") event.target.value = '';
+        if (pending === null) {
+            pending = requestAnimationFrame(() => {
+                pending = null;
+                filterFigures(search.value);
+            });
+        }
+    }
+    const search = document.getElementById('search');
+    if (!search) return;
+    const prebuilt = document.getElementById('search-index');
+    if (prebuilt) {
+        loadIndex(JSON.parse(prebuilt.textContent));
+        warm(0);
+    } else {
+        buildIndex();
+    }
+    hits = new Uint16Array(Math.max(count, figures.length));
+    shown = new Array(figures.length).fill(true);
+    search.addEventListener('input', schedule, true);
+    search.addEventListener('keyup', e => { if (e.key == "Escape") schedule(e); }, true);
+    search.addEventListener('click', (e) => e.target.select(), true);
+})();
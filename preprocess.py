@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Module: preprocess
+Description: Images prepared for vision models.
+
+Images are shrunk to fit MODEL_IMAGE_SIZE pixels, keeping their aspect
+ratio and EXIF orientation, and encoded as JPEG (or WebP, for backends
+that accept it). JPEGs are decoded in draft mode and other formats with
+reduce(), so the full-resolution image is never decoded. The encoded
+bytes are cached by content hash, size and format, in memory and, for
+gallery files, on disk next to the thumbnails. Used by album_create and
+aichat."""
+import io
+import os
+import sys
+import time
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageOps
+
+# Longest side in pixels; override with MODEL_IMAGE_SIZE=448
+SIZE = int(os.environ.get('MODEL_IMAGE_SIZE', 250))
+# llama.cpp decodes JPEG and PNG; WebP works with Gemini and OpenAI
+FORMAT = os.environ.get('MODEL_IMAGE_FORMAT', 'JPEG').upper()
+QUALITY = int(os.environ.get('MODEL_IMAGE_QUALITY', 85))
+MIMETYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png'}
+EXTS = {'JPEG': '.jpg', 'WEBP': '.webp', 'PNG': '.png'}
+if FORMAT not in MIMETYPES:
+    raise ValueError(f"MODEL_IMAGE_FORMAT={FORMAT} is not supported; "
+                     f"use {', '.join(MIMETYPES)}")
+# Encoded images kept in memory
+MEMORY_LIMIT = 32 << 20
+
+_memory = OrderedDict()
+_memory_size = 0
+_lock = threading.Lock()
+
+def params(size=SIZE, fmt=FORMAT, quality=QUALITY):
+    """Module: params: preprocessing settings, for cache keys"""
+    return {"size": size, "format": fmt, "quality": quality}
+
+def encode(img, size=SIZE, fmt=FORMAT, quality=QUALITY):
+    """Module: encode: shrink and encode one image
+    :param img: PIL Image, not yet loaded for the draft mode to help
+    :param size: longest side in pixels
+    :param fmt: JPEG, WEBP or PNG
+    :param quality: JPEG/WebP quality
+    :returns: encoded bytes"""
+    # Let the JPEG decoder scale down by up to 8x while decoding
+    img.draft('RGB', (size, size))
+    img = ImageOps.exif_transpose(img)
+    # reducing_gap shrinks by whole factors with reduce() first
+    img.thumbnail((size, size), Image.LANCZOS, reducing_gap=2.0)
+    if fmt == 'JPEG' and img.mode != 'RGB':
+        if 'A' in img.getbands() or img.mode == 'P':
+            rgba = img.convert('RGBA')
+            img = Image.new('RGB', rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel('A'))
+        else:
+            img = img.convert('RGB')
+    elif img.mode not in ('RGB', 'RGBA', 'L'):
+        img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+    buffered = io.BytesIO()
+    img.save(buffered, format=fmt, quality=quality)
+    return buffered.getvalue()
+
+def _remember(key, payload):
+    global _memory_size
+    with _lock:
+        if key in _memory:
+            return
+        _memory[key] = payload
+        _memory_size += len(payload)
+        while _memory_size > MEMORY_LIMIT and len(_memory) > 1:
+            _memory_size -= len(_memory.popitem(last=False)[1])
+
+def _recall(key):
+    with _lock:
+        payload = _memory.get(key)
+        if payload is not None:
+            _memory.move_to_end(key)
+        return payload
+
+def cache_file(cache_dir, digest, size=SIZE, fmt=FORMAT, quality=QUALITY):
+    """Content-addressed location: model/ab/abcdef...-250-q85.jpg"""
+    return os.path.join(cache_dir, 'model', digest[:2],
+                        f"{digest}-{size}-q{quality}{EXTS[fmt]}")
+
+def prepare_image(src, digest=None, cache_dir=None, size=SIZE, fmt=FORMAT, quality=QUALITY):
+    """Module: prepare_image: model input for an image, cached
+    :param src: image path, or a PIL Image
+    :param digest: content hash of src, if known
+    :param cache_dir: directory for the disk cache, e.g. the thumbnail cache
+    :returns: encoded bytes"""
+    if digest is None:
+        if isinstance(src, Image.Image):
+            h = hashlib.blake2b(src.tobytes(), digest_size=16)
+            h.update(f"{src.mode}{src.size}".encode())
+        else:
+            h = hashlib.blake2b(digest_size=16)
+            with open(src, 'rb') as f:
+                while chunk := f.read(1 << 20):
+                    h.update(chunk)
+        digest = h.hexdigest()
+    key = (digest, size, fmt, quality)
+    payload = _recall(key)
+    if payload is not None:
+        return payload
+    path = cache_file(cache_dir, digest, size, fmt, quality) if cache_dir else None
+    if path and os.path.exists(path):
+        with open(path, 'rb') as f:
+            payload = f.read()
+    else:
+        if isinstance(src, Image.Image):
+            payload = encode(src.copy(), size, fmt, quality)
+        else:
+            with Image.open(src) as img:
+                payload = encode(img, size, fmt, quality)
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp, path)
+    _remember(key, payload)
+    return payload
+
+def data_url(payload, fmt=FORMAT):
+    """Module: data_url: encoded image as a data: URL for image_url content"""
+    return f"data:{MIMETYPES[fmt]};base64,{base64.b64encode(payload).decode('utf-8')}"
+
+def image_url(src, digest=None, cache_dir=None, size=SIZE, fmt=FORMAT, quality=QUALITY):
+    """Module: image_url: prepare_image, as a data: URL"""
+    return data_url(prepare_image(src, digest, cache_dir, size, fmt, quality), fmt)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python preprocess.py <image> [...]")
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        start = time.perf_counter()
+        with Image.open(path) as img:
+            old = img.resize((250, 250))
+            buffered = io.BytesIO()
+            old.save(buffered, format="PNG")
+        before = time.perf_counter() - start
+        start = time.perf_counter()
+        with Image.open(path) as img:
+            payload = encode(img)
+        after = time.perf_counter() - start
+        print(f"{path}: resize+PNG {before * 1e3:.1f} ms {len(buffered.getvalue())} bytes, "
+              f"{FORMAT} {after * 1e3:.1f} ms {len(payload)} bytes")
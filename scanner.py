@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""Module: scanner
+Description: Cached media catalog for a gallery folder.
+
+The folder is listed with a single os.scandir pass that classifies files by
+extension and keeps their stat info. Results are cached. With inotify
+(pip install inotify_simple) only the files named in change events are
+re-examined; without it, the directory's mtime is checked instead, which
+notices added, removed and renamed files, and every few seconds the
+files themselves are stat'ed to notice edits made in place. Either way,
+page loads on an unchanged folder do not list it again. Subscribers are told which files
+were added, removed or changed."""
+import os
+import sys
+import time
+import threading
+from collections import namedtuple
+
+try:
+    from inotify_simple import INotify, flags
+    INOTIFY_AVAILABLE = True
+except ImportError:
+    INOTIFY_AVAILABLE = False
+
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+AUDIO_EXTS = ('.mp3', '.wav', '.ogg', '.m4a', '.flac', '.aac', '.wma', '.alac', '.aiff', '.opus', )
+VIDEO_EXTS = ('.mp4', '.mov', '.avi', '.mkv', '.webm', '.flv', '.wmv', '.mpeg', '.mpg')
+KINDS = {ext: kind for kind, exts in (('image', IMAGE_EXTS), ('audio', AUDIO_EXTS),
+                                      ('video', VIDEO_EXTS)) for ext in exts}
+
+# Seconds between stat'ing every file when polling
+STAT_INTERVAL = 5
+
+Entry = namedtuple('Entry', 'name kind size mtime_ns')
+Changes = namedtuple('Changes', 'added removed changed')
+
+def media_kind(filename):
+    """Module: media_kind: 'image', 'audio', 'video', or None"""
+    return KINDS.get(os.path.splitext(filename)[1].lower())
+
+class MediaScanner:
+    """Module: MediaScanner: cached listing of one gallery folder
+    :param folder: gallery folder
+    :param watch: use inotify when it is available"""
+    def __init__(self, folder, watch=True):
+        self.folder = folder
+        self.entries = {}
+        self.revision = 0
+        self._scanned = False
+        self._dir_mtime = None
+        self._statted = 0
+        self._pending = set()
+        self._rescan_all = True
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.watching = False
+        if watch and INOTIFY_AVAILABLE:
+            try:
+                self._start_watch()
+            except OSError as e:
+                print(f"inotify unavailable, polling {folder}: {e}")
+
+    def subscribe(self, listener):
+        """Call listener(scanner, changes) after each scan that finds changes"""
+        self._listeners.append(listener)
+
+    def _start_watch(self):
+        inotify = INotify()
+        mask = (flags.CREATE | flags.DELETE | flags.CLOSE_WRITE | flags.ATTRIB |
+                flags.MOVED_FROM | flags.MOVED_TO | flags.DELETE_SELF | flags.MOVE_SELF)
+        inotify.add_watch(self.folder, mask)
+        self.watching = True
+        threading.Thread(target=self._watch, args=(inotify,), daemon=True,
+                         name="media-watch").start()
+
+    def _watch(self, inotify):
+        while True:
+            events = inotify.read()
+            with self._lock:
+                for event in events:
+                    if event.mask & (flags.Q_OVERFLOW | flags.DELETE_SELF |
+                                     flags.MOVE_SELF | flags.IGNORED):
+                        self._rescan_all = True
+                    elif event.name and media_kind(event.name):
+                        self._pending.add(event.name)
+
+    def _stale(self):
+        """Decide what to look at, without listing the folder"""
+        if self.watching:
+            names, self._pending = self._pending, set()
+            everything, self._rescan_all = self._rescan_all, False
+            return everything, names
+        mtime = os.stat(self.folder).st_mtime_ns
+        now = time.monotonic()
+        if mtime != self._dir_mtime:
+            self._dir_mtime, self._statted = mtime, now
+            return True, set()
+        # Editing a file in place does not touch the directory
+        if now - self._statted >= STAT_INTERVAL:
+            self._statted = now
+            return False, set(self.entries)
+        return False, set()
+
+    def _scan_all(self):
+        entries = {}
+        with os.scandir(self.folder) as it:
+            for de in it:
+                kind = media_kind(de.name)
+                if kind is None:
+                    continue
+                try:
+                    if not de.is_file():
+                        continue
+                    st = de.stat()
+                except OSError:
+                    continue
+                entries[de.name] = Entry(de.name, kind, st.st_size, st.st_mtime_ns)
+        return entries
+
+    def _scan_names(self, names):
+        entries = dict(self.entries)
+        for name in names:
+            try:
+                st = os.stat(os.path.join(self.folder, name))
+                entries[name] = Entry(name, media_kind(name), st.st_size, st.st_mtime_ns)
+            except OSError:
+                entries.pop(name, None)
+        return entries
+
+    def scan(self):
+        """Module: scan: bring the catalog up to date
+        :returns: Changes(added, removed, changed) lists of filenames"""
+        with self._lock:
+            everything, names = self._stale()
+            if not self._scanned:
+                everything = True
+            if not everything and not names:
+                return Changes([], [], [])
+            old = self.entries
+            self.entries = self._scan_all() if everything else self._scan_names(names)
+            self._scanned = True
+            added = [n for n in self.entries if n not in old]
+            removed = [n for n in old if n not in self.entries]
+            changed = [n for n, e in self.entries.items()
+                       if n in old and old[n] != e]
+            changes = Changes(added, removed, changed)
+            if added or removed or changed:
+                self.revision += 1
+        if added or removed or changed:
+            for listener in self._listeners:
+                listener(self, changes)
+        return changes
+
+    def files(self, kind=None):
+        """Filenames in the catalog, optionally of one kind"""
+        return [e.name for e in self.entries.values() if kind is None or e.kind == kind]
+
+_scanners = {}
+_scanners_lock = threading.Lock()
+
+def open_scanner(folder, listener=None):
+    """Module: open_scanner: the shared MediaScanner for a folder
+    :param listener: subscribed when the scanner is first created"""
+    key = os.path.abspath(folder)
+    with _scanners_lock:
+        if key not in _scanners:
+            _scanners[key] = MediaScanner(folder)
+            if listener:
+                _scanners[key].subscribe(listener)
+        return _scanners[key]
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else '.'
+    scanner = MediaScanner(folder)
+    start = time.perf_counter()
+    changes = scanner.scan()
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    scanner.scan()
+    again = time.perf_counter() - start
+    for kind in ('image', 'audio', 'video'):
+        print(f"{kind}: {len(scanner.files(kind))}")
+    print(f"first scan {first * 1e3:.2f} ms, cached {again * 1e3:.3f} ms "
+          f"({'inotify' if scanner.watching else 'polling'})")
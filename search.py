@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""Module: search
+Description: Ranked caption search for a gallery folder.
+
+An inverted index maps each word of the captions (including XMP keywords
+imported as captions) and filenames to the files containing it. Every
+word of a query must match, either as typed, as the start of a longer
+word, or, when it matches nothing as typed, with one typo (two for long
+words). Results are ranked by BM25, so files where the words are rare
+and prominent come first. The index is built once and then caught up
+with the caption store and the folder scanner, re-indexing only the
+files that changed.
+
+Saved galleries search without a server: export_index builds a compact
+index of their figures that memesearch.js reads."""
+import os
+import re
+import sys
+import math
+import time
+import json
+import bisect
+import threading
+from collections import Counter, OrderedDict
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Score factors for words matched by prefix or with typos
+PREFIX_WEIGHT = 0.7
+TYPO_WEIGHT = 0.5
+# Words shorter than this must be spelled right
+TYPO_MIN = 4
+# Words this long may have two typos
+TYPO2_MIN = 8
+# Captions edited this many seconds apart may commit out of order
+SKEW = 5
+KEEP_RESULTS = 32
+
+_word = re.compile(r'[^\W_]+')
+
+def tokenize(text):
+    """Module: tokenize: lowercase words; filenames split at _ - and ."""
+    return _word.findall(text.casefold()) if text else []
+
+def edit_distance(a, b, limit):
+    """Damerau-Levenshtein (optimal string alignment) distance of a and b,
+    or limit + 1 if it is more than limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2, prev = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+class SearchIndex:
+    """Module: SearchIndex: inverted index over filenames and captions"""
+    def __init__(self):
+        # word -> {filename: count}
+        self.postings = {}
+        # filename -> Counter of its words
+        self.docs = {}
+        self.lengths = {}
+        self.total_length = 0
+        self.version = 0
+        self.catalog_revision = None
+        self.store_revision = None
+        self.updated = 0
+        self._vocab = None
+        self._results = OrderedDict()
+        self._lock = threading.RLock()
+
+    def add(self, name, caption=None):
+        """Index a file, replacing what was indexed for it before"""
+        with self._lock:
+            self.remove(name)
+            words = Counter(tokenize(name) + tokenize(caption))
+            self.docs[name] = words
+            self.lengths[name] = sum(words.values())
+            self.total_length += self.lengths[name]
+            for word, count in words.items():
+                postings = self.postings.get(word)
+                if postings is None:
+                    postings = self.postings[word] = {}
+                    self._vocab = None
+                postings[name] = count
+            self.version += 1
+
+    def remove(self, name):
+        """Drop a file from the index"""
+        with self._lock:
+            words = self.docs.pop(name, None)
+            if words is None:
+                return
+            self.total_length -= self.lengths.pop(name)
+            for word in words:
+                postings = self.postings[word]
+                del postings[name]
+                if not postings:
+                    del self.postings[word]
+                    self._vocab = None
+            self.version += 1
+
+    def refresh(self, catalog, store):
+        """Module: refresh: catch up with the folder and the caption store
+        :param catalog: MediaScanner, for the files in the folder
+        :param store: CaptionStore, for their captions"""
+        with self._lock:
+            catalog_revision, store_revision = catalog.revision, store.revision
+            if (catalog_revision, store_revision) == (self.catalog_revision,
+                                                      self.store_revision):
+                return
+            entries = catalog.entries
+            pending = set()
+            if catalog_revision != self.catalog_revision:
+                for name in self.docs.keys() - entries.keys():
+                    self.remove(name)
+                pending |= entries.keys() - self.docs.keys()
+            if store_revision != self.store_revision:
+                changed, newest = store.changed_since(self.updated - SKEW)
+                pending |= {name for name in changed if name in entries}
+                self.updated = max(self.updated, newest)
+            pending = sorted(pending)
+            captions = store.get_many(pending)
+            for name in pending:
+                self.add(name, captions.get(name))
+            self.catalog_revision, self.store_revision = catalog_revision, store_revision
+
+    @property
+    def vocab(self):
+        """Sorted list of indexed words, for prefix and typo lookups"""
+        if self._vocab is None:
+            self._vocab = sorted(self.postings)
+        return self._vocab
+
+    def expand(self, term):
+        """Module: expand: indexed words a query word matches
+        :returns: list of (word, weight)"""
+        vocab = self.vocab
+        start = bisect.bisect_left(vocab, term)
+        end = bisect.bisect_left(vocab, term + '\U0010ffff', start)
+        matches = [(w, 1.0 if w == term else PREFIX_WEIGHT) for w in vocab[start:end]]
+        if matches or len(term) < TYPO_MIN:
+            return matches
+        limit = 2 if len(term) >= TYPO2_MIN else 1
+        # Typos rarely hit the first letter; only words sharing it are checked
+        start = bisect.bisect_left(vocab, term[0])
+        end = bisect.bisect_left(vocab, term[0] + '\U0010ffff', start)
+        for word in vocab[start:end]:
+            distance = edit_distance(term, word, limit)
+            if distance <= limit:
+                matches.append((word, TYPO_WEIGHT / distance))
+        return matches
+
+    def _score(self, term):
+        """BM25 score of each file for one query word"""
+        n = len(self.docs)
+        average = self.total_length / n if n else 1
+        scores = {}
+        for word, weight in self.expand(term):
+            postings = self.postings[word]
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for name, count in postings.items():
+                score = weight * idf * count * (K1 + 1) / (
+                    count + K1 * (1 - B + B * self.lengths[name] / average))
+                if score > scores.get(name, 0):
+                    scores[name] = score
+        return scores
+
+    def search(self, q):
+        """Module: search: files matching every word of q, best first
+        :returns: list of (filename, score)"""
+        terms = list(dict.fromkeys(tokenize(q)))
+        with self._lock:
+            key = (self.version, tuple(terms))
+            if key in self._results:
+                self._results.move_to_end(key)
+                return self._results[key]
+            per_term = sorted((self._score(t) for t in terms), key=len)
+            if not per_term:
+                ranked = []
+            else:
+                # AND: start from the rarest word
+                totals = dict(per_term[0])
+                for scores in per_term[1:]:
+                    totals = {name: total + scores[name]
+                              for name, total in totals.items() if name in scores}
+                ranked = sorted(totals.items(), key=lambda item: (-item[1], item[0]))
+            self._results[key] = ranked
+            while len(self._results) > KEEP_RESULTS:
+                self._results.popitem(last=False)
+            return ranked
+
+    def stats(self):
+        return {"files": len(self.docs), "words": len(self.postings),
+                "version": self.version}
+
+def _base36(n):
+    digits = ''
+    while True:
+        n, r = divmod(n, 36)
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'[r] + digits
+        if not n:
+            return digits
+
+def export_index(items):
+    """Module: export_index: compact index for a saved gallery's search box
+    Words are sorted and space-separated; each has the numbers of the
+    figures containing it as base-36 gaps, which memesearch.js decodes
+    only for the words a search touches.
+    :param items: (filename, caption) pairs, in page order
+    :returns: JSON text, safe to put in a <script> element"""
+    names, postings = [], {}
+    for i, (name, caption) in enumerate(items):
+        names.append(name)
+        # Lowercased like the browser does, rather than casefolded
+        for word in set(_word.findall(f"{name} {caption or ''}".lower())):
+            postings.setdefault(word, []).append(i)
+    words = sorted(postings)
+    ids = [",".join(_base36(b - a) for a, b in zip([0] + postings[w], postings[w]))
+           for w in words]
+    data = json.dumps({"v": 1, "names": names, "words": " ".join(words), "ids": ids},
+                      ensure_ascii=False, separators=(',', ':'))
+    return data.replace('</', '<\\/')
+
+def embed(html_path):
+    """Module: embed: add or replace the prebuilt index in a saved gallery
+    :returns: number of figures indexed"""
+    from figs import parse_html
+    figures = parse_html(html_path)
+    tag = f'<script type="application/json" id="search-index">{export_index(figures.items())}</script>'
+    with open(html_path, encoding='utf-8') as f:
+        html = f.read()
+    old = re.compile(r'<script type="application/json" id="search-index">.*?</script>', re.S)
+    if old.search(html):
+        html = old.sub(lambda m: tag, html, count=1)
+    else:
+        # Before the scripts at the end, so they can read it
+        at = html.find('<script', html.rfind('</figure>'))
+        at = at if at >= 0 else html.rfind('</body>')
+        html = html[:at] + tag + '\n    ' + html[at:]
+    with open(html_path, 'w', encoding='utf-8') as f:
+        f.write(html)
+    return len(figures)
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def open_index(folder):
+    """Module: open_index: the shared SearchIndex for a folder"""
+    key = os.path.abspath(folder)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = SearchIndex()
+        return _indexes[key]
+
+if __name__ == "__main__":
+    # Search a gallery folder from the command line, or index a saved one
+    if len(sys.argv) == 3 and sys.argv[1] == '--embed':
+        print(f"indexed {embed(sys.argv[2])} figures in {sys.argv[2]}")
+        sys.exit(0)
+    if len(sys.argv) < 3:
+        print("Usage: python search.py <gallery folder> <query>\n"
+              "       python search.py --embed <saved index.html>")
+        sys.exit(1)
+    from captions import open_store
+    from scanner import MediaScanner
+    catalog = MediaScanner(sys.argv[1], watch=False)
+    catalog.scan()
+    index = open_index(sys.argv[1])
+    start = time.perf_counter()
+    index.refresh(catalog, open_store(sys.argv[1]))
+    built = time.perf_counter() - start
+    start = time.perf_counter()
+    results = index.search(" ".join(sys.argv[2:]))
+    print(f"indexed {index.stats()} in {built:.2f} s; "
+          f"{len(results)} results in {(time.perf_counter() - start) * 1e3:.1f} ms")
+    for name, score in results[:20]:
+        print(f"{score:6.2f} {name}")
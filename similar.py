@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""Module: similar
+Description: Near-duplicate images, by perceptual hash.
+
+Re-uploads, re-encodes and resizes of the same picture have different
+bytes but look alike. Each image gets two 64-bit perceptual hashes,
+computed with NumPy from its 320px thumbnail, many at a time: dHash (is
+each pixel of a 9x8 grey copy brighter than the one to its right) and
+pHash (are the lowest 8x8 frequencies of the DCT of a 32x32 grey copy
+above their median). Together they make a 128-bit key, and the number
+of differing bits (Hamming distance) says how alike two images are:
+0 for the same picture, under about 20 for near-duplicates, around 64
+for unrelated ones.
+
+Keys are kept in the caption store by content hash, so each file is
+hashed once, even when renamed. Multi-index hashing finds the images
+within a distance of one, or every pair of near-duplicates, without
+comparing every image with every other; that gives "find similar" and
+groups of duplicates."""
+import os
+import sys
+import time
+import itertools
+import threading
+import numpy as np
+from PIL import Image
+import thumbs
+
+# Hamming distance (of 128 bits) up to which images are near-duplicates
+RADIUS = int(os.environ.get('SIMILAR_RADIUS', 20))
+# Closer still, for copying a caption: re-encoded or resized copies are a
+# few bits apart, but one meme template with different text can be 7
+COPY_RADIUS = int(os.environ.get('COPY_RADIUS', 4))
+# Images hashed at a time
+BATCH = 256
+SIZE = 32
+PIECES = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_hashes (
+    hash TEXT PRIMARY KEY,
+    dhash INTEGER,
+    phash INTEGER
+);
+"""
+
+if hasattr(np, 'bitwise_count'):
+    popcount = np.bitwise_count
+else:
+    # NumPy before 2.0
+    _BITS = np.array([bin(i).count('1') for i in range(256)], np.uint8)
+
+    def popcount(a):
+        return _BITS[a.view(np.uint8)].reshape(*a.shape, 8).sum(axis=-1)
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II as a matrix, so a batch transforms with matmul"""
+    k = np.arange(n)[:, None]
+    m = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    m[0] /= np.sqrt(2)
+    return m.astype(np.float32)
+
+_DCT = _dct_matrix(SIZE)
+
+def _pack(bits):
+    """Rows of 64 booleans to Python ints"""
+    return [int.from_bytes(row.tobytes(), 'big') for row in np.packbits(bits, axis=1)]
+
+def dhash(small):
+    """Module: dhash: difference hashes of grey images
+    :param small: (n, 8, 9) array
+    :returns: list of 64-bit ints"""
+    bits = small[:, :, 1:] > small[:, :, :-1]
+    return _pack(bits.reshape(len(small), 64))
+
+def phash(grey):
+    """Module: phash: DCT hashes of grey images
+    :param grey: (n, 32, 32) array
+    :returns: list of 64-bit ints"""
+    low = (_DCT @ grey.astype(np.float32) @ _DCT.T)[:, :8, :8].reshape(len(grey), 64)
+    return _pack(low > np.median(low, axis=1, keepdims=True))
+
+def load(path):
+    """Grey 9x8 and 32x32 copies of an image, for hashing"""
+    with Image.open(path) as img:
+        img.draft('L', (SIZE * 4, SIZE * 4))
+        grey = img.convert('L')
+        return (np.asarray(grey.resize((9, 8), Image.BILINEAR)),
+                np.asarray(grey.resize((SIZE, SIZE), Image.BILINEAR)))
+
+def image_keys(paths):
+    """Module: image_keys: 128-bit keys (dHash, then pHash) of image files
+    :returns: list of ints, None for files that cannot be read"""
+    loaded, ok = [], []
+    for path in paths:
+        try:
+            loaded.append(load(path))
+            ok.append(True)
+        except (OSError, ValueError) as e:
+            print(f"Could not hash {path}: {e}")
+            ok.append(False)
+    keys = iter([])
+    if loaded:
+        small, grey = (np.stack(a) for a in zip(*loaded))
+        keys = iter([d << 64 | p for d, p in zip(dhash(small), phash(grey))])
+    return [next(keys) if good else None for good in ok]
+
+def distance(a, b):
+    """Number of differing bits"""
+    return (a ^ b).bit_count()
+
+def _signed(n):
+    """64-bit unsigned to SQLite's signed INTEGER, and back"""
+    return n - (1 << 64) if n >= 1 << 63 else n
+
+def _unsigned(n):
+    return n + (1 << 64) if n < 0 else n
+
+class MultiIndex:
+    """Module: MultiIndex: 128-bit keys searchable by Hamming distance
+    Multi-index hashing: keys are cut into PIECES pieces of 16 bits. Keys
+    within distance r of each other differ in at most r // PIECES bits of
+    at least one piece, so the candidates are the keys with a piece equal
+    to one of the query's with that many bits flipped. Each piece has a
+    table of keys by value for those lookups, and candidates are checked
+    with a vectorized popcount.
+    :param keys: list of 128-bit ints"""
+    def __init__(self, keys):
+        self.keys = _split(keys)
+        self.pieces = _pieces(self.keys)
+        # Rows of keys sorted by each piece, and where each value starts
+        self.order = np.argsort(self.pieces, axis=0, kind='stable')
+        self.starts = np.zeros((PIECES, (1 << 16) + 1), np.int64)
+        for j in range(PIECES):
+            np.cumsum(np.bincount(self.pieces[:, j], minlength=1 << 16),
+                      out=self.starts[j, 1:(1 << 16) + 1])
+
+    def _lookup(self, j, targets):
+        """Rows whose piece j equals each target, as (target number, row)"""
+        lo, hi = self.starts[j, targets], self.starts[j, targets + 1]
+        counts = hi - lo
+        src = np.repeat(np.arange(len(targets)), counts)
+        pos = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - lo, counts)
+        return src, self.order[pos, j]
+
+    def distances(self, a, b):
+        """Hamming distances of rows a to rows (or a key array) b"""
+        return popcount(self.keys[a] ^ b).sum(axis=-1)
+
+    def within(self, key, radius):
+        """Module: within: (rows, distances) of keys within radius of key"""
+        if not len(self.keys):
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+        query = _split([key])
+        pieces = _pieces(query)[0]
+        masks = _masks(radius // PIECES)
+        rows = np.unique(np.concatenate([
+            self._lookup(j, pieces[j] ^ masks)[1] for j in range(PIECES)]))
+        d = self.distances(rows, query[0])
+        return rows[d <= radius], d[d <= radius]
+
+    def pairs(self, radius):
+        """Module: pairs: (row, row) of every two keys within radius"""
+        masks = _masks(radius // PIECES)
+        found = []
+        for j in range(PIECES):
+            # A few flips at a time, to bound memory
+            for m in range(0, len(masks), 16):
+                targets = (self.pieces[:, j, None] ^ masks[None, m:m + 16]).ravel()
+                src, rows = self._lookup(j, targets)
+                src //= len(masks[m:m + 16])
+                keep = src < rows
+                src, rows = src[keep], rows[keep]
+                near = self.distances(src, self.keys[rows]) <= radius
+                found.append(np.stack([src[near], rows[near]], axis=1))
+        if not found:
+            return np.zeros((0, 2), np.int64)
+        return np.unique(np.concatenate(found), axis=0)
+
+def _split(keys):
+    """128-bit ints as rows of two uint64"""
+    return np.array([[key >> 64, key & (1 << 64) - 1] for key in keys],
+                    np.uint64).reshape(-1, 2)
+
+def _pieces(keys):
+    """Rows of two uint64 as rows of PIECES 16-bit values"""
+    shifts = np.array([48, 32, 16, 0], np.uint64)
+    return ((keys[:, :, None] >> shifts) & np.uint64(0xffff)).reshape(
+        -1, PIECES).astype(np.int64)
+
+def _masks(flips, bits=16):
+    """Every value of bits bits with at most flips bits set"""
+    out = [0]
+    for k in range(1, flips + 1):
+        out += [sum(1 << b for b in c) for c in itertools.combinations(range(bits), k)]
+    return np.array(out, np.int64)
+
+class SimilarImages:
+    """Module: SimilarImages: perceptual keys of a folder's images
+    :param store: CaptionStore of the folder; keys are kept in its database
+    :param cache_dir: thumbnail cache, where images are hashed from"""
+    def __init__(self, store, cache_dir):
+        self.store = store
+        self.cache_dir = cache_dir
+        # filename -> key, and key -> filenames with it
+        self.keys = {}
+        self.files = {}
+        self.stamps = {}
+        self.catalog_revision = None
+        self.version = 0
+        self._pending = {}
+        self._worker = None
+        self._index = None
+        self._lock = threading.RLock()
+        with self.db:
+            self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        return self.store.db
+
+    def _set(self, name, key):
+        self._forget(name)
+        self.keys[name] = key
+        self.files.setdefault(key, set()).add(name)
+        self.version += 1
+
+    def _forget(self, name):
+        key = self.keys.pop(name, None)
+        if key is not None:
+            self.files[key].discard(name)
+            if not self.files[key]:
+                del self.files[key]
+            self.version += 1
+
+    def index(self):
+        """MultiIndex of the keys and the key of each row, rebuilt after changes"""
+        with self._lock:
+            if self._index is None or self._index[0] != self.version:
+                keys = list(self.files)
+                self._index = (self.version, MultiIndex(keys), keys)
+            return self._index[1:]
+
+    def refresh(self, catalog):
+        """Module: refresh: hash new and changed images in the background
+        :param catalog: MediaScanner of the folder"""
+        with self._lock:
+            if catalog.revision == self.catalog_revision:
+                return self._start()
+            self.catalog_revision = catalog.revision
+            images = {name: (e.size, e.mtime_ns) for name, e in catalog.entries.items()
+                      if e.kind == 'image'}
+            for name in list(self.stamps):
+                if name not in images:
+                    del self.stamps[name]
+                    self._forget(name)
+                    self._pending.pop(name, None)
+            for name, stamp in images.items():
+                if self.stamps.get(name) != stamp:
+                    self.stamps[name] = stamp
+                    self._pending[name] = None
+            self._start()
+
+    def _start(self):
+        if self._pending and (self._worker is None or not self._worker.is_alive()):
+            self._worker = threading.Thread(target=self._hash_pending, daemon=True,
+                                            name="image-hashes")
+            self._worker.start()
+
+    def _hash_pending(self):
+        while True:
+            with self._lock:
+                names = list(self._pending)[:BATCH]
+                for name in names:
+                    del self._pending[name]
+            if not names:
+                return
+            try:
+                self._hash(names)
+            except Exception as e:
+                print(f"Could not hash images: {e}")
+                self._retry_later(names)
+
+    def _hash(self, names):
+        """Keys of files from the store, or from their thumbnails"""
+        digests = {}
+        for name in names:
+            try:
+                digests[name] = self.store.file_hash(name)
+            except OSError:
+                pass
+        known = {}
+        unique = sorted(set(digests.values()))
+        for i in range(0, len(unique), 500):
+            batch = unique[i:i + 500]
+            for digest, d, p in self.db.execute(
+                    'SELECT hash, dhash, phash FROM image_hashes WHERE hash IN '
+                    f'({",".join("?" * len(batch))})', batch):
+                known[digest] = _unsigned(d) << 64 | _unsigned(p)
+        todo = [d for d in unique if d not in known]
+        if todo:
+            source = {digest: name for name, digest in digests.items()}
+            paths = {}
+            for d in todo:
+                src = os.path.join(self.store.folder, source[d])
+                try:
+                    paths[d] = thumbs.get_thumb(self.cache_dir, src, d, thumbs.SIZES[0])
+                except thumbs.ERRORS as e:
+                    print(f"Could not hash {src}: {e}")
+            new = {d: key for d, key in zip(paths, image_keys(list(paths.values())))
+                   if key is not None}
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO image_hashes VALUES (?, ?, ?)',
+                                    ((d, _signed(key >> 64), _signed(key & (1 << 64) - 1))
+                                     for d, key in new.items()))
+            known.update(new)
+        with self._lock:
+            for name, digest in digests.items():
+                # Skip files that changed or went away meanwhile
+                if digest in known and name in self.stamps and name not in self._pending:
+                    self._set(name, known[digest])
+        self._retry_later([name for name in names if digests.get(name) not in known])
+
+    def _retry_later(self, names):
+        """Forget the stamps of files that could not be hashed, so the
+        next refresh after a change in the folder tries them again"""
+        with self._lock:
+            for name in names:
+                if name not in self._pending:
+                    self.stamps.pop(name, None)
+
+    def wait(self, timeout=None):
+        """Wait for images being hashed"""
+        worker = self._worker
+        if worker is not None:
+            worker.join(timeout)
+
+    def similar(self, name, radius=RADIUS):
+        """Module: similar: other images within radius of one
+        :returns: list of (filename, distance), closest first; None if the
+            image has not been hashed (yet)"""
+        with self._lock:
+            key = self.keys.get(name)
+            if key is None:
+                return None
+            index, keys = self.index()
+            rows, distances = index.within(key, radius)
+            found = [(other, int(d)) for row, d in zip(rows, distances)
+                     for other in self.files[keys[row]] if other != name]
+        return sorted(found, key=lambda item: (item[1], item[0]))
+
+    def clusters(self, radius=RADIUS):
+        """Module: clusters: groups of near-duplicate images
+        Images are grouped with every image within radius of them, so a
+        group can hold a chain of small changes.
+        :returns: list of sorted filename lists, largest group first"""
+        with self._lock:
+            index, keys = self.index()
+            parent = list(range(len(keys)))
+
+            def root(i):
+                while parent[i] != i:
+                    parent[i] = parent[parent[i]]
+                    i = parent[i]
+                return i
+
+            for a, b in index.pairs(radius).tolist():
+                a, b = root(a), root(b)
+                if a != b:
+                    parent[a] = b
+            groups = {}
+            for i, key in enumerate(keys):
+                groups.setdefault(root(i), []).extend(self.files[key])
+        found = [sorted(names) for names in groups.values() if len(names) > 1]
+        return sorted(found, key=lambda names: (-len(names), names[0]))
+
+    def stats(self):
+        return {"images": len(self.keys), "pending": len(self._pending),
+                "keys": len(self.files), "radius": RADIUS,
+                "copy_radius": COPY_RADIUS}
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def open_similar(store, cache_dir):
+    """Module: open_similar: the shared SimilarImages for a caption store"""
+    key = os.path.abspath(store.db_path)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = SimilarImages(store, cache_dir)
+        return _indexes[key]
+
+if __name__ == "__main__":
+    # Duplicate report for a folder
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python similar.py <gallery folder> [radius]")
+        sys.exit(1)
+    from captions import open_store, cache_path
+    from scanner import MediaScanner
+    folder = sys.argv[1]
+    radius = int(sys.argv[2]) if len(sys.argv) == 3 else RADIUS
+    catalog = MediaScanner(folder, watch=False)
+    catalog.scan()
+    index = SimilarImages(open_store(folder), cache_path(folder, thumbs.THUMB_DIR))
+    start = time.perf_counter()
+    index.refresh(catalog)
+    index.wait()
+    hashed = time.perf_counter() - start
+    start = time.perf_counter()
+    groups = index.clusters(radius)
+    print(f"{len(index.keys)} images hashed in {hashed:.2f} s; "
+          f"{len(groups)} groups of near-duplicates in "
+          f"{(time.perf_counter() - start) * 1e3:.1f} ms")
+    for names in groups:
+        print("  " + "  ".join(names))
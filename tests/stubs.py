@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Module: stubs
+Description: Tiny OpenAI-compatible servers for testing BackendPool.
+
+Each StubServer answers chat completions after a delay, streamed or not,
+lists its models and reports its slots in /props like llama-server. Run
+this module to spread a burst of requests over a few of them, one down:
+python tests/stubs.py 3"""
+import os
+import sys
+import json
+import time
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backends import BackendPool
+
+class StubServer(ThreadingHTTPServer):
+    """Module: StubServer: a tiny OpenAI-compatible server for trying out
+    BackendPool; answers after delay seconds and reports slots in /props"""
+    daemon_threads = True
+
+    def __init__(self, port=0, models=("stub-vision",), delay=0.2, slots=2):
+        super().__init__(('127.0.0.1', port), _StubHandler)
+        self.models = list(models)
+        self.delay = delay
+        self.slots = slots
+        self.served = 0
+        self.props = 0
+        self.url = f"http://127.0.0.1:{self.server_address[1]}/v1"
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def get_request(self):
+        conn, addr = super().get_request()
+        with self._connections_lock:
+            self._connections.add(conn)
+        return conn, addr
+
+    def shutdown_request(self, request):
+        with self._connections_lock:
+            self._connections.discard(request)
+        super().shutdown_request(request)
+
+    def stop(self):
+        """Stop as if the server died, dropping kept-alive connections too"""
+        self.shutdown()
+        self.server_close()
+        with self._connections_lock:
+            connections, self._connections = list(self._connections), set()
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.endswith('/models'):
+            self._reply({"object": "list", "data": [
+                {"id": m, "object": "model", "created": 0, "owned_by": "stub"}
+                for m in self.server.models]})
+        elif url.path == '/props':
+            self.server.props += 1
+            self._reply({"total_slots": self.server.slots,
+                         "model": parse_qs(url.query).get('model', [''])[0]})
+        else:
+            self._reply({"status": "ok"})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        self.server.served += 1
+        text = f"{body.get('model')} at port {self.server.server_address[1]}"
+        if not body.get('stream'):
+            time.sleep(self.server.delay)
+            self._reply({"id": "stub", "object": "chat.completion", "created": 0,
+                         "model": body.get('model'), "choices": [
+                             {"index": 0, "finish_reason": "stop", "message": {
+                                 "role": "assistant", "content": text}}]})
+            return
+        # The same delay, spread over the words as tokens
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        words = text.split(' ')
+        for i, word in enumerate(words):
+            time.sleep(self.server.delay / len(words))
+            chunk = {"id": "stub", "object": "chat.completion.chunk", "created": 0,
+                     "model": body.get('model'), "choices": [
+                         {"index": 0, "finish_reason": None,
+                          "delta": {"content": word if i == 0 else ' ' + word}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+if __name__ == "__main__":
+    # Spread a burst of requests over a few stub servers, one of them down
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    stubs = [StubServer(slots=2 + i) for i in range(count)]
+    pool = BackendPool([s.url for s in stubs] + ["http://127.0.0.1:9/v1"], "stub")
+    print("models:", pool.list_models(), "slots:", pool.slots("stub-vision"))
+    for workers in sorted({2, pool.slots("stub-vision")}):
+        for s in stubs:
+            s.served = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(workers) as threads:
+            list(threads.map(lambda _: pool.create("stub-vision", messages=[]), range(48)))
+        print(f"{workers} workers: 48 requests in {time.perf_counter() - start:.2f} s, "
+              f"per endpoint {[s.served for s in stubs]}")
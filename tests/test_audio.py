@@ -0,0 +1,76 @@
+"""Cutting recordings at pauses and captioning the chunks"""
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import audio
+
+sf = pytest.importorskip("soundfile")
+
+RATE = audio.RATE
+
+def recording(path, parts, rate=RATE):
+    """A WAV of tones and pauses, given as (seconds, loud) pairs"""
+    t = np.arange(int(sum(seconds for seconds, _ in parts) * rate)) / rate
+    samples = 0.3 * np.sin(2 * np.pi * 440 * t)
+    offset = 0
+    for seconds, loud in parts:
+        end = offset + int(seconds * rate)
+        if not loud:
+            samples[offset:end] = 0
+        offset = end
+    sf.write(str(path), samples.astype(np.float32), rate)
+    return str(path)
+
+def chunks(path):
+    return [(start, len(samples) / RATE)
+            for start, samples in audio.split(audio.decode(path))]
+
+def test_split_cuts_in_pauses(tmp_path):
+    # Pauses at 18 s and 40 s, and a silent stretch that is dropped
+    path = recording(tmp_path / "talk.wav", [(18, True), (1, False), (21, True),
+                                             (1, False), (20, True), (35, False)])
+    found = chunks(path)
+    assert len(found) == 3
+    starts = [start for start, _ in found]
+    assert 18 < starts[1] < 19 and 40 < starts[2] < 41
+    assert all(seconds <= audio.MAX_CHUNK for _, seconds in found)
+
+def test_split_cuts_at_max_chunk_without_a_pause(tmp_path):
+    found = chunks(recording(tmp_path / "drone.wav", [(70, True)]))
+    assert [start for start, _ in found] == [0, audio.MAX_CHUNK, 2 * audio.MAX_CHUNK]
+
+def test_chunks_in_flight_are_capped(tmp_path):
+    path = recording(tmp_path / "long.wav", [(150, True)])
+    lock = threading.Lock()
+    state = {"now": 0, "most": 0}
+
+    def describe(wav):
+        with lock:
+            state["now"] += 1
+            state["most"] = max(state["most"], state["now"])
+        time.sleep(0.05)
+        with lock:
+            state["now"] -= 1
+        return "tone"
+
+    text = audio.caption_audio(path, describe, workers=2, merge='timestamps')
+    assert text.count("tone") == 5
+    assert state["most"] == 2
+
+def test_first_failure_stops_the_rest(tmp_path):
+    path = recording(tmp_path / "long.wav", [(150, True)])
+    calls = []
+
+    def describe(wav):
+        calls.append(len(wav))
+        if len(calls) == 1:
+            raise RuntimeError("backend down")
+        time.sleep(0.05)
+        return "tone"
+
+    with pytest.raises(RuntimeError, match="backend down"):
+        audio.caption_audio(path, describe, workers=1)
+    assert len(calls) == 1
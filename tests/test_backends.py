@@ -0,0 +1,104 @@
+"""BackendPool routing over local StubServers"""
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import backends
+from backends import BackendPool, NoEndpoint
+from stubs import StubServer
+
+MODEL = "stub-vision"
+
+def port(server):
+    return server.server_address[1]
+
+@pytest.fixture
+def stubs():
+    servers = [StubServer(models=(MODEL, "stub-audio"), delay=0.05, slots=1),
+               StubServer(models=(MODEL,), delay=0.05, slots=3)]
+    yield servers
+    for server in servers:
+        try:
+            server.stop()
+        except OSError:
+            pass
+
+@pytest.fixture
+def pool(stubs):
+    changes = []
+    pool = BackendPool([s.url for s in stubs], "sk-test",
+                       on_change=lambda: changes.append(pool.models()))
+    pool.changes = changes
+    assert pool.list_models() == ["stub-audio", MODEL]
+    return pool
+
+def endpoint_of(client):
+    return str(client.base_url).rstrip('/')
+
+def test_least_loaded_endpoint_is_chosen(stubs, pool):
+    assert pool.slots(MODEL) == 4
+    a, b = stubs[0].url, stubs[1].url
+    chosen = []
+    with ExitStack() as held:
+        for _ in range(5):
+            chosen.append(endpoint_of(held.enter_context(pool.client(MODEL))))
+        # a has 1 slot and b has 3, so b takes three of the first four
+        assert chosen[:4] == [a, b, b, b]
+        assert [e.inflight for e in pool.endpoints] == [2, 3]
+    assert [e.inflight for e in pool.endpoints] == [0, 0]
+
+def test_slots_are_read_once_per_health_check(stubs, pool):
+    for _ in range(3):
+        assert pool.slots(MODEL) == 4
+    assert [s.props for s in stubs] == [1, 1]
+    pool.check_all()
+    assert pool.slots(MODEL) == 4
+    assert [s.props for s in stubs] == [2, 2]
+
+def test_concurrent_requests_spread_by_slots(stubs, pool):
+    pool.slots(MODEL)
+    with ThreadPoolExecutor(8) as threads:
+        replies = list(threads.map(
+            lambda _: pool.create(MODEL, messages=[]).choices[0].message.content,
+            range(24)))
+    assert all(reply.startswith(MODEL) for reply in replies)
+    assert stubs[0].served + stubs[1].served == 24
+    assert stubs[1].served > stubs[0].served > 0
+
+def test_failover_and_recovery(stubs, pool):
+    a, b = stubs
+    # Keep a connection alive to each, then take a down while it is next
+    assert a.served == b.served == 0
+    pool.create(MODEL, messages=[])
+    pool.create(MODEL, messages=[])
+    assert a.served == b.served == 1
+    a.stop()
+    reply = pool.create(MODEL, messages=[]).choices[0].message.content
+    assert str(port(b)) in reply
+    assert pool.endpoints[0].healthy is False
+    assert "".join(pool.stream(MODEL, messages=[])).endswith(str(port(b)))
+    # Models only a hosted are gone once the health check runs
+    pool.check_all()
+    assert pool.models() == [MODEL]
+    assert pool.changes[-1] == [MODEL]
+    with pytest.raises(NoEndpoint):
+        pool.create("stub-audio", messages=[])
+
+    # Back on the same port: healthy again after the next check
+    stubs[0] = StubServer(port=port(a), models=(MODEL, "stub-audio"), delay=0.05)
+    pool.check_all()
+    assert pool.endpoints[0].healthy is True
+    assert pool.changes[-1] == ["stub-audio", MODEL]
+    assert str(port(a)) in pool.create("stub-audio", messages=[]).choices[0].message.content
+    for _ in range(4):
+        pool.create(MODEL, messages=[])
+    assert stubs[0].served >= 2
+
+def test_all_down(stubs, pool):
+    for server in stubs:
+        server.stop()
+    with pytest.raises(NoEndpoint):
+        pool.create(MODEL, messages=[])
+    with pytest.raises(ConnectionError):
+        pool.list_models()
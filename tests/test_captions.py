@@ -0,0 +1,59 @@
+"""CaptionStore syncing with its folder"""
+import shutil
+import threading
+
+from PIL import Image
+
+import captions
+from captions import CaptionStore, content_hash
+
+def image(path, color):
+    Image.new("RGB", (32, 24), color).save(path)
+    return str(path)
+
+def test_new_files_are_imported_in_the_background(tmp_path):
+    for name, color in (("a.png", "red"), ("b.png", "blue")):
+        image(tmp_path / name, color)
+    store = CaptionStore(str(tmp_path))
+    added = []
+    assert store.sync(["a.png", "b.png"], on_added=added.extend) == 2
+    store.wait(30)
+    assert sorted(added) == ["a.png", "b.png"]
+    assert store.file_hash("a.png") == content_hash(str(tmp_path / "a.png"))
+
+    # A copy gets the caption by hash; a deleted file's row goes
+    store.set("a.png", "a red square")
+    shutil.copy(tmp_path / "a.png", tmp_path / "c.png")
+    (tmp_path / "b.png").unlink()
+    store.sync(["a.png", "c.png"], complete=True)
+    store.wait(30)
+    assert store.get_details(["a.png", "b.png", "c.png"]) == {
+        "a.png": ("a red square", "user", None),
+        "c.png": ("a red square", "user", None)}
+
+def test_caption_set_while_hashing_is_kept(tmp_path, monkeypatch):
+    image(tmp_path / "a.png", "red")
+    store = CaptionStore(str(tmp_path))
+    hashing, resume = threading.Event(), threading.Event()
+    real_hash = captions.content_hash
+    threads = []
+
+    def slow_hash(path):
+        threads.append(threading.current_thread())
+        hashing.set()
+        resume.wait(10)
+        return real_hash(path)
+
+    monkeypatch.setattr(captions, "content_hash", slow_hash)
+    store.sync(["a.png"])
+    assert hashing.wait(10)
+    # Not in the caller's thread, which may be serving a request
+    assert threading.current_thread() not in threads
+    store.set("a.png", "typed while it was hashed")
+    resume.set()
+    store.wait(30)
+    assert store.get_details(["a.png"]) == {
+        "a.png": ("typed while it was hashed", "user", None)}
+    # Hashed all the same, so the next sync finds it up to date
+    assert store.sync(["a.png"]) == 0
+    assert store._pending == {}
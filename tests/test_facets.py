@@ -0,0 +1,45 @@
+"""Cursors over facet views"""
+import base64
+import json
+
+import pytest
+
+from facets import encode_cursor, decode_cursor
+
+def raw(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+@pytest.mark.parametrize("sort, position", [
+    ("name", ["cat.jpg", "Cat.jpg"]),
+    ("date", [1.7e18, "cat.jpg"]),
+    ("model", [float("inf"), "cat.jpg"]),
+    (None, [400]),
+])
+def test_cursor_round_trip(sort, position):
+    assert decode_cursor(encode_cursor(position), sort) == tuple(position)
+
+def test_whole_number_keys_are_floats():
+    key, name = decode_cursor(raw([3, "a.png"]), "size")
+    assert type(key) is float and name == "a.png"
+
+@pytest.mark.parametrize("sort, cursor", [
+    ("type", raw(5)),
+    ("type", raw({"key": 1})),
+    ("type", raw([1.0])),
+    ("type", raw([1.0, "a.png", "b.png"])),
+    ("type", raw(["x", "y"])),
+    ("type", raw([True, "a.png"])),
+    ("type", raw([1.0, 2])),
+    # A name cursor used with another sort, and the other way round
+    ("type", encode_cursor(["a.png", "a.png"])),
+    ("name", encode_cursor([1.0, "a.png"])),
+    (None, raw(["10"])),
+    (None, raw([-1])),
+    (None, raw(5)),
+    ("name", "not base64!"),
+    ("name", base64.urlsafe_b64encode(b"[1,").decode()),
+    ("name", base64.urlsafe_b64encode(b"\xff\xfe").decode()),
+])
+def test_malformed_cursor_is_rejected(sort, cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, sort)
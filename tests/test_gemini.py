@@ -0,0 +1,91 @@
+"""GeminiFiles against FakeGenai"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import gemini
+from gemini import GeminiFiles, FakeGenai
+
+@pytest.fixture
+def photo(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(b"not really a photo")
+    return str(path)
+
+def test_upload_is_reused(tmp_path, photo):
+    fake = FakeGenai(delay=0)
+    files = GeminiFiles(fake, str(tmp_path / "gemini.db"))
+    first = files.get(photo)
+    assert files.get(photo) is first
+    assert fake.calls == 1
+    assert files.stats() == {"uploads": 1, "reuses": 1}
+    # Another process finds the upload in the database
+    again = GeminiFiles(fake, str(tmp_path / "gemini.db"))
+    assert again.get(photo).name == first.name
+    assert fake.calls == 1
+
+def test_expired_upload_is_sent_again(tmp_path, photo, monkeypatch):
+    monkeypatch.setattr(gemini, "EXPIRY_MARGIN", 0)
+    fake = FakeGenai(delay=0, ttl=0.2)
+    files = GeminiFiles(fake, str(tmp_path / "gemini.db"))
+    first = files.get(photo)
+    time.sleep(0.3)
+    second = files.get(photo)
+    assert second.name != first.name
+    assert fake.calls == 2
+    assert files.stats() == {"uploads": 2, "reuses": 0}
+
+def test_upload_gone_from_api_is_sent_again(tmp_path, photo):
+    fake = FakeGenai(delay=0)
+    first = GeminiFiles(fake, str(tmp_path / "gemini.db")).get(photo)
+    del fake.uploaded[first.name]
+    files = GeminiFiles(fake, str(tmp_path / "gemini.db"))
+    assert files.get(photo).name != first.name
+    assert fake.calls == 2
+
+def test_concurrent_callers_share_one_upload(tmp_path, photo):
+    fake = FakeGenai(delay=0.2)
+    files = GeminiFiles(fake, str(tmp_path / "gemini.db"))
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: files.get(photo), range(8)))
+    assert fake.calls == 1
+    assert all(file is results[0] for file in results)
+    assert files.stats() == {"uploads": 1, "reuses": 7}
+    assert files._pending == {}
+
+def test_failed_upload_is_retried(tmp_path, photo):
+    fake = FakeGenai(delay=0)
+    upload, failures = fake.upload_file, [ConnectionError("network down")]
+    def flaky(path):
+        if failures:
+            raise failures.pop()
+        return upload(path)
+    fake.upload_file = flaky
+    files = GeminiFiles(fake, str(tmp_path / "gemini.db"))
+    with pytest.raises(ConnectionError):
+        files.get(photo)
+    assert files._pending == {}
+    assert files.get(photo).name == "files/1"
+
+def test_generate_reuses_the_upload(tmp_path, photo):
+    fake = FakeGenai(delay=0)
+    files = GeminiFiles(fake, str(tmp_path / "gemini.db"))
+    assert files.generate("gemini-test", photo, "Describe") == f"gemini-test saw {photo}"
+    seen = []
+    streamed = files.generate("gemini-test", photo, "Describe", on_text=seen.append)
+    assert streamed.split() == ["gemini-test", "saw", photo]
+    assert seen[-1] == streamed and len(seen) == 3
+    assert fake.calls == 1
+
+def test_failed_generate_uploads_again(tmp_path, photo):
+    fake = FakeGenai(delay=0)
+    files = GeminiFiles(fake, str(tmp_path / "gemini.db"))
+    files.generate("gemini-test", photo, "Describe")
+    # Google dropped the upload before it was due to expire
+    fake.uploaded.clear()
+    with pytest.raises(PermissionError):
+        files.generate("gemini-test", photo, "Describe", on_text=lambda text: None)
+    assert files.files == {}
+    assert files.generate("gemini-test", photo, "Describe") == f"gemini-test saw {photo}"
+    assert fake.calls == 2
@@ -0,0 +1,103 @@
+"""Perceptual keys and the multi-index"""
+import os
+import random
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import similar
+from similar import MultiIndex, SimilarImages, distance
+from captions import CaptionStore, cache_path
+from scanner import MediaScanner
+import thumbs
+
+def planted_keys(count=600, seed=0):
+    """Random 128-bit keys, with near copies of some of them"""
+    rng = random.Random(seed)
+    keys = [rng.getrandbits(128) for _ in range(count)]
+    for _ in range(count // 2):
+        flips = rng.sample(range(128), rng.randint(0, 30))
+        keys.append(rng.choice(keys) ^ sum(1 << b for b in flips))
+    return keys
+
+@pytest.mark.parametrize("radius", [0, 7, 8, 20, 31])
+def test_within_matches_brute_force(radius):
+    keys = planted_keys()
+    index = MultiIndex(keys)
+    for query in keys[::37] + [random.Random(1).getrandbits(128)]:
+        rows, distances = index.within(query, radius)
+        expected = {i: distance(query, key) for i, key in enumerate(keys)
+                    if distance(query, key) <= radius}
+        assert dict(zip(rows.tolist(), distances.tolist())) == expected
+
+@pytest.mark.parametrize("radius", [0, 8, 20])
+def test_pairs_match_brute_force(radius):
+    keys = planted_keys(300)
+    split = similar._split(keys)
+    d = similar.popcount(split[:, None, :] ^ split[None, :, :]).sum(axis=-1)
+    a, b = np.nonzero(np.triu(d <= radius, k=1))
+    assert sorted(map(tuple, MultiIndex(keys).pairs(radius).tolist())) == \
+        sorted(zip(a.tolist(), b.tolist()))
+
+def test_empty_index():
+    rows, distances = MultiIndex([]).within(0, 20)
+    assert len(rows) == len(distances) == 0
+
+def picture(path, seed, size=(200, 150), quality=90):
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, 255, (6, 8, 3), dtype=np.uint8)
+    Image.fromarray(blocks).resize(size, Image.BILINEAR).save(path, quality=quality)
+
+def test_unreadable_image_does_not_drop_the_batch(tmp_path):
+    picture(tmp_path / "a0.jpg", 1)
+    picture(tmp_path / "a1.jpg", 1, size=(160, 120), quality=60)
+    picture(tmp_path / "b.jpg", 2)
+    (tmp_path / "bad.jpg").write_bytes(b"not a jpeg")
+    catalog = MediaScanner(str(tmp_path), watch=False)
+    catalog.scan()
+    index = SimilarImages(CaptionStore(str(tmp_path)),
+                          cache_path(str(tmp_path), thumbs.THUMB_DIR))
+    index.refresh(catalog)
+    index.wait(30)
+    assert set(index.keys) == {"a0.jpg", "a1.jpg", "b.jpg"}
+    assert [name for name, _ in index.similar("a0.jpg")] == ["a1.jpg"]
+    assert index.similar("bad.jpg") is None
+    assert "bad.jpg" not in index.stamps
+    assert index.clusters() == [["a0.jpg", "a1.jpg"]]
+
+    # Tried again once the folder changes
+    picture(tmp_path / "bad.jpg", 3)
+    catalog.scan()
+    index.refresh(catalog)
+    index.wait(30)
+    assert "bad.jpg" in index.keys
+
+def meme(path, text, source):
+    """The dogs template with a top and bottom caption"""
+    image = Image.open(source).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    width, height = image.size
+    for y, line in ((10, text * 2), (height - height // 6, text)):
+        draw.text((10, y), line, fill="white", font_size=height // 8,
+                  stroke_width=3, stroke_fill="black")
+    image.save(path)
+
+def test_copy_radius_separates_copies_from_memes(tmp_path):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    source = os.path.join(root, "memes", "dogs.png")
+    Image.open(source).convert("RGB").save(tmp_path / "dogs.jpg", quality=70)
+    for i, text in enumerate(["WHEN THE MAIL ARRIVES", "ME ON MONDAY", "SO MUCH WOW"]):
+        meme(tmp_path / f"meme{i}.png", text, source)
+    Image.open(tmp_path / "meme0.png").save(tmp_path / "meme0.jpg", quality=80)
+    catalog = MediaScanner(str(tmp_path), watch=False)
+    catalog.scan()
+    index = SimilarImages(CaptionStore(str(tmp_path)),
+                          cache_path(str(tmp_path), thumbs.THUMB_DIR))
+    index.refresh(catalog)
+    index.wait(60)
+    # Same template, different text: related, but never given one caption
+    assert {"meme1.png", "meme2.png"} <= {name for name, _ in index.similar("dogs.jpg")}
+    for i in range(3):
+        copies = [name for name, _ in index.similar(f"meme{i}.png", similar.COPY_RADIUS)]
+        assert copies == (["meme0.jpg"] if i == 0 else [])
@@ -0,0 +1,131 @@
+"""update_models.py against a local stand-in for the Hub API"""
+import os
+import csv
+import json
+import sys
+import subprocess
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+import update_models
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "update_models.py")
+
+class FakeHub(ThreadingHTTPServer):
+    """Answers /api/models from a list of {"id", "tags", "lastModified"}"""
+    daemon_threads = True
+
+    def __init__(self, models):
+        super().__init__(('127.0.0.1', 0), _HubHandler)
+        self.models = models
+        self.queries = []
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+class _HubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.server.queries.append(query)
+        tag = query['filter'][0]
+        models = [m for m in self.server.models if tag in m['tags']]
+        key = 'lastModified' if query.get('sort') == ['lastModified'] else 'downloads'
+        models.sort(key=lambda m: m[key], reverse=True)
+        data = json.dumps([{k: m[k] for k in ('id', 'tags', 'lastModified')}
+                           for m in models]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def model(model_id, tag, day, downloads=0):
+    return {"id": model_id, "tags": [tag, "gguf"], "downloads": downloads,
+            "lastModified": f"2024-05-{day:02d}T00:00:00.000Z"}
+
+def run(output, hub, *args):
+    subprocess.run([sys.executable, SCRIPT, "-o", str(output), "--endpoint", hub.url,
+                    *args], check=True, capture_output=True,
+                   env=dict(os.environ, HF_HUB_OFFLINE="0", HF_HUB_DISABLE_TELEMETRY="1"))
+
+def read(output):
+    with open(output, newline="") as f:
+        return list(csv.reader(f))
+
+@pytest.fixture
+def hub():
+    server = FakeHub([model("a/vision", "image-text-to-text", 1, 30),
+                      model("b/vision", "image-text-to-text", 3, 20),
+                      model("c/audio", "audio-text-to-text", 2, 10),
+                      model("d/omni", "any-to-any", 4, 5)])
+    yield server
+    server.shutdown()
+
+def test_full_then_incremental(tmp_path, hub):
+    output = tmp_path / "models.csv"
+    run(output, hub)
+    rows = read(output)
+    assert rows[0] == update_models.HEADER
+    assert {row[0]: row[1] for row in rows[1:]} == {
+        "a/vision": "['image']", "b/vision": "['image']",
+        "c/audio": "['audio']", "d/omni": "['any']"}
+    # Most downloaded first within a category
+    assert [row[0] for row in rows[1:]].index("a/vision") < \
+        [row[0] for row in rows[1:]].index("b/vision")
+    first = [row[0] for row in rows[1:]]
+    state = json.loads((tmp_path / "models.state.json").read_text())
+    assert state["image-text-to-text"].startswith("2024-05-03")
+    assert state["audio-text-to-text"].startswith("2024-05-02")
+    assert "video-text-to-text" not in state
+
+    # One model changes its tags, one is new, the rest are older than the state
+    hub.models[0] = dict(model("a/vision", "image-text-to-text", 9, 30),
+                         tags=["image-text-to-text", "video-text-to-text"])
+    hub.models.append(model("e/video", "video-text-to-text", 8))
+    hub.queries.clear()
+    run(output, hub, "--incremental")
+    # Categories seen before ask for recent changes only
+    sorts = {q['filter'][0]: q['sort'][0] for q in hub.queries}
+    assert sorts["image-text-to-text"] == sorts["audio-text-to-text"] == "lastModified"
+    assert sorts["video-text-to-text"] == "downloads"
+    rows = read(output)
+    assert rows[0] == update_models.HEADER
+    # Changed models are updated in place, new ones appended
+    assert [row[0] for row in rows[1:]] == first + ["e/video"]
+    assert dict(rows[1:])["a/vision"] == "['image', 'video']"
+    assert rows[-1][1] == "['video']"
+    state = json.loads((tmp_path / "models.state.json").read_text())
+    assert state["image-text-to-text"].startswith("2024-05-09")
+    assert state["video-text-to-text"].startswith("2024-05-09")
+    assert state["audio-text-to-text"].startswith("2024-05-02")
+    # No part or temporary files are left behind
+    assert sorted(os.listdir(tmp_path)) == ["models.csv", "models.state.json"]
+
+def test_replace_is_atomic(tmp_path):
+    path = tmp_path / "models.csv"
+    path.write_text("old")
+    tmp = tmp_path / "models.csv.1.tmp"
+    tmp.write_text("new")
+    with open(path) as reader:
+        update_models._replace(str(tmp), str(path))
+        # An open reader keeps the whole old file; new opens see the new one
+        assert reader.read() == "old"
+    assert path.read_text() == "new"
+    assert not tmp.exists()
+
+def test_failed_fetch_keeps_old_file(tmp_path, hub):
+    output = tmp_path / "models.csv"
+    output.write_text("Model ID,Tags\nkept/model,['image']\n")
+    hub.shutdown()
+    hub.server_close()
+    with pytest.raises(subprocess.CalledProcessError):
+        run(output, hub)
+    assert read(output) == [update_models.HEADER, ["kept/model", "['image']"]]
+    assert os.listdir(tmp_path) == ["models.csv"]
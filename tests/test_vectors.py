@@ -0,0 +1,111 @@
+"""VectorIndex with stub_embed"""
+import os
+import json
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+import vectors
+from vectors import VectorIndex, stub_embed, normalize, open_vectors
+from captions import CaptionStore
+
+CAPTIONS = {
+    "dog.jpg": "a brown dog runs on the beach",
+    "cat.jpg": "a grey cat sleeps on a sofa",
+    "car.jpg": "a red car parked in the street",
+}
+
+Catalog = namedtuple('Catalog', 'entries revision')
+
+@pytest.fixture
+def index(tmp_path):
+    index = VectorIndex(str(tmp_path / "store.db"), stub_embed)
+    index.add(list(CAPTIONS), stub_embed(list(CAPTIONS.values())))
+    return index
+
+def test_add_remove_search(tmp_path, index):
+    assert index.search("dog on a beach")[0][0] == "dog.jpg"
+    assert index.search("sleepy cat")[0][0] == "cat.jpg"
+    index.remove(["dog.jpg"])
+    assert "dog.jpg" not in dict(index.search("dog on a beach"))
+    # A freed row is used again
+    free = index.free[-1]
+    index.add(["bike.jpg"], stub_embed(["a blue bike by a wall"]))
+    assert index.rows["bike.jpg"] == free
+    assert index.search("blue bike")[0][0] == "bike.jpg"
+    # Replacing a vector keeps its row
+    index.add(["car.jpg"], stub_embed(["a yellow taxi"]))
+    assert index.rows["car.jpg"] == 2
+    assert index.search("yellow taxi")[0][0] == "car.jpg"
+
+    again = VectorIndex(str(tmp_path / "store.db"), stub_embed)
+    assert again.search("blue bike")[0][0] == "bike.jpg"
+    assert set(again.rows) == {"cat.jpg", "car.jpg", "bike.jpg"}
+    # Another model starts over
+    other = VectorIndex(str(tmp_path / "store.db"), stub_embed, model="other")
+    assert other.count == 0 and other.search("blue bike") == []
+
+def test_header_is_replaced_whole(tmp_path, index):
+    index.add([f"{i}.jpg" for i in range(2000)], np.ones((2000, vectors.STUB_DIM)))
+    assert index.matrix.shape[0] == 2048
+    with open(tmp_path / "store.vec.json") as f:
+        assert json.load(f) == {"model": "stub", "dim": vectors.STUB_DIM, "capacity": 2048}
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+def test_exact_search_in_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(vectors, "SCORE_BLOCK", 100)
+    rng = np.random.default_rng(0)
+    data = normalize(rng.standard_normal((1050, 32)))
+    index = VectorIndex(str(tmp_path / "store.db"))
+    index.add([f"{i}.jpg" for i in range(len(data))], data)
+    index.remove(["7.jpg"])
+    stored = np.asarray(index.matrix[:len(data)], np.float32)
+    for query in normalize(rng.standard_normal((5, 32))):
+        rows, scores = index.search_vector(query, 10)
+        expected = np.argsort(-(stored @ query))
+        expected = expected[expected != 7][:10]
+        assert list(rows) == list(expected)
+        assert np.allclose(scores, stored[rows] @ query)
+
+def test_ivf_recall(tmp_path):
+    rng = np.random.default_rng(1)
+    data = vectors.clustered(20000, 64, 40, rng)
+    index = VectorIndex(str(tmp_path / "store.db"), threshold=10000)
+    index.add([f"{i}.jpg" for i in range(len(data))], data)
+    index.train()
+    assert index._ivf is not None
+    probes = normalize(data[rng.choice(len(data), 50)]
+                       + rng.standard_normal((50, 64)) * 0.75 / 8)
+    recall = np.mean([len(set(index.search_vector(q, 10)[0])
+                          & set(index.search_vector(q, 10, exact=True)[0])) / 10
+                      for q in probes])
+    assert recall >= 0.9
+
+def test_refresh_embeds_captions(tmp_path):
+    folder = tmp_path / "gallery"
+    folder.mkdir()
+    store = CaptionStore(str(folder))
+    for name, caption in CAPTIONS.items():
+        (folder / name).write_bytes(name.encode())
+        store.set(name, caption)
+    catalog = Catalog({name: None for name in CAPTIONS}, 1)
+    index = VectorIndex(store.db_path, stub_embed)
+    index.refresh(catalog, store)
+    index._worker.join(10)
+    assert index.count == 3
+    store.set("car.jpg", "a white boat on a lake")
+    index.refresh(catalog, store)
+    index._worker.join(10)
+    assert index.search("boat on a lake")[0][0] == "car.jpg"
+    store.set("cat.jpg", "")
+    index.refresh(catalog, store)
+    assert "cat.jpg" not in index.rows
+
+def test_open_vectors_per_model(tmp_path):
+    path = str(tmp_path / "store.db")
+    first = open_vectors(path, stub_embed, "a")
+    assert open_vectors(path, stub_embed, "a") is first
+    second = open_vectors(path, stub_embed, "b")
+    assert second is not first and second.model == "b"
+    assert open_vectors(path, stub_embed, "b") is second
@@ -0,0 +1,52 @@
+"""Keyframes of small generated clips"""
+import numpy as np
+import pytest
+from PIL import Image
+
+import video
+
+def make_clip(path, seconds=10, cut=5.0, frame_ms=250):
+    """An animated GIF: a drifting red scene, then a blue one from cut"""
+    frames = []
+    for i in range(int(seconds * 1000 / frame_ms)):
+        t = i * frame_ms / 1000
+        x = np.arange(64)[None, :, None]
+        base = np.array([200, 40, 40] if t < cut else [30, 60, 210])
+        pixels = np.clip(base + (x + i) % 16, 0, 255).astype(np.uint8)
+        frames.append(Image.fromarray(np.broadcast_to(pixels, (64, 64, 3)).copy()))
+    frames[0].save(path, save_all=True, append_images=frames[1:],
+                   duration=frame_ms, loop=0)
+    return str(path)
+
+@pytest.fixture
+def clip(tmp_path):
+    return make_clip(tmp_path / "clip.gif")
+
+def test_select_keyframes_finds_the_cut(clip):
+    times, hists = zip(*video.scan(clip))
+    assert len(times) > video.MAX_FRAMES
+    # The cut is the biggest change, so it is kept first
+    assert video.select_keyframes(times, hists, max_frames=2) == [0.0, 5.0]
+    wanted = video.select_keyframes(times, hists)
+    assert 5.0 in wanted
+    assert len(wanted) == video.MAX_FRAMES
+    assert wanted == sorted(wanted)
+
+def test_select_keyframes_without_cuts_spreads_out():
+    times = [i / 2 for i in range(40)]
+    hists = [np.full(3 * video.BINS, 1 / video.BINS)] * 40
+    wanted = video.select_keyframes(times, hists, max_frames=4)
+    assert wanted[0] == 0.0 and len(wanted) == 4
+    assert all(b - a >= 3 for a, b in zip(wanted, wanted[1:]))
+
+def test_keyframes_are_cached(clip, tmp_path, monkeypatch):
+    cache = tmp_path / "cache"
+    frames = video.keyframes(clip, "ab" * 16, str(cache))
+    assert 5.0 in [t for t, _ in frames]
+    assert all(data[:2] == b"\xff\xd8" for _, data in frames)
+    # A second call reads the cache instead of the video
+    monkeypatch.setattr(video, "scan", lambda *args: pytest.fail("scanned again"))
+    assert video.keyframes(clip, "ab" * 16, str(cache)) == frames
+    # Other sampling settings are cached separately
+    with pytest.raises(pytest.fail.Exception):
+        video.keyframes(clip, "ab" * 16, str(cache), max_frames=4)
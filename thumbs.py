@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Module: thumbs
+Description: Thumbnails for the gallery page.
+
+Images are shrunk to 320px (gallery) and 640px (hover) wide, with EXIF
+orientation applied, and saved as WebP (or JPEG if Pillow lacks WebP) in
+a content-addressed cache, .thumbs in the gallery folder. JPEGs are
+decoded in draft mode, which skips most of the full-resolution decode.
+Thumbnails for new files are made ahead of time in a process pool."""
+import os
+import sys
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps, features
+
+SIZES = (320, 640)
+THUMB_DIR = '.thumbs'
+FORMAT = 'WEBP' if features.check('webp') else 'JPEG'
+EXT = '.webp' if FORMAT == 'WEBP' else '.jpg'
+MIMETYPE = 'image/webp' if FORMAT == 'WEBP' else 'image/jpeg'
+QUALITY = 80
+# Animated GIFs would lose their animation; serve them as they are.
+PASSTHROUGH = ('.gif',)
+# What PIL raises for unreadable, corrupt or enormous images
+ERRORS = (OSError, Image.DecompressionBombError)
+
+def thumb_path(cache_dir, digest, size):
+    """Content-addressed location: .thumbs/ab/abcdef...-320.webp"""
+    return os.path.join(cache_dir, digest[:2], f"{digest}-{size}{EXT}")
+
+def make_thumbs(src, cache_dir, digest, sizes=SIZES):
+    """Module: make_thumbs: write the missing thumbnails of one image
+    :param src: original image
+    :param cache_dir: thumbnail cache directory
+    :param digest: content hash of src
+    :returns: list of thumbnail paths"""
+    todo = [s for s in sizes if not os.path.exists(thumb_path(cache_dir, digest, s))]
+    if todo:
+        with Image.open(src) as img:
+            # Let the JPEG decoder scale down by up to 8x while decoding
+            largest = max(todo)
+            img.draft('RGB', (largest, largest))
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+            if FORMAT == 'JPEG' and img.mode != 'RGB':
+                img = img.convert('RGB')
+            os.makedirs(os.path.dirname(thumb_path(cache_dir, digest, largest)), exist_ok=True)
+            for size in sorted(todo, reverse=True):
+                img.thumbnail((size, size * 8), Image.LANCZOS)
+                dst = thumb_path(cache_dir, digest, size)
+                tmp = f"{dst}.{os.getpid()}.tmp"
+                img.save(tmp, FORMAT, quality=QUALITY)
+                os.replace(tmp, dst)
+    return [thumb_path(cache_dir, digest, s) for s in sizes]
+
+_pool = None
+_pool_lock = threading.Lock()
+_queued = set()
+
+def _get_pool():
+    """Worker processes are started lazily, once"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # forkserver avoids forking a multithreaded web server
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context(method))
+        return _pool
+
+def _done(key, future):
+    _queued.discard(key)
+    if future.exception():
+        print(f"Thumbnail error for {key[0]}: {future.exception()}")
+
+def pregenerate(cache_dir, items):
+    """Module: pregenerate: make thumbnails in the background
+    :param cache_dir: thumbnail cache directory
+    :param items: iterable of (image path, content hash)"""
+    pool = None
+    for src, digest in items:
+        if src.lower().endswith(PASSTHROUGH):
+            continue
+        if all(os.path.exists(thumb_path(cache_dir, digest, s)) for s in SIZES):
+            continue
+        key = (src, digest)
+        if key in _queued:
+            continue
+        _queued.add(key)
+        pool = pool or _get_pool()
+        pool.submit(make_thumbs, src, cache_dir, digest).add_done_callback(
+            lambda future, key=key: _done(key, future))
+
+def get_thumb(cache_dir, src, digest, size):
+    """Module: get_thumb: path of a thumbnail, made now if it is missing"""
+    path = thumb_path(cache_dir, digest, size)
+    if not os.path.exists(path):
+        make_thumbs(src, cache_dir, digest)
+    return path
+
+if __name__ == "__main__":
+    from captions import content_hash, cache_path
+    from scanner import MediaScanner
+    folder = sys.argv[1] if len(sys.argv) > 1 else '.'
+    scanner = MediaScanner(folder, watch=False)
+    scanner.scan()
+    cache_dir = cache_path(folder, THUMB_DIR)
+    start = time.perf_counter()
+    with _get_pool() as pool:
+        jobs = [pool.submit(make_thumbs, os.path.join(folder, f), cache_dir,
+                            content_hash(os.path.join(folder, f)))
+                for f in scanner.files('image') if not f.lower().endswith(PASSTHROUGH)]
+        for job in jobs:
+            job.result()
+    print(f"{len(jobs)} images in {time.perf_counter() - start:.2f} s, cache in {cache_dir}")
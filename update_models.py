@@ -1,39 +1,178 @@
 #!/usr/bin/env python3
+"""Module: update_models
+Description: Build models.csv, the capability list used by look_up_model.py.
+
+A full rebuild lists the most downloaded models in each category. With
+--incremental, only models modified since the last run are fetched and
+merged into the existing file. The four category queries run concurrently
+and stream rows to disk, and the result replaces models.csv atomically, so
+a running server never reads a half-written file."""
+import os
 import csv
+import json
+import shutil
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+# Install requirement: pip install huggingface_hub
 from huggingface_hub import HfApi
 
-def generate_gguf_multimodal_csv(output_file="models.csv"):
-    api = HfApi()
-
-    # Target tasks and the 'gguf' library filter
-    categories = [
-        "audio-text-to-text",
-        "image-text-to-text",
-        "video-text-to-text",
-        "any-to-any"
-    ]
-
-    category_data = {}
-    models = []
-    for tag in categories:
-        models += api.list_models(
-            filter=tag,
-            sort="downloads",
-            direction=-1,
-            limit=5000
-        )
-
-    # Write to CSV
-    with open(output_file, mode="w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["Model ID", "Tags"])
-        for model in models:
-            writer.writerow([model.id,
-            [t.split('-')[0] for t in model.tags
-            if 'text-to-text' in t or 'any-to-any' in t]])
+# Target tasks
+CATEGORIES = [
+    "audio-text-to-text",
+    "image-text-to-text",
+    "video-text-to-text",
+    "any-to-any"
+]
+HEADER = ["Model ID", "Tags"]
+EXPAND = ["tags", "lastModified"]
+
+def state_path(output_file):
+    """Per-category last-modified markers are kept next to the CSV"""
+    return os.path.splitext(output_file)[0] + ".state.json"
+
+def load_state(output_file):
+    try:
+        with open(state_path(output_file), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _replace(tmp, path):
+    """Flush tmp to disk and move it over path in one step"""
+    with open(tmp, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def save_state(output_file, state):
+    path = state_path(output_file)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=2)
+    _replace(tmp, path)
+
+def model_caps(model):
+    """Capability tags, e.g. ['image'], from a model's pipeline tags"""
+    return [t.split('-')[0] for t in (model.tags or [])
+            if 'text-to-text' in t or 'any-to-any' in t]
+
+def _stamp(model):
+    last = getattr(model, "last_modified", None)
+    return last.isoformat() if last else None
+
+def _newer(stamp, since):
+    return since is None or (stamp is not None and
+        datetime.fromisoformat(stamp) > datetime.fromisoformat(since))
+
+def fetch_category(api, tag, writer, since=None, limit=5000):
+    """Module: fetch_category: stream one category's rows to a CSV writer
+    :param api: HfApi, or anything with a compatible list_models()
+    :param tag: pipeline tag, e.g. image-text-to-text
+    :param writer: csv.writer receiving [model id, tags] rows
+    :param since: ISO last-modified marker; stop at models not newer
+    :param limit: maximum number of models to fetch
+    :returns: (rows written, newest last-modified stamp seen)"""
+    if since is None:
+        models = api.list_models(filter=tag, sort="downloads", direction=-1,
+                                 limit=limit, expand=EXPAND)
+    else:
+        models = api.list_models(filter=tag, sort="last_modified", direction=-1,
+                                 limit=limit, expand=EXPAND)
+    count, newest = 0, None
+    for model in models:
+        stamp = _stamp(model)
+        if since is not None and not _newer(stamp, since):
+            break
+        if stamp and _newer(stamp, newest):
+            newest = stamp
+        writer.writerow([model.id, model_caps(model)])
+        count += 1
+    return count, newest
+
+def _fetch_part(api, tag, part, since, limit):
+    with open(part, "w", newline="") as f:
+        return fetch_category(api, tag, csv.writer(f), since, limit)
+
+def _fetch_all(api, parts, state, incremental, limit):
+    """Run the category queries concurrently, each into its own part file"""
+    with ThreadPoolExecutor(max_workers=len(CATEGORIES)) as pool:
+        futures = {tag: pool.submit(_fetch_part, api, tag, parts[tag],
+                                    state.get(tag) if incremental else None,
+                                    limit)
+                   for tag in CATEGORIES}
+        results = {tag: future.result() for tag, future in futures.items()}
+    for tag, (count, newest) in results.items():
+        print(f"{tag}: {count} models")
+        if newest and _newer(newest, state.get(tag)):
+            state[tag] = newest
+    return state
+
+def _read_deltas(parts):
+    """Models changed since the last run: {model id: tags row}, in order"""
+    deltas = {}
+    for tag in CATEGORIES:
+        with open(parts[tag], "r", newline="") as f:
+            for row in csv.reader(f):
+                deltas.setdefault(row[0], row)
+    return deltas
+
+def generate_gguf_multimodal_csv(output_file="models.csv", incremental=False,
+                                 api=None, limit=5000):
+    """Module: generate_gguf_multimodal_csv: rebuild or update models.csv
+    :param output_file: CSV to write
+    :param incremental: merge models modified since the last run
+    :param api: HfApi instance; pass HfApi(endpoint=...) to use a stand-in
+    :param limit: maximum models per category query"""
+    api = api or HfApi()
+    if incremental and not os.path.isfile(output_file):
+        print(f"{output_file} not found. Doing a full rebuild.")
+        incremental = False
+    state = load_state(output_file) if incremental else {}
+    tmp = f"{output_file}.{os.getpid()}.tmp"
+    parts = {tag: f"{tmp}.{tag}" for tag in CATEGORIES}
+    try:
+        state = _fetch_all(api, parts, state, incremental, limit)
+        with open(tmp, "w", newline="") as out:
+            writer = csv.writer(out)
+            writer.writerow(HEADER)
+            if incremental:
+                # Stream the existing catalog through, updating changed
+                # models in place, then append models we have not seen.
+                deltas = _read_deltas(parts)
+                with open(output_file, "r", newline="") as f:
+                    reader = csv.reader(f)
+                    next(reader, None)
+                    seen = set()
+                    for row in reader:
+                        seen.add(row[0])
+                        writer.writerow(deltas.get(row[0], row))
+                added = [row for model_id, row in deltas.items()
+                         if model_id not in seen]
+                writer.writerows(added)
+                print(f"{len(deltas) - len(added)} updated, {len(added)} added")
+            else:
+                for tag in CATEGORIES:
+                    with open(parts[tag], "r", newline="") as f:
+                        shutil.copyfileobj(f, out)
+        _replace(tmp, output_file)
+        save_state(output_file, state)
+    finally:
+        for path in [tmp] + list(parts.values()):
+            if os.path.exists(path):
+                os.remove(path)
 
     print(f"Successfully generated {output_file}.")
 
+def main():
+    parser = argparse.ArgumentParser(description="Build models.csv from the Hugging Face Hub")
+    parser.add_argument("-o", "--output", default="models.csv", help="CSV file to write")
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="only fetch models modified since the last run")
+    parser.add_argument("--limit", type=int, default=5000, help="models per category")
+    parser.add_argument("--endpoint", help="Hub API endpoint, e.g. a local stand-in")
+    args = parser.parse_args()
+    api = HfApi(endpoint=args.endpoint) if args.endpoint else None
+    generate_gguf_multimodal_csv(args.output, args.incremental, api, args.limit)
+
 if __name__ == "__main__":
-    # Install requirement: pip install huggingface_hub
-    generate_gguf_multimodal_csv()
+    main()
@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+"""Module: vectors
+Description: Semantic caption search with embeddings.
+
+Captions are turned into vectors by an embedding model (a local
+OpenAI-compatible /v1/embeddings endpoint, or stub_embed for trying
+things out), normalized, and kept as a float16 matrix in a memory-mapped
+file next to the caption store (.findaimage.vec), with the row of each
+file in the store's database. A query is embedded the same way and the
+captions closest in meaning are found with a few large dot products, so
+"puppy" finds a caption that says "dog".
+
+Up to IVF_THRESHOLD vectors every row is scored. Above it the vectors
+are grouped around k-means centroids (an inverted file), and only the
+groups nearest the query are scored. Captions are re-embedded in the
+background when they change; the groups are recomputed when the number
+of vectors has doubled or halved since. Run this module to benchmark
+latency and recall at 10k, 100k and 1M vectors."""
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from captions import connect
+
+# Vectors above which the inverted file is used
+IVF_THRESHOLD = 50000
+# Groups probed per query, as a share of all groups, and at least
+NPROBE_SHARE = 1 / 32
+NPROBE_MIN = 8
+KMEANS_ITERATIONS = 8
+# Vectors sampled to find the centroids, per centroid
+KMEANS_SAMPLE = 64
+# Rows handled at a time, to bound memory
+BLOCK = 65536
+# Rows converted from float16 and scored at a time when every row is
+# scored; small enough to stay in the CPU cache, and the matrix is never
+# copied as a whole
+SCORE_BLOCK = 2048
+# Captions embedded per request
+BATCH = 64
+STUB_DIM = 256
+# Captions edited this many seconds apart may commit out of order
+SKEW = 5
+KEEP_QUERIES = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vectors (
+    filename TEXT PRIMARY KEY,
+    row INTEGER,
+    digest TEXT
+);
+"""
+
+_word = re.compile(r'[^\W_]+')
+
+def stub_embed(texts, dim=STUB_DIM):
+    """Module: stub_embed: deterministic stand-in for an embedding model
+    Words are hashed into dim signed buckets, so texts sharing words are
+    close. Needs no server and gives the same vectors every run."""
+    out = np.zeros((len(texts), dim), np.float32)
+    for i, text in enumerate(texts):
+        for word in _word.findall(text.casefold()):
+            h = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), 'little')
+            out[i, h % dim] += 1.0 if (h >> 63) else -1.0
+    return out
+
+def normalize(vectors):
+    """Unit-length rows, so dot products are cosine similarities"""
+    vectors = np.asarray(vectors, np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def caption_digest(caption):
+    return hashlib.blake2b(caption.encode(), digest_size=8).hexdigest()
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first"""
+    if len(scores) > k:
+        part = np.argpartition(-scores, k)[:k]
+    else:
+        part = np.arange(len(scores))
+    return part[np.argsort(-scores[part], kind='stable')]
+
+def kmeans(sample, k, iterations=KMEANS_ITERATIONS, seed=0):
+    """Module: kmeans: k centroids of unit vectors (spherical k-means)"""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), k, replace=False)].copy()
+    for _ in range(iterations):
+        nearest = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, nearest, sample)
+        counts = np.bincount(nearest, minlength=k)
+        # Empty groups start again from a random vector
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+class VectorIndex:
+    """Module: VectorIndex: caption embeddings for one gallery folder
+    :param db_path: the caption store's database; the matrix goes next to it
+    :param embed: embed(texts) -> list of vectors, or None to only read
+    :param model: embedding model name; vectors are made again if it changes
+    :param threshold: vectors above which the inverted file is used"""
+    def __init__(self, db_path, embed=None, model='stub', threshold=IVF_THRESHOLD):
+        self.db_path = db_path
+        self.path = os.path.splitext(db_path)[0] + '.vec'
+        self.embed = embed
+        self.model = model
+        self.threshold = threshold
+        self.names = []
+        self.rows = {}
+        self.digests = {}
+        self.free = []
+        self.matrix = None
+        self.valid = np.zeros(0, bool)
+        self.version = 0
+        self.catalog_revision = None
+        self.store_revision = None
+        self.updated = 0
+        self.error = None
+        self._pending = {}
+        self._worker = None
+        self._ivf = None
+        self._queries = OrderedDict()
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        with self.db:
+            self.db.executescript(SCHEMA)
+        self._load()
+
+    @property
+    def db(self):
+        """One connection per thread"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = connect(self.db_path)
+        return db
+
+    def _load(self):
+        """Open the matrix, or start over if the model changed"""
+        try:
+            with open(self.path + '.json') as f:
+                header = json.load(f)
+        except (OSError, ValueError):
+            header = None
+        if header is None or header.get('model') != self.model:
+            with self.db:
+                self.db.execute('DELETE FROM vectors')
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        self.matrix = np.memmap(self.path, np.float16, 'r+',
+                                shape=(header['capacity'], header['dim']))
+        self.valid = np.zeros(header['capacity'], bool)
+        for name, row, digest in self.db.execute('SELECT filename, row, digest FROM vectors'):
+            self._claim(name, row)
+            self.digests[name] = digest
+        used = set(self.rows.values())
+        self.free = [row for row in range(len(self.names)) if row not in used]
+
+    def _claim(self, name, row):
+        while len(self.names) <= row:
+            self.names.append(None)
+        self.names[row] = name
+        self.rows[name] = row
+        self.valid[row] = True
+
+    def _grow(self, need, dim):
+        """Make room for need rows, doubling the file"""
+        capacity = 0 if self.matrix is None else self.matrix.shape[0]
+        if self.matrix is not None and self.matrix.shape[1] != dim:
+            raise ValueError(f"{self.model} gave {dim} numbers, not {self.matrix.shape[1]}")
+        if need <= capacity:
+            return
+        capacity = max(1024, capacity * 2, need)
+        if self.matrix is not None:
+            self.matrix.flush()
+        with open(self.path, 'ab') as f:
+            f.truncate(capacity * dim * 2)
+        self.matrix = np.memmap(self.path, np.float16, 'r+', shape=(capacity, dim))
+        valid = np.zeros(capacity, bool)
+        valid[:len(self.valid)] = self.valid
+        self.valid = valid
+        # Replaced in one step, so a crash never leaves half a header
+        tmp = f"{self.path}.json.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"model": self.model, "dim": dim, "capacity": capacity}, f)
+        os.replace(tmp, self.path + '.json')
+
+    def add(self, names, vectors, digests=None):
+        """Module: add: store vectors for files, replacing older ones"""
+        if not len(names):
+            return
+        vectors = normalize(vectors)
+        with self._lock:
+            rows, end = [], len(self.names)
+            for name in names:
+                row = self.rows.get(name)
+                if row is None and self.free:
+                    row = self.free.pop()
+                elif row is None:
+                    row, end = end, end + 1
+                rows.append(row)
+            self._grow(max(rows, default=-1) + 1, vectors.shape[1])
+            for name, row in zip(names, rows):
+                self._claim(name, row)
+            order = np.argsort(rows)
+            self.matrix[np.asarray(rows)[order]] = vectors[order]
+            if self._ivf is not None:
+                self._ivf.add(np.asarray(rows), vectors)
+            digests = digests or [None] * len(names)
+            for name, digest in zip(names, digests):
+                self.digests[name] = digest
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)',
+                                    zip(names, rows, digests))
+            self.version += 1
+
+    def remove(self, names):
+        """Forget the vectors of files"""
+        with self._lock:
+            gone = [name for name in names if name in self.rows]
+            for name in gone:
+                row = self.rows.pop(name)
+                self.names[row] = None
+                self.valid[row] = False
+                self.digests.pop(name, None)
+                self.free.append(row)
+            if gone:
+                with self.db:
+                    self.db.executemany('DELETE FROM vectors WHERE filename=?',
+                                        ((name,) for name in gone))
+                self.version += 1
+
+    def refresh(self, catalog, store):
+        """Module: refresh: embed new and changed captions in the background
+        :param catalog: MediaScanner, for the files in the folder
+        :param store: CaptionStore, for their captions"""
+        with self._lock:
+            catalog_revision, store_revision = catalog.revision, store.revision
+            if (catalog_revision, store_revision) == (self.catalog_revision,
+                                                      self.store_revision):
+                # Try again captions that could not be embedded
+                return self._start()
+            entries = catalog.entries
+            names = set()
+            if catalog_revision != self.catalog_revision:
+                self.remove([name for name in self.rows if name not in entries])
+                names |= entries.keys() - self.rows.keys()
+            if store_revision != self.store_revision:
+                changed, newest = store.changed_since(self.updated - SKEW)
+                names |= {name for name in changed if name in entries}
+                self.updated = max(self.updated, newest)
+            self.catalog_revision, self.store_revision = catalog_revision, store_revision
+        captions = store.get_many(sorted(names))
+        blank = []
+        with self._lock:
+            for name in names:
+                caption = (captions.get(name) or '').strip()
+                if not caption:
+                    blank.append(name)
+                elif self.digests.get(name) != caption_digest(caption):
+                    self._pending[name] = caption
+            self.remove(blank)
+            self._start()
+
+    def _start(self):
+        """Start the background worker, if there is work and it is not running"""
+        if (self._pending and self.embed or self._needs_training()) and (
+                self._worker is None or not self._worker.is_alive()):
+            self._worker = threading.Thread(target=self._embed_pending, daemon=True,
+                                            name="caption-embeddings")
+            self._worker.start()
+
+    def _embed_pending(self):
+        while True:
+            if self._needs_training():
+                self.train()
+            with self._lock:
+                batch = list(self._pending.items())[:BATCH]
+                if not batch or not self.embed:
+                    return
+            names, captions = zip(*batch)
+            try:
+                vectors = self.embed(list(captions))
+            except Exception as e:
+                print(f"Could not embed captions with {self.model}: {e}")
+                self.error = str(e)
+                return
+            self.error = None
+            with self._lock:
+                # Skip captions that changed again meanwhile
+                done = [i for i, name in enumerate(names)
+                        if self._pending.get(name) == captions[i]]
+                for i in done:
+                    del self._pending[names[i]]
+                self.add([names[i] for i in done], np.asarray(vectors)[done],
+                         [caption_digest(captions[i]) for i in done])
+
+    @property
+    def count(self):
+        return len(self.rows)
+
+    def _needs_training(self):
+        """Whether the inverted file is missing, or older than a doubling"""
+        if self._ivf is None:
+            return self.count >= self.threshold
+        return not self._ivf.trained / 2 <= self.count <= self._ivf.trained * 2
+
+    def train(self):
+        """Module: train: group the vectors for the inverted file"""
+        with self._lock:
+            if self.count < self.threshold:
+                self._ivf = None
+                return
+            rows = np.flatnonzero(self.valid[:len(self.names)])
+            self._ivf = InvertedFile.train(self.matrix, rows)
+
+    def query_vector(self, q):
+        """The query's embedding, remembered for repeated searches"""
+        with self._lock:
+            if q in self._queries:
+                self._queries.move_to_end(q)
+                return self._queries[q]
+        vector = normalize(self.embed([q]))[0]
+        with self._lock:
+            self._queries[q] = vector
+            while len(self._queries) > KEEP_QUERIES:
+                self._queries.popitem(last=False)
+        return vector
+
+    def search_vector(self, vector, k=100, exact=False):
+        """Module: search_vector: the k rows nearest a unit vector
+        :param exact: score every row even when the inverted file is built
+        :returns: (rows, scores), best first"""
+        with self._lock:
+            matrix, valid, ivf, n = self.matrix, self.valid, self._ivf, len(self.names)
+        if matrix is None or not n:
+            return np.zeros(0, np.int64), np.zeros(0, np.float32)
+        vector = np.asarray(vector, np.float32)
+        if ivf is not None and not exact:
+            rows = ivf.candidates(vector)
+            rows = rows[valid[rows]]
+            scores = matrix[rows].astype(np.float32) @ vector
+            best = top_k(scores, k)
+            return rows[best], scores[best]
+        scores = np.empty(n, np.float32)
+        for start in range(0, n, SCORE_BLOCK):
+            stop = min(n, start + SCORE_BLOCK)
+            np.dot(matrix[start:stop].astype(np.float32), vector, out=scores[start:stop])
+        scores[~valid[:n]] = -np.inf
+        best = top_k(scores, k)
+        best = best[np.isfinite(scores[best])]
+        return best, scores[best]
+
+    def search(self, q, k=100):
+        """Module: search: files whose captions are closest in meaning to q
+        :returns: list of (filename, score), best first"""
+        if not q.strip():
+            return []
+        rows, scores = self.search_vector(self.query_vector(q), k)
+        with self._lock:
+            return [(self.names[row], float(score)) for row, score in zip(rows, scores)
+                    if self.names[row] is not None]
+
+    def stats(self):
+        return {"model": self.model, "vectors": self.count, "pending": len(self._pending),
+                "ivf": self._ivf.stats() if self._ivf is not None else None,
+                "error": self.error}
+
+class InvertedFile:
+    """Module: InvertedFile: rows grouped by their nearest centroid"""
+    def __init__(self, centroids, lists, trained):
+        self.centroids = centroids
+        self.lists = lists
+        self.extra = [[] for _ in lists]
+        self.trained = trained
+        self.nprobe = max(NPROBE_MIN, int(len(centroids) * NPROBE_SHARE))
+
+    @classmethod
+    def train(cls, matrix, rows, seed=0):
+        """Centroids from a sample of rows, then every row assigned"""
+        k = max(1, int(np.sqrt(len(rows))))
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(rows, min(len(rows), k * KMEANS_SAMPLE), replace=False))
+        centroids = kmeans(normalize(matrix[sample].astype(np.float32)), k, seed=seed)
+        nearest = np.empty(len(rows), np.int32)
+        for start in range(0, len(rows), BLOCK):
+            block = matrix[rows[start:start + BLOCK]].astype(np.float32)
+            nearest[start:start + BLOCK] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(nearest, kind='stable')
+        bounds = np.searchsorted(nearest[order], np.arange(k + 1))
+        lists = [rows[order[bounds[i]:bounds[i + 1]]] for i in range(k)]
+        return cls(centroids, lists, len(rows))
+
+    def add(self, rows, vectors):
+        """Put new or changed rows in their nearest group"""
+        for row, group in zip(rows, np.argmax(vectors @ self.centroids.T, axis=1)):
+            self.extra[group].append(row)
+
+    def candidates(self, vector):
+        """Rows in the groups nearest the vector; may repeat a changed row"""
+        groups = top_k(self.centroids @ vector, self.nprobe)
+        parts = [self.lists[g] for g in groups]
+        parts += [np.asarray(self.extra[g], np.int64) for g in groups if self.extra[g]]
+        return np.unique(np.concatenate(parts))
+
+    def stats(self):
+        return {"groups": len(self.centroids), "nprobe": self.nprobe, "trained": self.trained}
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def open_vectors(db_path, embed, model):
+    """Module: open_vectors: the shared VectorIndex for a caption store
+    and embedding model; another model starts the vectors over"""
+    key = (os.path.abspath(db_path), model)
+    with _indexes_lock:
+        if key not in _indexes:
+            for old in [k for k in _indexes if k[0] == key[0]]:
+                del _indexes[old]
+            _indexes[key] = VectorIndex(db_path, embed, model)
+        return _indexes[key]
+
+def clustered(n, dim, clusters, rng, spread=1.5):
+    """Synthetic unit vectors around random topics, like caption embeddings"""
+    topics = normalize(rng.standard_normal((clusters, dim)))
+    out = np.empty((n, dim), np.float32)
+    for start in range(0, n, BLOCK):
+        m = min(BLOCK, n - start)
+        noise = rng.standard_normal((m, dim)) * spread / np.sqrt(dim)
+        out[start:start + m] = normalize(topics[rng.integers(clusters, size=m)] + noise)
+    return out
+
+def bench(sizes=(10_000, 100_000, 1_000_000), dim=256, queries=50, k=10):
+    """Module: bench: latency and recall@k, every row scored vs inverted file"""
+    import tempfile
+    rng = np.random.default_rng(1)
+    print(f"{'vectors':>9} {'exact ms':>9} {'ivf ms':>8} {'recall':>7} {'build s':>8}")
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            index = VectorIndex(os.path.join(folder, 'bench.db'), threshold=n + 1)
+            data = clustered(n, dim, max(8, n // 500), rng)
+            for start in range(0, n, BLOCK):
+                index.add([f"{i}.jpg" for i in range(start, min(n, start + BLOCK))],
+                          data[start:start + BLOCK])
+            noise = rng.standard_normal((queries, dim)) * 0.75 / np.sqrt(dim)
+            probes = normalize(data[rng.choice(n, queries)] + noise)
+            del data
+            start = time.perf_counter()
+            truth = [set(index.search_vector(q, k)[0]) for q in probes]
+            exact = (time.perf_counter() - start) / queries * 1e3
+            start = time.perf_counter()
+            index.threshold = 1
+            index.train()
+            built = time.perf_counter() - start
+            start = time.perf_counter()
+            found = [set(index.search_vector(q, k)[0]) for q in probes]
+            ivf = (time.perf_counter() - start) / queries * 1e3
+            recall = np.mean([len(a & b) / k for a, b in zip(truth, found)])
+            print(f"{n:>9} {exact:>9.2f} {ivf:>8.2f} {recall:>7.3f} {built:>8.1f}")
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or (10_000, 100_000, 1_000_000)
+    bench(sizes)
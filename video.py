@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Module: video
+Description: Keyframes for captioning videos.
+
+Instead of sending a whole video, a few frames that show what happens in
+it are sent. The video is scanned at SCAN_FPS frames a second, shrunk to
+64x64, with ffmpeg. Each frame's colour histogram is compared with the
+previous one using NumPy, and the frames after the biggest changes
+(scene cuts) are kept, up to MAX_FRAMES, topped up with evenly spaced
+frames for videos with few cuts. Those frames are then extracted at
+model size as JPEGs and cached by content hash and sampling settings.
+Without ffmpeg, anything Pillow can read as a sequence of frames (GIF,
+animated WebP) still works."""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import subprocess
+import numpy as np
+from PIL import Image, ImageSequence
+import preprocess
+from audio import clock
+
+FFMPEG = shutil.which('ffmpeg')
+SCAN_FPS = 2
+SCAN_SIZE = 64
+MAX_FRAMES = 8
+# Histogram difference (0-2) that counts as a scene cut
+CUT_THRESHOLD = 0.4
+BINS = 16
+FRAME_PROMPT = ("These are {n} frames from one video, at {times}. "
+                "{prompt}")
+
+def params(max_frames=MAX_FRAMES, scan_fps=SCAN_FPS, threshold=CUT_THRESHOLD):
+    """Module: params: sampling settings, for cache keys"""
+    return dict(preprocess.params(), frames=max_frames, scan_fps=scan_fps,
+                threshold=threshold)
+
+def histogram(frame):
+    """Normalized BINS-bin histogram of each colour channel, concatenated"""
+    pixels = frame.reshape(-1, 3) // (256 // BINS)
+    counts = [np.bincount(pixels[:, c], minlength=BINS) for c in range(3)]
+    return np.concatenate(counts) / len(pixels)
+
+def _ffmpeg_scan(path, fps):
+    """Yield (seconds, small RGB frame) at fps frames a second"""
+    size = SCAN_SIZE * SCAN_SIZE * 3
+    proc = subprocess.Popen([FFMPEG, '-nostdin', '-v', 'error', '-i', path, '-an',
+                             '-vf', f'fps={fps},scale={SCAN_SIZE}:{SCAN_SIZE}',
+                             '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        i = 0
+        while len(data := proc.stdout.read(size)) == size:
+            yield i / fps, np.frombuffer(data, np.uint8).reshape(SCAN_SIZE, SCAN_SIZE, 3)
+            i += 1
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+def _pil_scan(path, fps):
+    """Frames of a GIF or animated WebP, at about fps frames a second"""
+    with Image.open(path) as img:
+        t, next_t = 0.0, 0.0
+        for frame in ImageSequence.Iterator(img):
+            if t >= next_t:
+                small = frame.convert('RGB').resize((SCAN_SIZE, SCAN_SIZE))
+                yield t, np.asarray(small)
+                next_t += 1 / fps
+            t += frame.info.get('duration', 100) / 1000
+
+def scan(path, fps=SCAN_FPS):
+    """Module: scan: (seconds, histogram) of frames sampled fps a second"""
+    frames = _ffmpeg_scan(path, fps) if FFMPEG else _pil_scan(path, fps)
+    for t, frame in frames:
+        yield t, histogram(frame)
+
+def select_keyframes(times, histograms, max_frames=MAX_FRAMES, threshold=CUT_THRESHOLD):
+    """Module: select_keyframes: times of the frames that best cover a video
+    :param times: frame times in seconds
+    :param histograms: one histogram per frame, as from histogram()
+    :returns: sorted list of up to max_frames times"""
+    n = len(times)
+    if n <= max_frames:
+        return list(times)
+    hist = np.asarray(histograms)
+    # L1 distance between consecutive frames, summed over channels
+    diff = np.abs(np.diff(hist, axis=0)).sum(axis=1) / 3
+    cuts = np.flatnonzero(diff >= threshold) + 1
+    chosen = {0}
+    # Biggest changes first
+    for i in cuts[np.argsort(-diff[cuts - 1], kind='stable')]:
+        if len(chosen) >= max_frames:
+            break
+        chosen.add(int(i))
+    # Top up with evenly spaced frames, away from those already chosen
+    for i in np.linspace(0, n - 1, max_frames + 2)[1:-1].astype(int):
+        if len(chosen) >= max_frames:
+            break
+        if all(abs(int(i) - c) > n // (2 * max_frames) for c in chosen):
+            chosen.add(int(i))
+    return [times[i] for i in sorted(chosen)]
+
+def _ffmpeg_frame(path, t, size):
+    result = subprocess.run(
+        [FFMPEG, '-nostdin', '-v', 'error', '-ss', f'{t:.3f}', '-i', path,
+         '-frames:v', '1', '-f', 'image2pipe', '-vcodec', 'png', '-'],
+        capture_output=True, check=True)
+    with Image.open(io.BytesIO(result.stdout)) as img:
+        return preprocess.encode(img, size, 'JPEG', preprocess.QUALITY)
+
+def _pil_frames(path, wanted, size):
+    out = []
+    with Image.open(path) as img:
+        t = 0.0
+        for frame in ImageSequence.Iterator(img):
+            while len(out) < len(wanted) and wanted[len(out)] <= t + 1e-6:
+                out.append(preprocess.encode(frame.convert('RGB'), size, 'JPEG',
+                                             preprocess.QUALITY))
+            t += frame.info.get('duration', 100) / 1000
+    return out
+
+def keyframes(path, digest, cache_dir=None, max_frames=MAX_FRAMES):
+    """Module: keyframes: representative frames of a video, cached
+    :param path: video file
+    :param digest: content hash of path
+    :param cache_dir: directory for the cache, e.g. the thumbnail cache
+    :returns: list of (seconds, JPEG bytes)"""
+    settings = params(max_frames)
+    key = hashlib.blake2b(json.dumps(settings, sort_keys=True).encode(),
+                          digest_size=6).hexdigest()
+    folder = os.path.join(cache_dir, 'video', digest[:2], f"{digest}-{key}") if cache_dir else None
+    manifest = os.path.join(folder, 'frames.json') if folder else None
+    if manifest and os.path.exists(manifest):
+        with open(manifest) as f:
+            times = json.load(f)
+        frames = []
+        for i, t in enumerate(times):
+            with open(os.path.join(folder, f"{i:02}.jpg"), 'rb') as f:
+                frames.append((t, f.read()))
+        return frames
+    times, hists = [], []
+    for t, h in scan(path):
+        times.append(t)
+        hists.append(h)
+    if not times:
+        raise ValueError(f"No frames could be read from {path}")
+    wanted = select_keyframes(times, hists, max_frames)
+    size = preprocess.SIZE
+    if FFMPEG:
+        images = [_ffmpeg_frame(path, t, size) for t in wanted]
+    else:
+        images = _pil_frames(path, wanted, size)
+    frames = list(zip(wanted, images))
+    if folder:
+        tmp = f"{folder}.{os.getpid()}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+        for i, (t, data) in enumerate(frames):
+            with open(os.path.join(tmp, f"{i:02}.jpg"), 'wb') as f:
+                f.write(data)
+        with open(os.path.join(tmp, 'frames.json'), 'w') as f:
+            json.dump([t for t, _ in frames], f)
+        try:
+            os.replace(tmp, folder)
+        except OSError:
+            # Another worker got there first
+            shutil.rmtree(tmp, ignore_errors=True)
+    return frames
+
+def frame_prompt(frames, prompt):
+    """Module: frame_prompt: prompt for a batch of frames, with their times"""
+    times = ", ".join(clock(t) for t, _ in frames)
+    return FRAME_PROMPT.format(n=len(frames), times=times, prompt=prompt)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python video.py <video file>")
+        sys.exit(1)
+    start = time.perf_counter()
+    times, hists = zip(*scan(sys.argv[1]))
+    scanned = time.perf_counter() - start
+    print(f"{len(times)} frames scanned in {scanned:.2f} s "
+          f"with {'ffmpeg' if FFMPEG else 'Pillow'}; keyframes at "
+          f"{', '.join(f'{t:.1f}' for t in select_keyframes(times, hists))} s")
@@ -1,6 +1,17 @@
 #!/usr/bin/python
 import sys
 import os
+import mmap
+import zlib
+import time
+import queue
+import atexit
+import shutil
+import struct
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import exiftool
@@ -8,19 +19,234 @@ try:
 except ImportError:
     EXIFTOOL_AVAILABLE = False
 
-def get_keywords(image_path):
-    if not EXIFTOOL_AVAILABLE:
-        print("Warning: exiftool module not available. Cannot extract keywords.")
-        return None
+# Files per exiftool request, and most exiftool processes kept running
+CHUNK_SIZE = 64
+MAX_SESSIONS = os.cpu_count() or 4
+SUBJECT_TAGS = ["XMP:Subject"]
+
+# Keywords already read, by (path, size, mtime)
+_cache = {}
+_cache_lock = threading.Lock()
+# Idle stay-open exiftool sessions, shared by all threads
+_sessions = queue.LifoQueue()
+_all_sessions = []
+_sessions_lock = threading.Lock()
+
+def _acquire():
+    """Reuse an idle exiftool session, or start one"""
     try:
-        with exiftool.ExifToolHelper() as et:
-            metadata = et.get_metadata(image_path)[0]
-            for key, value in metadata.items():
-                if key.startswith("XMP") and "Subject" in key:
-                    return str.join(' ', value)
+        return _sessions.get_nowait()
+    except queue.Empty:
+        pass
+    with _sessions_lock:
+        if len(_all_sessions) < MAX_SESSIONS:
+            et = exiftool.ExifToolHelper(check_execute=False)
+            _all_sessions.append(et)
+            return et
+    return _sessions.get()
+
+def _release(et):
+    _sessions.put(et)
 
+@atexit.register
+def close_sessions():
+    """Module: close_sessions: stop all exiftool processes"""
+    with _sessions_lock:
+        for et in _all_sessions:
+            try:
+                et.terminate()
+            except Exception:
+                pass
+        _all_sessions.clear()
+    while not _sessions.empty():
+        _sessions.get_nowait()
+
+def _join(value):
+    """XMP:Subject is a list, or a bare value for a single keyword"""
+    if isinstance(value, list):
+        return str.join(' ', (str(v) for v in value))
+    return str(value)
+
+def _discard(et):
+    """Drop a session whose exiftool process failed"""
+    with _sessions_lock:
+        if et in _all_sessions:
+            _all_sessions.remove(et)
+    try:
+        et.terminate()
+    except Exception:
+        pass
+
+def _read_chunk(paths):
+    """Read Subject tags for a list of files with one exiftool request"""
+    try:
+        et = _acquire()
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return None
+    try:
+        results = et.get_tags(paths, tags=SUBJECT_TAGS)
     except Exception as e:
+        _discard(et)
         print(f"Error: {str(e)}")
+        return None
+    _release(et)
+    found = {}
+    for metadata in results:
+        for key, value in metadata.items():
+            if key.startswith("XMP") and "Subject" in key:
+                found[metadata.get("SourceFile")] = _join(value)
+                break
+    # exiftool reports SourceFile with the path as given
+    return {path: found.get(path) for path in paths}
+
+# Native XMP packet reader for JPEG, PNG and WebP. Other formats, or
+# packets we cannot parse, fall back to exiftool.
+UNHANDLED = object()
+JPEG_XMP = b"http://ns.adobe.com/xap/1.0/\x00"
+PNG_SIG = b"\x89PNG\r\n\x1a\n"
+PNG_XMP = b"XML:com.adobe.xmp"
+DC = "{http://purl.org/dc/elements/1.1/}"
+RDF = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}"
+
+def _jpeg_packet(m):
+    pos = 2
+    while pos + 4 <= len(m):
+        if m[pos] != 0xFF:
+            return None
+        marker = m[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker in (0xD9, 0xDA):  # EOI, start of scan: no more metadata
+            return None
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        length = struct.unpack_from(">H", m, pos + 2)[0]
+        if marker == 0xE1 and m[pos + 4:pos + 4 + len(JPEG_XMP)] == JPEG_XMP:
+            return m[pos + 4 + len(JPEG_XMP):pos + 2 + length]
+        pos += 2 + length
+    return None
+
+def _png_packet(m):
+    pos = 8
+    while pos + 8 <= len(m):
+        length, kind = struct.unpack_from(">I4s", m, pos)
+        if kind == b"IEND":
+            return None
+        if kind == b"iTXt":
+            data = m[pos + 8:pos + 8 + length]
+            keyword, _, rest = data.partition(b"\x00")
+            if keyword == PNG_XMP:
+                compressed = rest[0]
+                # Skip compression method, language tag, translated keyword
+                text = rest[2:].split(b"\x00", 2)[2]
+                return zlib.decompress(text) if compressed else text
+        pos += 12 + length
+    return None
+
+def _webp_packet(m):
+    pos = 12
+    while pos + 8 <= len(m):
+        kind, length = struct.unpack_from("<4sI", m, pos)
+        if kind == b"XMP ":
+            return m[pos + 8:pos + 8 + length]
+        pos += 8 + length + (length & 1)
+    return None
+
+def _subject(packet):
+    """Keywords from the dc:subject bag of an XMP packet"""
+    start = packet.find(b"<x:xmpmeta")
+    end = packet.rfind(b"</x:xmpmeta>")
+    if start < 0 or end < 0:
+        return UNHANDLED
+    root = ET.fromstring(packet[start:end + len(b"</x:xmpmeta>")])
+    for subject in root.iter(DC + "subject"):
+        words = [li.text.strip() for li in subject.iter(RDF + "li") if li.text]
+        return str.join(' ', words) if words else None
+    return None
+
+def read_packet_keywords(path):
+    """Module: read_packet_keywords: dc:subject keywords without exiftool
+    :param path: JPEG, PNG or WebP file
+    :returns: keywords string, None, or UNHANDLED for other formats"""
+    try:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if m[:3] == b"\xff\xd8\xff":
+                    packet = _jpeg_packet(m)
+                elif m[:8] == PNG_SIG:
+                    packet = _png_packet(m)
+                elif m[:4] == b"RIFF" and m[8:12] == b"WEBP":
+                    packet = _webp_packet(m)
+                else:
+                    return UNHANDLED
+        return _subject(packet) if packet else None
+    except (OSError, ValueError, IndexError, struct.error, zlib.error, ET.ParseError):
+        return UNHANDLED
+
+def _key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (path, st.st_size, st.st_mtime_ns)
+
+def get_keywords_many(paths, chunk=CHUNK_SIZE, workers=None, sources=None):
+    """Module: get_keywords_many: XMP keywords for many files at once
+    :param paths: list of file paths
+    :param chunk: files per exiftool request
+    :param workers: exiftool sessions to use, default one per core
+    :param sources: optional dict, filled with the path that served each
+        file: 'cache', 'native' or 'exiftool'
+    :returns: dict of path to keywords string, or None"""
+    paths = list(paths)
+    sources = {} if sources is None else sources
+    keys = {path: _key(path) for path in paths}
+    out, todo = {}, []
+    with _cache_lock:
+        for path in paths:
+            if keys[path] in _cache:
+                out[path] = _cache[keys[path]]
+                sources[path] = 'cache'
+            elif keys[path] is None:
+                out[path] = None
+            else:
+                todo.append(path)
+    rest = []
+    for path in todo:
+        keywords = read_packet_keywords(path)
+        if keywords is UNHANDLED:
+            rest.append(path)
+            continue
+        out[path] = keywords
+        sources[path] = 'native'
+        with _cache_lock:
+            _cache[keys[path]] = keywords
+    if rest and not EXIFTOOL_AVAILABLE:
+        print("Warning: exiftool module not available. Cannot extract keywords.")
+        out.update((path, None) for path in rest)
+        return out
+    chunks = [rest[i:i + chunk] for i in range(0, len(rest), chunk)]
+    if not chunks:
+        return out
+    workers = min(workers or MAX_SESSIONS, MAX_SESSIONS, len(chunks))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch, result in zip(chunks, pool.map(_read_chunk, chunks)):
+            if result is None:
+                # exiftool failed; leave these uncached to retry later
+                out.update((path, None) for path in batch)
+                continue
+            with _cache_lock:
+                for path, keywords in result.items():
+                    _cache[keys[path]] = keywords
+                    sources[path] = 'exiftool'
+            out.update(result)
+    return out
+
+def get_keywords(image_path):
+    return get_keywords_many([image_path])[image_path]
 
 def get_custom_metadata(image_path):
     if not EXIFTOOL_AVAILABLE:
@@ -53,9 +279,76 @@ def get_custom_metadata(image_path):
     except Exception as e:
         print(f"Error: {str(e)}")
 
+XMP_PACKET = """<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:subject><rdf:Bag>{}</rdf:Bag></dc:subject>
+</rdf:Description></rdf:RDF></x:xmpmeta>
+<?xpacket end="w"?>"""
+
+def make_corpus(folder, count=300, size=512):
+    """Module: make_corpus: write tagged JPEG, PNG and WebP test images
+    :returns: dict of path to expected keywords"""
+    import io
+    from PIL import Image, PngImagePlugin
+    expected = {}
+    for i in range(count):
+        words = [f"word{i}", "meme", "test"]
+        packet = XMP_PACKET.format(''.join(f"<rdf:li>{w}</rdf:li>" for w in words))
+        img = Image.new("RGB", (size, size), (i % 256, 80, 160))
+        kind = ("jpg", "png", "webp")[i % 3]
+        path = os.path.join(folder, f"img{i:05d}.{kind}")
+        if kind == "jpg":
+            buf = io.BytesIO()
+            img.save(buf, "JPEG")
+            data = JPEG_XMP + packet.encode()
+            app1 = b"\xff\xe1" + struct.pack(">H", len(data) + 2) + data
+            with open(path, "wb") as f:
+                f.write(buf.getvalue()[:2] + app1 + buf.getvalue()[2:])
+        elif kind == "png":
+            info = PngImagePlugin.PngInfo()
+            info.add_itxt(PNG_XMP.decode(), packet, zip=i % 2 == 0)
+            img.save(path, "PNG", pnginfo=info)
+        else:
+            img.save(path, "WEBP", xmp=packet.encode())
+        expected[path] = ' '.join(words)
+    return expected
+
+def bench(count=300):
+    """Module: bench: compare the native reader with exiftool"""
+    with tempfile.TemporaryDirectory() as folder:
+        expected = make_corpus(folder, count)
+        paths = list(expected)
+        start = time.perf_counter()
+        found = {path: read_packet_keywords(path) for path in paths}
+        native = time.perf_counter() - start
+        wrong = sum(found[path] != expected[path] for path in paths)
+        print(f"{count} files, {wrong} mismatches")
+        print(f"native:        {native * 1e3:9.1f} ms  {native / count * 1e6:8.1f} us/file")
+        if not EXIFTOOL_AVAILABLE or not shutil.which("exiftool"):
+            print("exiftool not available, skipping exiftool timings")
+            return
+        _cache.clear()
+        start = time.perf_counter()
+        for i in range(0, count, CHUNK_SIZE):
+            _read_chunk(paths[i:i + CHUNK_SIZE])
+        bulk = time.perf_counter() - start
+        print(f"exiftool bulk: {bulk * 1e3:9.1f} ms  {bulk / count * 1e6:8.1f} us/file")
+        sample = paths[:min(count, 20)]
+        start = time.perf_counter()
+        for path in sample:
+            with exiftool.ExifToolHelper() as et:
+                et.get_tags(path, tags=SUBJECT_TAGS)
+        single = (time.perf_counter() - start) / len(sample)
+        print(f"exiftool/file: {single * count * 1e3:9.1f} ms  {single * 1e6:8.1f} us/file (estimated)")
+
 if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "--bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 300)
+        sys.exit(0)
     if len(sys.argv) != 2:
         print("Usage: python script.py <image_path>")
+        print("       python script.py --bench [number of files]")
         sys.exit(1)
 
     image_path = sys.argv[1]